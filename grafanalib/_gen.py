@@ -1,14 +1,28 @@
 """Generate JSON Grafana dashboards."""
 
 import argparse
+import concurrent.futures
 import json
 import os
 import sys
 
+import attr
+
+from grafanalib import allowlist, cardinality, checks, cost, recording, shard, variables
+from grafanalib.core import LATEST_SCHEMA_VERSION, SCHEMA_VERSION
+from grafanalib.optimize import parse_duration
+from grafanalib.validators import (
+    ValidationError, deferred_validation, validate_all)
+
 
 DASHBOARD_SUFFIX = '.dashboard.py'
 ALERTGROUP_SUFFIX = '.alertgroup.py'
 
+VALIDATION_EAGER = 'eager'
+VALIDATION_DEFERRED = 'deferred'
+VALIDATION_TRUSTED = 'trusted'
+VALIDATION_MODES = (VALIDATION_EAGER, VALIDATION_DEFERRED, VALIDATION_TRUSTED)
+
 """
 Common generation functionality
 """
@@ -76,6 +90,44 @@ def loader(path):
     return grafanalibtype
 
 
+def load(path, validation=VALIDATION_EAGER):
+    """Load a grafanalib type, choosing when its fields are validated.
+
+    :param str path: Path to a *.<type>.py file that defines a variable called <type>.
+    :param str validation: One of ``VALIDATION_MODES``. ``eager`` validates
+        every object as it is constructed, ``deferred`` validates the loaded
+        object once with ``validate_all``, and ``trusted`` skips validation
+        for definitions that are already known to be valid.
+    """
+    if validation == VALIDATION_EAGER:
+        return loader(path)
+    with deferred_validation():
+        grafanalibtype = loader(path)
+    if validation == VALIDATION_DEFERRED:
+        validate_all(grafanalibtype)
+    return grafanalibtype
+
+
+def check_consistency(grafanalibtype, error=DashboardError):
+    """Raise ``error`` if ``grafanalibtype`` fails the cross-object checks."""
+    problems = checks.check(grafanalibtype)
+    if problems:
+        raise error('\n'.join(str(p) for p in problems))
+    return grafanalibtype
+
+
+def add_validation_argument(parser):
+    parser.add_argument(
+        '--validation', choices=VALIDATION_MODES, default=VALIDATION_EAGER,
+        help='When to validate definitions (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--check', action='store_true',
+        help='Fail on duplicate ids, overlapping panels and other '
+             'cross-object inconsistencies',
+    )
+
+
 def run_script(f):
     sys.exit(f(sys.argv[1:]))
 
@@ -89,10 +141,12 @@ def print_alertgroup(dashboard):
     write_dashboard(dashboard, stream=sys.stdout)
 
 
-def write_alertgroups(paths):
+def write_alertgroups(paths, validation=VALIDATION_EAGER, check=False):
     for path in paths:
         assert path.endswith(ALERTGROUP_SUFFIX)
-        dashboard = loader(path)
+        dashboard = load(path, validation)
+        if check:
+            check_consistency(dashboard, AlertGroupError)
         with open(get_alertgroup_json_path(path), 'w') as json_file:
             write_dashboard(dashboard, json_file)
 
@@ -118,10 +172,11 @@ def generate_alertgroups(args):
         'alertgroups', metavar='ALERT', type=os.path.abspath,
         nargs='+', help='Path to alertgroup definition',
     )
+    add_validation_argument(parser)
     opts = parser.parse_args(args)
     try:
-        write_alertgroups(opts.alertgroups)
-    except AlertGroupError as e:
+        write_alertgroups(opts.alertgroups, opts.validation, opts.check)
+    except (AlertGroupError, ValidationError) as e:
         sys.stderr.write('ERROR: {}\n'.format(e))
         return 1
     return 0
@@ -137,15 +192,18 @@ def generate_alertgroup(args):
         'alertgroup', metavar='ALERT', type=os.path.abspath,
         help='Path to alertgroup definition',
     )
+    add_validation_argument(parser)
     opts = parser.parse_args(args)
     try:
-        alertgroup = loader(opts.alertgroup)
+        alertgroup = load(opts.alertgroup, opts.validation)
+        if opts.check:
+            check_consistency(alertgroup, AlertGroupError)
         if not opts.output:
             print_alertgroup(alertgroup)
         else:
             with open(opts.output, 'w') as output:
                 write_alertgroup(alertgroup, output)
-    except AlertGroupError as e:
+    except (AlertGroupError, ValidationError) as e:
         sys.stderr.write('ERROR: {}\n'.format(e))
         return 1
     return 0
@@ -170,12 +228,97 @@ def print_dashboard(dashboard):
     write_dashboard(dashboard, stream=sys.stdout)
 
 
-def write_dashboards(paths):
+def schema_version(value):
+    version = int(value)
+    if not SCHEMA_VERSION <= version <= LATEST_SCHEMA_VERSION:
+        raise argparse.ArgumentTypeError(
+            'Schema version must be between {} and {}'.format(
+                SCHEMA_VERSION, LATEST_SCHEMA_VERSION))
+    return version
+
+
+def add_schema_version_argument(parser):
+    parser.add_argument(
+        '--schema-version', type=schema_version,
+        help='Emit dashboards in the shape of this Grafana schema version, '
+             'up to {} (default: the one of each dashboard)'.format(LATEST_SCHEMA_VERSION),
+    )
+
+
+def with_schema_version(dashboard, version):
+    """Return ``dashboard`` set to emit schema ``version``, if given."""
+    if version is None:
+        return dashboard
+    return attr.evolve(dashboard, schemaVersion=version)
+
+
+def duration(value):
+    seconds = parse_duration(value)
+    if seconds is None:
+        raise argparse.ArgumentTypeError('{} is not a duration such as 12h'.format(value))
+    return seconds
+
+
+def add_snapshot_arguments(parser):
+    parser.add_argument(
+        '--variable-fixture', type=os.path.abspath,
+        help='Resolve query variables found in this JSON file into custom '
+             'variables, see variables.FixtureResolver',
+    )
+    parser.add_argument(
+        '--max-variable-age', type=duration,
+        help='Fail when the values of a variable in the fixture are older than this',
+    )
+
+
+def with_snapshot(dashboard, fixture, max_age=None):
+    """Return ``dashboard`` with the query variables in ``fixture``, if
+    given, resolved into custom variables."""
+    if fixture is None:
+        return dashboard
+    try:
+        return variables.snapshot_variables(
+            dashboard, variables.FixtureResolver(fixture), max_age=max_age, strict=True)
+    except ValueError as e:
+        raise DashboardError(str(e))
+
+
+def add_shard_arguments(parser):
+    parser.add_argument(
+        '--max-panels', type=int,
+        help='Split dashboards with more panels into linked dashboards, '
+             'written next to the first one with -2, -3, ... appended',
+    )
+    parser.add_argument(
+        '--max-bytes', type=int,
+        help='Split dashboards whose JSON is bigger into linked dashboards',
+    )
+
+
+def get_shard_json_path(path, index):
+    """Return where to write shard ``index`` (counting from 1) of ``path``."""
+    if index == 1:
+        return path
+    base, ext = os.path.splitext(path)
+    return '{}-{}{}'.format(base, index, ext)
+
+
+def write_shards(dashboard, path, max_panels=None, max_bytes=None):
+    shards = shard.shard_dashboard(dashboard, max_panels, max_bytes)
+    for index, dashboard_shard in enumerate(shards, 1):
+        with open(get_shard_json_path(path, index), 'w') as json_file:
+            write_dashboard(dashboard_shard, json_file)
+
+
+def write_dashboards(paths, validation=VALIDATION_EAGER, check=False, schema_version=None,
+                     max_panels=None, max_bytes=None, variable_fixture=None, max_variable_age=None):
     for path in paths:
         assert path.endswith(DASHBOARD_SUFFIX)
-        dashboard = loader(path)
-        with open(get_dashboard_json_path(path), 'w') as json_file:
-            write_dashboard(dashboard, json_file)
+        dashboard = with_schema_version(load(path, validation), schema_version)
+        dashboard = with_snapshot(dashboard, variable_fixture, max_variable_age)
+        if check:
+            check_consistency(dashboard)
+        write_shards(dashboard, get_dashboard_json_path(path), max_panels, max_bytes)
 
 
 def get_dashboard_json_path(path):
@@ -199,10 +342,16 @@ def generate_dashboards(args):
         'dashboards', metavar='DASHBOARD', type=os.path.abspath,
         nargs='+', help='Path to dashboard definition',
     )
+    add_validation_argument(parser)
+    add_schema_version_argument(parser)
+    add_shard_arguments(parser)
+    add_snapshot_arguments(parser)
     opts = parser.parse_args(args)
     try:
-        write_dashboards(opts.dashboards)
-    except DashboardError as e:
+        write_dashboards(
+            opts.dashboards, opts.validation, opts.check, opts.schema_version,
+            opts.max_panels, opts.max_bytes, opts.variable_fixture, opts.max_variable_age)
+    except (DashboardError, ValidationError) as e:
         sys.stderr.write('ERROR: {}\n'.format(e))
         return 1
     return 0
@@ -218,15 +367,23 @@ def generate_dashboard(args):
         'dashboard', metavar='DASHBOARD', type=os.path.abspath,
         help='Path to dashboard definition',
     )
+    add_validation_argument(parser)
+    add_schema_version_argument(parser)
+    add_shard_arguments(parser)
+    add_snapshot_arguments(parser)
     opts = parser.parse_args(args)
+    if (opts.max_panels or opts.max_bytes) and not opts.output:
+        parser.error('--max-panels and --max-bytes need --output')
     try:
-        dashboard = loader(opts.dashboard)
+        dashboard = with_schema_version(load(opts.dashboard, opts.validation), opts.schema_version)
+        dashboard = with_snapshot(dashboard, opts.variable_fixture, opts.max_variable_age)
+        if opts.check:
+            check_consistency(dashboard)
         if not opts.output:
             print_dashboard(dashboard)
         else:
-            with open(opts.output, 'w') as output:
-                write_dashboard(dashboard, output)
-    except DashboardError as e:
+            write_shards(dashboard, opts.output, opts.max_panels, opts.max_bytes)
+    except (DashboardError, ValidationError) as e:
         sys.stderr.write('ERROR: {}\n'.format(e))
         return 1
     return 0
@@ -240,3 +397,339 @@ def generate_dashboards_script():
 def generate_dashboard_script():
     """Entry point for generate-dashboard."""
     run_script(generate_dashboard)
+
+
+"""
+Dashboard cost
+"""
+
+
+def name_count(value):
+    """Parse a ``NAME=COUNT`` option."""
+    name, sep, count = value.partition('=')
+    if not sep or not name or not count.isdigit():
+        raise argparse.ArgumentTypeError(
+            '{} is not of the form NAME=COUNT'.format(value))
+    return name, int(count)
+
+
+def format_cost(report, viewers=1):
+    return (
+        '{}: {} queries per load ({} more in collapsed rows), '
+        '{:.2f} queries/s for {} viewers, {} points per load'.format(
+            report.title, report.queries_per_load, report.collapsed_queries,
+            report.queries_per_second * viewers, viewers, report.points_per_load))
+
+
+def report_dashboard_cost(args):
+    """Script reporting the queries dashboards issue, failing over budget."""
+    parser = argparse.ArgumentParser(prog='dashboard-cost')
+    parser.add_argument(
+        'dashboards', metavar='DASHBOARD', type=dashboard_path,
+        nargs='+', help='Path to dashboard definition',
+    )
+    parser.add_argument(
+        '--viewers', type=int, default=1,
+        help='Number of people viewing each dashboard at once (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--fan-out', metavar='VARIABLE=COUNT', type=name_count, action='append', default=[],
+        help='Number of values of a query variable panels repeat over',
+    )
+    parser.add_argument('--max-queries-per-load', type=int, help='Fail above this many queries per load')
+    parser.add_argument('--max-queries-per-second', type=float,
+                        help='Fail above this many queries per second, for all viewers')
+    parser.add_argument('--max-points-per-load', type=int, help='Fail above this many data points per load')
+    parser.add_argument(
+        '--cardinality', metavar='SNAPSHOT', type=os.path.abspath,
+        help='Estimate the series and samples Prometheus targets read from this '
+             'JSON dump of /api/v1/status/tsdb',
+    )
+    parser.add_argument(
+        '--scrape-interval', type=duration, default=cardinality.DEFAULT_SCRAPE_INTERVAL,
+        help='Seconds between two samples of a series (default: %(default)s)',
+    )
+    parser.add_argument('--max-series-per-load', type=int, help='Fail above this many series per load')
+    parser.add_argument('--max-samples-per-load', type=int, help='Fail above this many samples per load')
+    parser.add_argument(
+        '--max-range', type=duration, default=cardinality.DEFAULT_MAX_RANGE,
+        help='Warn about range vectors and subqueries over this many seconds (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--max-groups', type=int, default=cardinality.DEFAULT_MAX_GROUPS,
+        help='Warn about aggregations making more groups (default: %(default)s)',
+    )
+    parser.add_argument('--json', action='store_true', help='Print the reports as JSON')
+    add_validation_argument(parser)
+    opts = parser.parse_args(args)
+    budget = cost.CostBudget(
+        max_queries_per_load=opts.max_queries_per_load,
+        max_queries_per_second=opts.max_queries_per_second,
+        max_points_per_load=opts.max_points_per_load,
+        viewers=opts.viewers,
+    )
+    query_budget = cardinality.QueryBudget(
+        max_series_per_load=opts.max_series_per_load,
+        max_samples_per_load=opts.max_samples_per_load,
+    )
+    reports = []
+    problems = []
+    warnings = []
+    try:
+        snapshot = None
+        if opts.cardinality:
+            snapshot = cardinality.load_snapshot(opts.cardinality, opts.scrape_interval)
+        for path in opts.dashboards:
+            dashboard = load(path, opts.validation)
+            if opts.check:
+                check_consistency(dashboard)
+            report = cost.dashboard_cost(dashboard, dict(opts.fan_out))
+            problems.extend(cost.check_cost(report, budget))
+            query_report = None
+            if snapshot is not None:
+                query_report = cardinality.dashboard_query_cost(
+                    dashboard, snapshot, dict(opts.fan_out), opts.max_range, opts.max_groups)
+                over_budget = cardinality.check_query_cost(query_report, query_budget)
+                problems.extend(over_budget)
+                warnings.extend(p for p in query_report.problems if p not in over_budget)
+            reports.append((report, query_report))
+    except (DashboardError, ValidationError, OSError, ValueError) as e:
+        sys.stderr.write('ERROR: {}\n'.format(e))
+        return 1
+    if opts.json:
+        data = []
+        for report, query_report in reports:
+            data.append(report.to_json_data())
+            if query_report is not None:
+                data[-1]['prometheus'] = query_report
+        json.dump(data, sys.stdout, sort_keys=True, indent=2, cls=DashboardEncoder)
+        sys.stdout.write('\n')
+    else:
+        for report, query_report in reports:
+            sys.stdout.write(format_cost(report, opts.viewers) + '\n')
+            if query_report is not None:
+                sys.stdout.write('{}: about {} series and {} samples per load\n'.format(
+                    query_report.title, query_report.series_per_load, query_report.samples_per_load))
+    for warning in warnings:
+        sys.stderr.write('WARNING: {}\n'.format(warning))
+    for problem in problems:
+        sys.stderr.write('ERROR: {}\n'.format(problem))
+    return 1 if problems else 0
+
+
+def report_dashboard_cost_script():
+    """Entry point for dashboard-cost."""
+    run_script(report_dashboard_cost)
+
+
+def find_definitions(paths, suffixes=(DASHBOARD_SUFFIX,)):
+    """Return the definitions among ``paths`` and those ending with one of
+    ``suffixes`` in the directories among them, in order."""
+    found = []
+    for path in paths:
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            found.extend(
+                os.path.join(root, name) for name in sorted(files)
+                if name.endswith(suffixes))
+    return found
+
+
+def find_dashboards(paths):
+    """Return the dashboard definitions among ``paths`` and in the
+    directories among them, in order."""
+    return find_definitions(paths)
+
+
+def load_datasource_load(path, validation=VALIDATION_EAGER, viewers=None, default_viewers=1, fan_out=None):
+    """Load a dashboard definition and return its ``cost.datasource_load``.
+
+    :param viewers: dict of the number of viewers of dashboards by title,
+        others have ``default_viewers``
+    """
+    dashboard = load(path, validation)
+    count = (viewers or {}).get(dashboard.title, default_viewers)
+    return cost.datasource_load(dashboard, count, fan_out)
+
+
+def forecast_fleet_load(args):
+    """Script forecasting the load of many dashboards on each datasource."""
+    parser = argparse.ArgumentParser(prog='fleet-cost')
+    parser.add_argument(
+        'paths', metavar='PATH', type=os.path.abspath, nargs='+',
+        help='Dashboard definition, or directory to search for them',
+    )
+    parser.add_argument(
+        '--viewers', type=int, default=1,
+        help='Number of people viewing each dashboard at once (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--dashboard-viewers', metavar='TITLE=COUNT', type=name_count, action='append', default=[],
+        help='Number of people viewing the dashboard with this title at once',
+    )
+    parser.add_argument(
+        '--fan-out', metavar='VARIABLE=COUNT', type=name_count, action='append', default=[],
+        help='Number of values of a query variable panels repeat over',
+    )
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=os.cpu_count(),
+        help='Number of dashboards to load in parallel (default: %(default)s)',
+    )
+    parser.add_argument('--json', action='store_true', help='Print the forecast as JSON')
+    parser.add_argument('--validation', choices=VALIDATION_MODES, default=VALIDATION_TRUSTED,
+                        help='When to validate definitions (default: %(default)s)')
+    opts = parser.parse_args(args)
+    paths = find_dashboards(opts.paths)
+    for path in paths:
+        if not path.endswith(DASHBOARD_SUFFIX):
+            parser.error('Dashboard file {} does not end with {}'.format(path, DASHBOARD_SUFFIX))
+    load_args = (opts.validation, dict(opts.dashboard_viewers), opts.viewers, dict(opts.fan_out))
+    try:
+        if opts.jobs > 1 and len(paths) > 1:
+            with concurrent.futures.ProcessPoolExecutor(opts.jobs) as executor:
+                futures = [executor.submit(load_datasource_load, path, *load_args) for path in paths]
+                loads = [f.result() for f in futures]
+        else:
+            loads = [load_datasource_load(path, *load_args) for path in paths]
+    except (DashboardError, DefinitionError, ValidationError) as e:
+        sys.stderr.write('ERROR: {}\n'.format(e))
+        return 1
+    forecast = cost.fleet_load(loads)
+    if opts.json:
+        json.dump(forecast, sys.stdout, sort_keys=True, indent=2, cls=DashboardEncoder)
+        sys.stdout.write('\n')
+    else:
+        for load in forecast:
+            sys.stdout.write(
+                '{}: {:.2f} queries/s, {:.0f} points/s, {} queries on load, {} dashboards\n'.format(
+                    load.datasource, load.queries_per_second, load.points_per_second,
+                    load.queries_per_load, load.dashboards))
+    return 0
+
+
+def forecast_fleet_load_script():
+    """Entry point for fleet-cost."""
+    run_script(forecast_fleet_load)
+
+
+"""
+Recording rules
+"""
+
+
+def load_definitions(parser, opts):
+    """Load the dashboard and alertgroup definitions found in ``opts.paths``.
+
+    :returns: list of ``(path, definition)``
+    """
+    paths = find_definitions(opts.paths, (DASHBOARD_SUFFIX, ALERTGROUP_SUFFIX))
+    for path in paths:
+        if not path.endswith((DASHBOARD_SUFFIX, ALERTGROUP_SUFFIX)):
+            parser.error('Definition {} does not end with {} or {}'.format(path, DASHBOARD_SUFFIX, ALERTGROUP_SUFFIX))
+    definitions = [(path, load(path, opts.validation)) for path in paths]
+    if opts.check:
+        for path, definition in definitions:
+            is_alertgroup = path.endswith(ALERTGROUP_SUFFIX)
+            check_consistency(definition, AlertGroupError if is_alertgroup else DashboardError)
+    return definitions
+
+
+def extract_recording_rules(args):
+    """Script writing recording rules for aggregations repeated in dashboards
+    and alert groups."""
+    parser = argparse.ArgumentParser(prog='extract-recording-rules')
+    parser.add_argument(
+        'paths', metavar='PATH', type=os.path.abspath, nargs='+',
+        help='Dashboard or alertgroup definition, or directory to search for them',
+    )
+    parser.add_argument('--output', '-o', type=os.path.abspath, help='Where to write the rules YAML')
+    parser.add_argument(
+        '--min-count', type=int, default=recording.DEFAULT_MIN_COUNT,
+        help='Record aggregations used by at least this many targets (default: %(default)s)',
+    )
+    parser.add_argument('--max-rules', type=int, help='Record at most this many of the most used aggregations')
+    parser.add_argument('--group-name', default=recording.DEFAULT_GROUP_NAME, help='Name of the rule group')
+    parser.add_argument(
+        '--interval', default=recording.DEFAULT_INTERVAL,
+        help='Evaluation interval of the rule group (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--rewrite', action='store_true',
+        help='Also write the JSON of the dashboards, reading the recorded series',
+    )
+    add_validation_argument(parser)
+    opts = parser.parse_args(args)
+    try:
+        definitions = load_definitions(parser, opts)
+    except (AlertGroupError, DashboardError, ValidationError) as e:
+        sys.stderr.write('ERROR: {}\n'.format(e))
+        return 1
+    rules = recording.find_rules([d for _, d in definitions], opts.min_count, opts.max_rules)
+    text = recording.rules_yaml(rules, opts.group_name, opts.interval)
+    if opts.output:
+        with open(opts.output, 'w') as output:
+            output.write(text)
+    else:
+        sys.stdout.write(text)
+    if opts.rewrite:
+        for path, definition in definitions:
+            if path.endswith(DASHBOARD_SUFFIX):
+                with open(get_dashboard_json_path(path), 'w') as json_file:
+                    write_dashboard(recording.rewrite_dashboard(definition, rules), json_file)
+    return 0
+
+
+def extract_recording_rules_script():
+    """Entry point for extract-recording-rules."""
+    run_script(extract_recording_rules)
+
+
+def export_used_metrics(args):
+    """Script writing the metrics read by dashboards and alert groups, as an
+    ingestion allowlist."""
+    parser = argparse.ArgumentParser(prog='export-used-metrics')
+    parser.add_argument(
+        'paths', metavar='PATH', type=os.path.abspath, nargs='+',
+        help='Dashboard or alertgroup definition, or directory to search for them',
+    )
+    parser.add_argument('--output', '-o', type=os.path.abspath, help='Where to write the allowlist')
+    parser.add_argument(
+        '--format', choices=('text', 'relabel', 'json'), default='text',
+        help='One metric per line, a metric_relabel_configs keep rule, or the '
+             'matchers of each metric as JSON (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--strict', action='store_true',
+        help='Fail if a selector may read any metric, rather than only warning',
+    )
+    add_validation_argument(parser)
+    opts = parser.parse_args(args)
+    try:
+        definitions = load_definitions(parser, opts)
+    except (AlertGroupError, DashboardError, ValidationError) as e:
+        sys.stderr.write('ERROR: {}\n'.format(e))
+        return 1
+    metrics, unknown = allowlist.used_metrics([d for _, d in definitions])
+    if opts.format == 'relabel':
+        text = allowlist.keep_rule(metrics)
+    elif opts.format == 'json':
+        text = allowlist.used_metrics_json(metrics)
+    else:
+        text = ''.join(name + '\n' for name in sorted(metrics))
+    if opts.output:
+        with open(opts.output, 'w') as output:
+            output.write(text)
+    else:
+        sys.stdout.write(text)
+    level = 'ERROR' if opts.strict else 'WARNING'
+    for selector in unknown:
+        sys.stderr.write('{}: {} may read any metric\n'.format(level, selector))
+    return 1 if opts.strict and unknown else 0
+
+
+def export_used_metrics_script():
+    """Entry point for export-used-metrics."""
+    run_script(export_used_metrics)
@@ -0,0 +1,89 @@
+"""Metrics used by dashboards and alert rules, as an ingestion allowlist.
+
+Prometheus ingests every series its targets expose, whether or not anything
+reads them. ``used_metrics`` parses the PromQL of the targets of dashboards
+and alert groups and collects the metrics they select, with the label
+matchers they select them with. ``keep_rule`` writes them as a relabel rule
+keeping only those metrics, for ``metric_relabel_configs``, and
+``used_metrics_json`` as data for cleaning up cardinality.
+
+Selectors that only select by labels, such as ``{job="api"}``, or whose
+metric name is a Grafana variable, may read any metric: they cannot be
+allowlisted and are returned apart, so they can be fixed or kept by hand.
+So are the targets whose PromQL cannot be parsed.
+"""
+
+import json
+import re
+
+from grafanalib.prometheus import Selector, iter_nodes, render
+from grafanalib.recording import iter_targets, target_expr, unparsed_expr
+
+# Grafana variables, whose values are only known in the browser.
+_VARIABLE = re.compile(r'\$|\[\[')
+
+
+def selector_metric(selector):
+    """Return the metric name, or regex of metric names, a selector reads.
+
+    :returns: a name or regex, ``None`` if the selector reads metrics by
+        labels only or through a Grafana variable
+    """
+    names = [selector.metric] if selector.metric else []
+    for matcher in selector.matchers:
+        if matcher.label == '__name__' and matcher.op in ('=', '=~'):
+            names.append(matcher.value if matcher.op == '=~' else re.escape(matcher.value))
+    names = [name for name in names if not _VARIABLE.search(name)]
+    return names[0] if names else None
+
+
+def used_metrics(objs):
+    """Collect the metrics read by the targets of dashboards and alert groups.
+
+    :param objs: ``Dashboard`` and ``AlertGroup`` objects
+    :returns: ``(metrics, unknown)``, a dict of the set of label matchers,
+        as PromQL text, each metric or regex of metric names is selected with,
+        and a sorted list of the selectors that may read any metric, and of
+        the expressions that cannot be parsed
+    """
+    metrics = {}
+    unknown = set()
+    for obj in objs:
+        for target in iter_targets(obj):
+            expr = target_expr(target)
+            if expr is None:
+                text = unparsed_expr(target)
+                if text is not None:
+                    unknown.add(text)
+                continue
+            for node in iter_nodes(expr):
+                if not isinstance(node, Selector):
+                    continue
+                name = selector_metric(node)
+                if name is None:
+                    unknown.add(render(node))
+                    continue
+                matchers = metrics.setdefault(name, set())
+                matchers.update(render(m) for m in node.matchers if m.label != '__name__')
+    return metrics, sorted(unknown)
+
+
+def keep_regex(metrics):
+    """Return a regex matching the names of ``metrics``, for a relabel rule."""
+    return '|'.join(sorted(metrics))
+
+
+def keep_rule(metrics):
+    """Return a relabel rule keeping only ``metrics``, as YAML for the
+    ``metric_relabel_configs`` of a scrape config."""
+    lines = [
+        '- source_labels: [__name__]',
+        '  regex: {}'.format(json.dumps(keep_regex(metrics))),
+        '  action: keep',
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def used_metrics_json(metrics):
+    """Return ``metrics`` as JSON, each metric with its sorted matchers."""
+    return json.dumps({name: sorted(matchers) for name, matchers in metrics.items()}, sort_keys=True, indent=2) + '\n'
@@ -0,0 +1,482 @@
+"""Static estimates of the series and samples Prometheus targets read.
+
+``load_snapshot`` reads a cardinality snapshot, the JSON returned by the
+``/api/v1/status/tsdb`` endpoint of Prometheus, so that dashboards can be
+reviewed without access to the server. ``expr_cost`` estimates how many series
+a PromQL expression selects and how many samples Prometheus reads to evaluate
+it over a time range at a step, and ``lint_expr`` flags what makes queries
+expensive: selectors without label matchers, ``=~".*"`` matchers, very long
+ranges and aggregations by high cardinality labels.
+Targets whose PromQL cannot be parsed are reported, as their cost is unknown.
+
+``dashboard_query_cost`` adds up the estimates of the targets of each panel
+and of the whole dashboard, and ``check_query_cost`` compares them with a
+``QueryBudget``, so that review can block expensive dashboards.
+
+The estimates assume that label values are spread evenly and independently
+across series. They are meant to compare queries and catch the expensive
+ones, not to predict exact numbers.
+"""
+
+import json
+import math
+import re
+
+import attr
+from attr.validators import instance_of, optional
+
+from grafanalib.checks import Problem
+from grafanalib.cost import dashboard_time_range, iter_shown_panels, panel_queries, repeat_fan_out
+from grafanalib.optimize import DEFAULT_MAX_DATA_POINTS, panel_time_range, parse_duration
+from grafanalib.prometheus import (
+    Aggregation, Binary, Call, Number, Selector, Subquery, Unary, duration_ms,
+    iter_nodes, render,
+)
+from grafanalib.recording import target_expr, unparsed_expr
+
+HIGH_CARDINALITY_GROUPING = 'high-cardinality-grouping'
+LONG_RANGE = 'long-range'
+MATCH_ALL_REGEX = 'match-all-regex'
+MISSING_MATCHERS = 'missing-matchers'
+SAMPLES_PER_LOAD = 'samples-per-load'
+SERIES_PER_LOAD = 'series-per-load'
+UNPARSEABLE_QUERY = 'unparseable-query'
+
+DEFAULT_SCRAPE_INTERVAL = 15
+
+# Step of subqueries that do not set one, the default evaluation interval
+# of Prometheus.
+DEFAULT_SUBQUERY_STEP = 60
+
+# Longest range vectors and subqueries ``lint_expr`` lets through.
+DEFAULT_MAX_RANGE = 24 * 60 * 60
+
+# Most groups an aggregation may make before ``lint_expr`` flags it.
+DEFAULT_MAX_GROUPS = 1000
+
+# Most points Prometheus returns per series; Grafana widens the step to fit.
+MAX_POINTS_PER_SERIES = 11000
+
+# Label values that read as a single value: literals and Grafana variables.
+_SINGLE_VALUE = re.compile(r'^(?:[\w:-]+|\$\w+|\$\{[^}]+\}|\[\[\w+\]\])$')
+_VARIABLE = re.compile(r'^\$\{?(\w+)(?::\w+)?\}?$')
+
+
+@attr.s
+class CardinalitySnapshot(object):
+    """Series counts of a Prometheus server.
+
+    :param total_series: number of series in the head block
+    :param series_by_metric: dict of the number of series of metric names
+    :param values_by_label: dict of the number of values of label names
+    :param series_by_label_value: dict of the number of series of
+        ``label=value`` pairs
+    :param scrape_interval: seconds between two samples of a series
+    """
+
+    total_series = attr.ib(default=0, validator=instance_of(int))
+    series_by_metric = attr.ib(default=attr.Factory(dict))
+    values_by_label = attr.ib(default=attr.Factory(dict))
+    series_by_label_value = attr.ib(default=attr.Factory(dict))
+    scrape_interval = attr.ib(default=DEFAULT_SCRAPE_INTERVAL, validator=instance_of((int, float)))
+
+    def metric_series(self, metric):
+        """Return the number of series of a metric, of all metrics if
+        ``metric`` is ``None``.
+
+        The status endpoint only lists the metrics with the most series, so
+        others count as many series as the smallest listed one.
+        """
+        if metric is None:
+            return self.total_series
+        if metric in self.series_by_metric:
+            return self.series_by_metric[metric]
+        if self.series_by_metric:
+            return min(self.series_by_metric.values())
+        return self.total_series
+
+
+def _counts(entries):
+    return {entry['name']: int(entry['value']) for entry in entries or []}
+
+
+def snapshot_from_status(status, scrape_interval=DEFAULT_SCRAPE_INTERVAL):
+    """Make a ``CardinalitySnapshot`` from the JSON data of the TSDB status
+    endpoint, with or without its ``status``/``data`` envelope."""
+    data = status.get('data', status)
+    series_by_metric = _counts(data.get('seriesCountByMetricName'))
+    total = (data.get('headStats') or {}).get('numSeries')
+    return CardinalitySnapshot(
+        total_series=int(total) if total is not None else sum(series_by_metric.values()),
+        series_by_metric=series_by_metric,
+        values_by_label=_counts(data.get('labelValueCountByLabelName')),
+        series_by_label_value=_counts(data.get('seriesCountByLabelValuePair')),
+        scrape_interval=scrape_interval,
+    )
+
+
+def load_snapshot(path, scrape_interval=DEFAULT_SCRAPE_INTERVAL):
+    """Read a ``CardinalitySnapshot`` from a file saved from
+    ``/api/v1/status/tsdb``."""
+    with open(path) as f:
+        return snapshot_from_status(json.load(f), scrape_interval)
+
+
+def _matched_values(matcher):
+    """Return the values an equality or alternation matcher selects, ``None``
+    if it may select any number of them."""
+    if matcher.op == '=':
+        return [matcher.value]
+    if matcher.op != '=~':
+        return None
+    values = matcher.value.split('|')
+    if all(_SINGLE_VALUE.match(value) for value in values):
+        return values
+    return None
+
+
+def matcher_selectivity(matcher, snapshot):
+    """Return the fraction of series a label matcher keeps.
+
+    A Grafana variable counts as one value of its label. Negative matchers
+    and regexes other than alternations of values keep every series.
+    """
+    values = _matched_values(matcher)
+    if values is None:
+        return 1.0
+    label_values = snapshot.values_by_label.get(matcher.label)
+    fraction = 0.0
+    for value in values:
+        pair = '{}={}'.format(matcher.label, value)
+        if pair in snapshot.series_by_label_value and snapshot.total_series:
+            fraction += snapshot.series_by_label_value[pair] / float(snapshot.total_series)
+        elif label_values:
+            fraction += 1.0 / label_values
+        else:
+            return 1.0
+    return min(fraction, 1.0)
+
+
+def selector_series(selector, snapshot):
+    """Estimate the number of series a selector selects."""
+    metric = selector.metric
+    matchers = []
+    for matcher in selector.matchers:
+        if matcher.label == '__name__' and matcher.op == '=' and metric is None:
+            metric = matcher.value
+        else:
+            matchers.append(matcher)
+    series = float(snapshot.metric_series(metric))
+    for matcher in matchers:
+        series *= matcher_selectivity(matcher, snapshot)
+    return int(math.ceil(series))
+
+
+@attr.s
+class QueryContext(object):
+    """How a query is evaluated.
+
+    :param time_range: seconds of the range queried
+    :param step: seconds between two evaluations
+    :param steps: number of evaluations, 1 for instant queries
+    """
+
+    time_range = attr.ib()
+    step = attr.ib()
+    steps = attr.ib(default=1, validator=instance_of(int))
+
+
+def duration_seconds(text, context, snapshot):
+    """Return the seconds of a PromQL duration or of one of the Grafana
+    interval variables, ``None`` if unknown."""
+    if text is None:
+        return None
+    ms = duration_ms(text)
+    if ms is not None:
+        return ms / 1000.0
+    match = _VARIABLE.match(text)
+    name = match.group(1) if match else None
+    if name in ('__interval', '__interval_ms'):
+        return context.step
+    if name == '__rate_interval':
+        return max(context.step + snapshot.scrape_interval, 4 * snapshot.scrape_interval)
+    if name == '__range':
+        return context.time_range
+    return None
+
+
+def _estimate(node, context, snapshot):
+    """Return the ``(series, samples)`` of evaluating ``node``."""
+    if isinstance(node, Selector):
+        series = selector_series(node, snapshot)
+        window = duration_seconds(node.range, context, snapshot) if node.range else None
+        per_series = max(1, window // snapshot.scrape_interval) if window else 1
+        return series, series * per_series * context.steps
+    if isinstance(node, Subquery):
+        window = duration_seconds(node.range, context, snapshot) or context.step
+        step = duration_seconds(node.step, context, snapshot) or DEFAULT_SUBQUERY_STEP
+        inner = attr.evolve(context, steps=context.steps * max(1, int(window // step)))
+        return _estimate(node.expr, inner, snapshot)
+    if isinstance(node, Aggregation):
+        series, samples = _estimate(node.expr, context, snapshot)
+        if node.by is not None:
+            groups = 1
+            for label in node.by:
+                groups *= snapshot.values_by_label.get(label, series)
+        elif node.without is not None:
+            groups = series
+        else:
+            groups = 1
+        # Aggregations selecting series keep some of each group.
+        per_group = 1
+        if node.op in ('topk', 'bottomk', 'limitk', 'count_values'):
+            per_group = int(node.param.value) if isinstance(node.param, Number) else series
+        return min(series, groups * per_group), samples
+    if isinstance(node, Binary):
+        lhs, lhs_samples = _estimate(node.lhs, context, snapshot)
+        rhs, rhs_samples = _estimate(node.rhs, context, snapshot)
+        if node.op == 'or':
+            series = lhs + rhs
+        elif node.op == 'unless' or node.group_left is not None or not rhs:
+            series = lhs
+        elif node.group_right is not None or not lhs:
+            series = rhs
+        else:
+            series = min(lhs, rhs)
+        return series, lhs_samples + rhs_samples
+    if isinstance(node, (Call, Unary)):
+        args = node.args if isinstance(node, Call) else (node.expr,)
+        estimates = [_estimate(arg, context, snapshot) for arg in args]
+        return max([s for s, _ in estimates] or [0]), sum(samples for _, samples in estimates)
+    return 0, 0
+
+
+@attr.s
+class QueryCost(object):
+    """Estimated cost of one query.
+
+    :param expr: PromQL text of the query
+    :param series: series the query selects
+    :param samples: samples Prometheus reads to evaluate it
+    :param steps: number of evaluations, 1 for instant queries
+    """
+
+    expr = attr.ib(validator=instance_of(str))
+    series = attr.ib(validator=instance_of(int))
+    samples = attr.ib(validator=instance_of(int))
+    steps = attr.ib(default=1, validator=instance_of(int))
+
+    def to_json_data(self):
+        return {
+            'expr': self.expr,
+            'series': self.series,
+            'samples': self.samples,
+            'steps': self.steps,
+        }
+
+
+def expr_cost(expr, snapshot, context):
+    """Estimate the cost of a PromQL expression.
+
+    :param expr: an ``Expr``, see ``prometheus.parse``
+    :param snapshot: a ``CardinalitySnapshot``
+    :param context: a ``QueryContext``
+    :returns: a ``QueryCost``
+    """
+    selected = sum(selector_series(node, snapshot) for node in iter_nodes(expr) if isinstance(node, Selector))
+    _, samples = _estimate(expr, context, snapshot)
+    return QueryCost(expr=render(expr), series=selected, samples=int(samples), steps=context.steps)
+
+
+def query_context(panel, target, time_range, snapshot):
+    """Return the ``QueryContext`` of a target of a panel, computing the
+    step like Grafana does from the time range, ``maxDataPoints`` and the
+    minimum intervals."""
+    time_range = panel_time_range(panel, time_range)
+    max_points = getattr(panel, 'maxDataPoints', None) or DEFAULT_MAX_DATA_POINTS
+    intervals = [getattr(target, 'interval', None), getattr(panel, 'interval', None)]
+    min_interval = next(
+        (parse_duration(i) for i in intervals if parse_duration(i)), snapshot.scrape_interval)
+    step = max(time_range / float(max_points), min_interval) * (getattr(target, 'intervalFactor', None) or 1)
+    step = max(step, time_range / float(MAX_POINTS_PER_SERIES))
+    if getattr(target, 'instant', False):
+        return QueryContext(time_range=time_range, step=step)
+    return QueryContext(time_range=time_range, step=step, steps=int(time_range // step) + 1)
+
+
+def lint_expr(expr, snapshot=None, max_range=DEFAULT_MAX_RANGE, max_groups=DEFAULT_MAX_GROUPS):
+    """Return the ``Problem`` list of the expensive parts of an expression.
+
+    :param expr: an ``Expr``
+    :param snapshot: a ``CardinalitySnapshot``, to check the groups of
+        aggregations; ``None`` to skip that check
+    :param max_range: most seconds range vectors and subqueries may cover
+    :param max_groups: most groups aggregations may make
+    """
+    problems = []
+    for node in iter_nodes(expr):
+        if isinstance(node, Selector):
+            if not [m for m in node.matchers if m.label != '__name__']:
+                problems.append(Problem(MISSING_MATCHERS, '{} has no label matchers'.format(render(node))))
+            for matcher in node.matchers:
+                if matcher.op == '=~' and matcher.value == '.*':
+                    problems.append(Problem(MATCH_ALL_REGEX, '{} matches {} with ".*", which matches anything'.format(
+                        render(node), matcher.label)))
+        if isinstance(node, (Selector, Subquery)) and node.range:
+            ms = duration_ms(node.range)
+            if ms is not None and ms / 1000.0 > max_range:
+                problems.append(Problem(LONG_RANGE, '{} reads {} of samples per evaluation'.format(
+                    render(node), node.range)))
+        if isinstance(node, Aggregation) and node.by and snapshot is not None:
+            counts = [snapshot.values_by_label.get(label) for label in node.by]
+            groups = 1
+            for count in counts:
+                groups *= count or 1
+            if groups > max_groups:
+                problems.append(Problem(HIGH_CARDINALITY_GROUPING, '{} makes up to {} groups by {}'.format(
+                    render(node), groups, ', '.join(node.by))))
+    return problems
+
+
+@attr.s
+class PanelQueryCost(object):
+    """Estimated cost of the Prometheus queries of one panel.
+
+    :param title: title of the panel
+    :param queries: list of ``QueryCost``, for one copy of the panel
+    :param copies: number of copies of a repeated panel, 1 otherwise
+    :param collapsed: whether the panel is in a collapsed row
+    """
+
+    title = attr.ib()
+    queries = attr.ib(default=attr.Factory(list))
+    copies = attr.ib(default=1, validator=instance_of(int))
+    collapsed = attr.ib(default=False, validator=instance_of(bool))
+
+    @property
+    def series(self):
+        return sum(q.series for q in self.queries) * self.copies
+
+    @property
+    def samples(self):
+        return sum(q.samples for q in self.queries) * self.copies
+
+    def to_json_data(self):
+        return {
+            'title': self.title,
+            'series': self.series,
+            'samples': self.samples,
+            'copies': self.copies,
+            'collapsed': self.collapsed,
+            'queries': self.queries,
+        }
+
+
+@attr.s
+class QueryCostReport(object):
+    """Estimated cost of the Prometheus queries of a dashboard.
+
+    :param title: title of the dashboard
+    :param panels: list of ``PanelQueryCost``
+    :param problems: ``Problem`` list of ``lint_expr``, and of the targets
+        that cannot be parsed
+    """
+
+    title = attr.ib()
+    panels = attr.ib(default=attr.Factory(list))
+    problems = attr.ib(default=attr.Factory(list))
+
+    @property
+    def series_per_load(self):
+        """Series selected by the panels shown when the dashboard is opened."""
+        return sum(p.series for p in self.panels if not p.collapsed)
+
+    @property
+    def samples_per_load(self):
+        """Samples read for the panels shown when the dashboard is opened."""
+        return sum(p.samples for p in self.panels if not p.collapsed)
+
+    def to_json_data(self):
+        return {
+            'title': self.title,
+            'seriesPerLoad': self.series_per_load,
+            'samplesPerLoad': self.samples_per_load,
+            'panels': self.panels,
+            'problems': [str(p) for p in self.problems],
+        }
+
+
+@attr.s
+class QueryBudget(object):
+    """Limits for ``check_query_cost``; limits left to ``None`` are not
+    checked.
+
+    :param max_series_per_load: most series selected when the dashboard is
+        opened
+    :param max_samples_per_load: most samples read when it is opened
+    """
+
+    max_series_per_load = attr.ib(default=None, validator=optional(instance_of(int)))
+    max_samples_per_load = attr.ib(default=None, validator=optional(instance_of(int)))
+
+
+def dashboard_query_cost(dashboard, snapshot, fan_out=None, max_range=DEFAULT_MAX_RANGE,
+                         max_groups=DEFAULT_MAX_GROUPS):
+    """Estimate the cost of the Prometheus queries of a dashboard.
+
+    Targets without a PromQL expression are left out, targets whose
+    expression cannot be parsed are reported as ``UNPARSEABLE_QUERY``
+    problems.
+
+    :param dashboard: a ``Dashboard``
+    :param snapshot: a ``CardinalitySnapshot``
+    :param fan_out: see ``cost.dashboard_cost``
+    :param max_range: see ``lint_expr``
+    :param max_groups: see ``lint_expr``
+    :returns: a ``QueryCostReport``
+    """
+    time_range = dashboard_time_range(dashboard)
+    templates = {t.name: t for t in dashboard.templating.list if not isinstance(t, dict)}
+    panels = []
+    problems = []
+    for panel, collapsed in iter_shown_panels(dashboard):
+        queries = []
+        for target in panel_queries(panel):
+            expr = target_expr(target)
+            if expr is None:
+                text = unparsed_expr(target)
+                if text is not None:
+                    problems.append(Problem(UNPARSEABLE_QUERY, 'panel "{}": cannot estimate the cost of {}'.format(
+                        getattr(panel, 'title', ''), text)))
+                continue
+            queries.append(expr_cost(expr, snapshot, query_context(panel, target, time_range, snapshot)))
+            for problem in lint_expr(expr, snapshot, max_range, max_groups):
+                problems.append(Problem(problem.check, 'panel "{}": {}'.format(
+                    getattr(panel, 'title', ''), problem.message)))
+        if queries:
+            panels.append(PanelQueryCost(
+                title=getattr(panel, 'title', ''), queries=queries,
+                copies=repeat_fan_out(panel, templates, fan_out), collapsed=collapsed,
+            ))
+    return QueryCostReport(title=dashboard.title, panels=panels, problems=problems)
+
+
+def check_query_cost(report, budget):
+    """Return the ``Problem`` list of a ``QueryCostReport`` over a
+    ``QueryBudget``.
+
+    Targets that cannot be parsed are problems too when the budget has a
+    limit, as they may be over it.
+    """
+    problems = []
+    if budget.max_series_per_load is not None or budget.max_samples_per_load is not None:
+        problems.extend(p for p in report.problems if p.check == UNPARSEABLE_QUERY)
+    if budget.max_series_per_load is not None and report.series_per_load > budget.max_series_per_load:
+        problems.append(Problem(SERIES_PER_LOAD, 'dashboard "{}" selects about {} series per load, '
+                                'more than {}'.format(report.title, report.series_per_load,
+                                                      budget.max_series_per_load)))
+    if budget.max_samples_per_load is not None and report.samples_per_load > budget.max_samples_per_load:
+        problems.append(Problem(SAMPLES_PER_LOAD, 'dashboard "{}" reads about {} samples per load, '
+                                'more than {}'.format(report.title, report.samples_per_load,
+                                                      budget.max_samples_per_load)))
+    return problems
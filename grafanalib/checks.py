@@ -0,0 +1,204 @@
+"""Cross-object consistency checks for dashboards and alert groups.
+
+Per-field validators only see one value at a time. The checks here look at a
+whole ``Dashboard`` or ``AlertGroup`` and find the mistakes that Grafana would
+otherwise only report after upload: duplicate panel ids, duplicate ``refId``
+values inside a panel, overlapping ``GridPos`` rectangles, repeats over
+variables that do not exist, variables that depend on each other in a loop
+and alert conditions that point nowhere.
+
+Each dashboard is walked once; the lookups are done against hash indexes that
+are built during that walk, so the cost is linear in the number of panels and
+targets.
+"""
+
+import attr
+from attr.validators import instance_of
+
+from grafanalib.core import (
+    AlertExpression, AlertFileBasedProvisioning, AlertGroup, Dashboard, RowPanel,
+    Target,
+)
+from grafanalib.variables import dependency_graph, find_cycle
+
+CYCLIC_VARIABLES = 'cyclic-variables'
+DUPLICATE_PANEL_ID = 'duplicate-panel-id'
+DUPLICATE_REF_ID = 'duplicate-ref-id'
+MISSING_CONDITION = 'missing-condition'
+OVERLAPPING_PANELS = 'overlapping-panels'
+UNKNOWN_REPEAT_VARIABLE = 'unknown-repeat-variable'
+
+
+@attr.s
+class Problem(object):
+    """A consistency problem found by one of the checks.
+
+    :param check: which check found the problem, one of the ``CYCLIC_*``,
+        ``DUPLICATE_*``, ``MISSING_*``, ``OVERLAPPING_*`` or ``UNKNOWN_*``
+        constants
+    :param message: human readable description of the problem
+    """
+
+    check = attr.ib(validator=instance_of(str))
+    message = attr.ib(validator=instance_of(str))
+
+    def __str__(self):
+        return '{}: {}'.format(self.check, self.message)
+
+
+def _describe(panel):
+    return 'panel {} "{}"'.format(
+        getattr(panel, 'id', None), getattr(panel, 'title', ''))
+
+
+def _template_names(templating):
+    names = set()
+    for template in templating.list:
+        name = template.get('name') if isinstance(template, dict) else getattr(template, 'name', None)
+        if name:
+            names.add(name)
+    return names
+
+
+def _iter_layers(dashboard):
+    """Yield ``(layer, panel)`` for every panel of a dashboard.
+
+    Panels that share a layer are laid out on the same grid. Top level panels
+    use layer ``None``; the children of each ``RowPanel`` get a layer of their
+    own, as Grafana keeps the positions of collapsed children apart from the
+    rest of the dashboard.
+    """
+    for row in dashboard.rows:
+        for panel in row._iter_panels():
+            yield row, panel
+    for panel in dashboard.panels:
+        yield None, panel
+        if isinstance(panel, RowPanel):
+            for child in panel.panels:
+                yield panel, child
+
+
+def _check_targets(panel, problems):
+    seen = set()
+    reported = set()
+    for target in getattr(panel, 'targets', None) or []:
+        ref_id = getattr(target, 'refId', None)
+        if not ref_id:
+            continue
+        if ref_id in seen and ref_id not in reported:
+            reported.add(ref_id)
+            problems.append(Problem(DUPLICATE_REF_ID, '{} uses refId {!r} more than once'.format(
+                _describe(panel), ref_id)))
+        seen.add(ref_id)
+
+
+def _check_overlap(layer, panel, occupied, problems, reported):
+    pos = getattr(panel, 'gridPos', None)
+    if pos is None:
+        return
+    try:
+        cells = [
+            (x, y)
+            for y in range(pos.y, pos.y + pos.h)
+            for x in range(pos.x, pos.x + pos.w)
+        ]
+    except TypeError:
+        return
+    for cell in cells:
+        other = occupied.setdefault((id(layer), cell), panel)
+        if other is not panel and (id(other), id(panel)) not in reported:
+            reported.add((id(other), id(panel)))
+            problems.append(Problem(OVERLAPPING_PANELS, '{} overlaps {} at x={}, y={}'.format(
+                _describe(panel), _describe(other), cell[0], cell[1])))
+
+
+def check_dashboard(dashboard):
+    """Return the consistency problems of a dashboard.
+
+    :param dashboard: a ``Dashboard``
+    :returns: list of ``Problem``, empty if the dashboard is consistent
+    """
+    problems = []
+    variables = _template_names(dashboard.templating)
+    cycle = find_cycle(dependency_graph(dashboard.templating.list))
+    if cycle:
+        problems.append(Problem(CYCLIC_VARIABLES, 'variables depend on each other: {}'.format(' -> '.join(cycle))))
+    panel_ids = {}
+    occupied = {}
+    reported_overlaps = set()
+
+    for row in dashboard.rows:
+        if row.repeat and row.repeat.lstrip('$') not in variables:
+            problems.append(Problem(UNKNOWN_REPEAT_VARIABLE, 'row "{}" repeats over unknown variable {!r}'.format(
+                row.title, row.repeat)))
+
+    for layer, panel in _iter_layers(dashboard):
+        panel_id = getattr(panel, 'id', None)
+        if panel_id is not None:
+            other = panel_ids.setdefault(panel_id, panel)
+            if other is not panel:
+                problems.append(Problem(DUPLICATE_PANEL_ID, '{} has the same id as {}'.format(
+                    _describe(panel), _describe(other))))
+
+        repeat = getattr(panel, 'repeat', None)
+        variable = getattr(repeat, 'variable', None)
+        if variable and variable.lstrip('$') not in variables:
+            problems.append(Problem(UNKNOWN_REPEAT_VARIABLE, '{} repeats over unknown variable {!r}'.format(
+                _describe(panel), variable)))
+
+        _check_targets(panel, problems)
+        _check_overlap(layer, panel, occupied, problems, reported_overlaps)
+
+    return problems
+
+
+def check_alert_rule(rule):
+    """Return the consistency problems of a Grafana 9.x+ alert rule.
+
+    :param rule: an ``AlertRulev9``
+    :returns: list of ``Problem``
+    """
+    problems = []
+    ref_ids = set()
+    for trigger in rule.triggers:
+        if isinstance(trigger, (Target, AlertExpression)):
+            if trigger.refId in ref_ids:
+                problems.append(Problem(DUPLICATE_REF_ID, 'alert rule "{}" uses refId {!r} more than once'.format(
+                    rule.title, trigger.refId)))
+            ref_ids.add(trigger.refId)
+    if rule.condition not in ref_ids:
+        problems.append(Problem(MISSING_CONDITION, 'alert rule "{}" condition {!r} is not one of {}'.format(
+            rule.title, rule.condition, sorted(ref_ids))))
+    return problems
+
+
+def check_alertgroup(alertgroup):
+    """Return the consistency problems of an alert group.
+
+    Only Grafana 9.x+ rules (``AlertRulev9``) name their condition, Grafana
+    8.x rules always evaluate the generated ``CONDITION`` expression.
+
+    :param alertgroup: an ``AlertGroup``
+    :returns: list of ``Problem``
+    """
+    problems = []
+    for rule in alertgroup.rules:
+        if hasattr(rule, 'condition'):
+            problems.extend(check_alert_rule(rule))
+    return problems
+
+
+def check(obj):
+    """Return the consistency problems of any generated grafanalib type.
+
+    :param obj: a ``Dashboard``, ``AlertGroup`` or
+        ``AlertFileBasedProvisioning``; other types have no checks
+    :returns: list of ``Problem``
+    """
+    if isinstance(obj, Dashboard):
+        return check_dashboard(obj)
+    if isinstance(obj, AlertGroup):
+        return check_alertgroup(obj)
+    if isinstance(obj, AlertFileBasedProvisioning):
+        return [p for group in obj.groups for p in check_alertgroup(group)]
+    return []
@@ -0,0 +1,398 @@
+"""Convert angular panels to their modern replacements at build time.
+
+``Graph``, ``SingleStat`` and the ``ColumnStyle`` based tables are angular
+panels. Current Grafana versions replace them with ``timeseries``, ``stat``
+and field overrides in the browser, every time a dashboard using them is
+loaded. The converters here do the same once, when the dashboard is built,
+following the rules of Grafana's own panel migrations::
+
+    dashboard = convert.convert_dashboard(dashboard)
+
+Panels that have no modern equivalent, such as graphs with a ``series`` or
+``histogram`` X axis, are left alone.
+"""
+
+import copy
+
+import attr
+
+from grafanalib.core import (
+    NULL_CONNECTED, SORT_ASC, SORT_DESC, ColumnStyle,
+    DateColumnStyleType, GaugePanel, Graph, HiddenColumnStyleType, Panel,
+    SingleStat, Stat, Table, Threshold, TimeSeries, VTYPE_AVG, VTYPE_CURR,
+    VTYPE_DELTA, VTYPE_FIRST, VTYPE_MAX, VTYPE_MIN, VTYPE_NAME, VTYPE_RANGE,
+    VTYPE_TOTAL, _deep_update,
+)
+from grafanalib.schema import upgrade_value_mappings
+
+# SingleStat.valueName to the reducer of Stat panels.
+REDUCERS = {
+    VTYPE_AVG: 'mean',
+    VTYPE_CURR: 'lastNotNull',
+    VTYPE_DELTA: 'delta',
+    VTYPE_FIRST: 'firstNotNull',
+    VTYPE_MAX: 'max',
+    VTYPE_MIN: 'min',
+    VTYPE_NAME: 'lastNotNull',
+    VTYPE_RANGE: 'range',
+    VTYPE_TOTAL: 'sum',
+}
+
+# Legend values of Graph panels to the legend calculations of TimeSeries.
+LEGEND_CALCS = [
+    ('min', 'min'),
+    ('max', 'max'),
+    ('avg', 'mean'),
+    ('current', 'lastNotNull'),
+    ('total', 'sum'),
+]
+
+THRESHOLD_COLORS = {
+    'ok': 'green',
+    'warning': 'orange',
+    'critical': 'red',
+}
+
+# Fields of every panel that carry over unchanged.
+_COMMON_FIELDS = [
+    f.name for f in attr.fields(Panel)
+    if f.name not in ('thresholds', 'thresholdType', 'extraJson')
+]
+
+
+def _get(obj, name, default=None):
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+
+def _set_fields(obj):
+    """Return the fields of a dict or attrs object that differ from defaults."""
+    if isinstance(obj, dict):
+        return obj
+    return {
+        f.name: getattr(obj, f.name) for f in attr.fields(type(obj))
+        if getattr(obj, f.name) != f.default
+    }
+
+
+def _number(value):
+    """Return ``value`` as an int or float, or ``None`` if it is not a number."""
+    if value is None or value == '':
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return int(number) if number.is_integer() else number
+
+
+def _common(panel, extra):
+    """Return the common panel arguments, with ``extra`` merged into ``extraJson``."""
+    kwargs = {name: getattr(panel, name) for name in _COMMON_FIELDS}
+    if panel.extraJson:
+        _deep_update(extra, copy.deepcopy(panel.extraJson))
+    kwargs['extraJson'] = extra or None
+    return kwargs
+
+
+def _matcher(pattern):
+    if len(pattern) > 1 and pattern.startswith('/') and pattern.endswith('/'):
+        return {'id': 'byRegexp', 'options': pattern}
+    return {'id': 'byName', 'options': pattern}
+
+
+def _fixed_color(color):
+    return {'mode': 'fixed', 'fixedColor': color}
+
+
+def _graph_threshold_steps(thresholds):
+    """Convert ``GraphThreshold`` values to threshold steps and a style mode."""
+    steps = [['transparent', None]]
+    fill = line = False
+    for threshold in sorted(thresholds, key=lambda t: _get(t, 'value')):
+        color_mode = _get(threshold, 'colorMode')
+        if color_mode == 'custom':
+            color = _get(threshold, 'fillColor') or _get(threshold, 'lineColor')
+        else:
+            color = THRESHOLD_COLORS.get(color_mode, 'red')
+        fill = fill or _get(threshold, 'fill', True)
+        line = line or _get(threshold, 'line', True)
+        value = float(_get(threshold, 'value'))
+        if _get(threshold, 'op') == 'lt':
+            steps[-1][0] = color
+            steps.append(['transparent', value])
+        else:
+            steps.append([color, value])
+    result = [Threshold(color, i, value or 0.0) for i, (color, value) in enumerate(steps)]
+    mode = 'line+area' if fill and line else 'area' if fill else 'line'
+    return result, mode
+
+
+def _axis_properties(axis):
+    properties = []
+    if axis.format:
+        properties.append({'id': 'unit', 'value': axis.format})
+    if axis.label:
+        properties.append({'id': 'custom.axisLabel', 'value': axis.label})
+    for name in ('min', 'max', 'decimals'):
+        value = _number(getattr(axis, name))
+        if value is not None:
+            properties.append({'id': name, 'value': value})
+    if axis.logBase and axis.logBase > 1:
+        properties.append({'id': 'custom.scaleDistribution', 'value': {'type': 'log', 'log': axis.logBase}})
+    return properties
+
+
+def _series_override(override, right_axis):
+    """Convert one entry of ``Graph.seriesOverrides`` to a field override."""
+    fields = _set_fields(override)
+    properties = []
+    if fields.get('bars'):
+        properties.append({'id': 'custom.drawStyle', 'value': 'bars'})
+    elif fields.get('lines') is False:
+        properties.append({'id': 'custom.drawStyle', 'value': 'points'})
+    if 'fill' in fields:
+        properties.append({'id': 'custom.fillOpacity', 'value': fields['fill'] * 10})
+    if fields.get('color'):
+        properties.append({'id': 'color', 'value': _fixed_color(fields['color'])})
+    if fields.get('dashes'):
+        properties.append({'id': 'custom.lineStyle', 'value': {
+            'fill': 'dash',
+            'dash': [fields.get('dashLength') or 10, fields.get('spaceLength') or 10],
+        }})
+    if fields.get('fillBelowTo'):
+        properties.append({'id': 'custom.fillBelowTo', 'value': fields['fillBelowTo']})
+    if fields.get('yaxis') == 2:
+        properties.append({'id': 'custom.axisPlacement', 'value': 'right'})
+        properties.extend(_axis_properties(right_axis))
+    if not properties:
+        return None
+    return {'matcher': _matcher(fields['alias']), 'properties': properties}
+
+
+def graph_to_time_series(graph):
+    """Convert a ``Graph`` to the equivalent ``TimeSeries`` panel.
+
+    Axes, legend, tooltip, thresholds, ``aliasColors`` and
+    ``seriesOverrides`` are carried over. Graphs that do not plot over
+    time are returned unchanged.
+
+    :param graph: a ``Graph``
+    :returns: a ``TimeSeries``, or ``graph``
+    """
+    if graph.xAxis.mode != 'time':
+        return graph
+
+    left = graph.yAxes.left
+    defaults = {}
+    kwargs = {
+        'unit': graph.unit or left.format or '',
+        'axisLabel': left.label or '',
+        'axisPlacement': 'auto' if left.show else 'hidden',
+        'drawStyle': 'bars' if graph.bars else 'line' if graph.lines else 'points',
+        'lineWidth': int(graph.lineWidth),
+        'fillOpacity': graph.fill * 10,
+        'gradientMode': 'opacity' if graph.fillGradient else 'none',
+        'lineInterpolation': 'stepAfter' if graph.steppedLine else 'linear',
+        'showPoints': 'always' if graph.points else 'never',
+        'pointSize': 2 + int(graph.pointRadius) * 2,
+        'spanNulls': graph.nullPointMode == NULL_CONNECTED,
+        'tooltipMode': 'multi' if graph.tooltip.shared else 'single',
+        'tooltipSort': {SORT_ASC: 'asc', SORT_DESC: 'desc'}.get(graph.tooltip.sort, 'none'),
+    }
+    if left.logBase and left.logBase > 1:
+        kwargs['scaleDistributionType'] = 'log'
+        kwargs['scaleDistributionLog'] = int(left.logBase)
+    for name, field in (('min', 'valueMin'), ('max', 'valueMax'), ('decimals', 'valueDecimals')):
+        value = _number(getattr(left, name))
+        if isinstance(value, int):
+            kwargs[field] = value
+        elif value is not None:
+            defaults[name] = value
+    if graph.stack:
+        kwargs['stacking'] = {'mode': 'percent' if graph.percentage else 'normal', 'group': 'A'}
+
+    legend = graph.legend
+    if not legend.show:
+        kwargs['legendDisplayMode'] = 'hidden'
+    elif legend.alignAsTable:
+        kwargs['legendDisplayMode'] = 'table'
+    if legend.rightSide:
+        kwargs['legendPlacement'] = 'right'
+    kwargs['legendCalcs'] = [calc for name, calc in LEGEND_CALCS if getattr(legend, name)]
+
+    if graph.thresholds and not graph.alert:
+        steps, mode = _graph_threshold_steps(graph.thresholds)
+        kwargs['thresholds'] = steps
+        kwargs['thresholdsStyleMode'] = mode
+
+    overrides = [
+        {'matcher': _matcher(alias), 'properties': [{'id': 'color', 'value': _fixed_color(color)}]}
+        for alias, color in graph.aliasColors.items()
+    ]
+    for override in graph.seriesOverrides:
+        converted = _series_override(override, graph.yAxes.right)
+        if converted:
+            overrides.append(converted)
+    kwargs['overrides'] = overrides
+
+    if graph.dataLinks:
+        defaults['links'] = graph.dataLinks
+    extra = {'fieldConfig': {'defaults': defaults}} if defaults else {}
+    if graph.alert:
+        extra['alert'] = graph.alert
+    kwargs.update(_common(graph, extra))
+    return TimeSeries(**kwargs)
+
+
+def _legacy_mappings(mapping_type, value_maps, range_maps):
+    """Convert ``ValueMap``/``RangeMap`` lists to typed value mappings."""
+    if mapping_type == 2:
+        legacy = [
+            {'type': 2, 'from': _get(m, 'from', _get(m, 'start')), 'to': _get(m, 'to', _get(m, 'end')),
+             'text': _get(m, 'text')}
+            for m in range_maps
+        ]
+    else:
+        legacy = [{'type': 1, 'value': _get(m, 'value'), 'text': _get(m, 'text')} for m in value_maps]
+    return upgrade_value_mappings(legacy)
+
+
+def _color_thresholds(colors, thresholds):
+    """Convert comma separated thresholds and their colors to threshold steps."""
+    if isinstance(thresholds, str):
+        thresholds = [t for t in thresholds.split(',') if t.strip()]
+    values = [_number(t) for t in thresholds or []]
+    steps = [Threshold(colors[0] if colors else 'green', 0, 0.0)]
+    for i, value in enumerate(v for v in values if v is not None):
+        color = colors[min(i + 1, len(colors) - 1)] if colors else 'red'
+        steps.append(Threshold(color, i + 1, float(value)))
+    return steps
+
+
+def single_stat_to_stat(single_stat):
+    """Convert a ``SingleStat`` to the equivalent ``Stat`` panel.
+
+    Single stats that show a gauge become a ``GaugePanel`` instead. Prefixes
+    and postfixes become a custom unit when no other unit is set.
+
+    :param single_stat: a ``SingleStat``
+    :returns: a ``Stat`` or ``GaugePanel``
+    """
+    unit = single_stat.format
+    if unit in (None, '', 'none'):
+        if single_stat.prefix:
+            unit = 'prefix:' + single_stat.prefix
+        elif single_stat.postfix:
+            unit = 'suffix:' + single_stat.postfix
+        else:
+            unit = 'none'
+    mappings = _legacy_mappings(single_stat.mappingType, single_stat.valueMaps, single_stat.rangeMaps)
+    thresholds = _color_thresholds(single_stat.colors, single_stat.thresholds)
+    calc = REDUCERS.get(single_stat.valueName, 'mean')
+    kwargs = _common(single_stat, {})
+    kwargs['thresholds'] = thresholds
+
+    if single_stat.gauge.show:
+        gauge = single_stat.gauge
+        return GaugePanel(
+            calc=calc, decimals=single_stat.decimals, format=unit, valueMaps=mappings,
+            min=gauge.minValue, max=gauge.maxValue,
+            thresholdLabels=gauge.thresholdLabels, thresholdMarkers=gauge.thresholdMarkers,
+            **kwargs)
+
+    if single_stat.colorBackground:
+        color_mode = 'background'
+    elif single_stat.colorValue:
+        color_mode = 'value'
+    else:
+        color_mode = 'none'
+    return Stat(
+        colorMode=color_mode,
+        decimals=single_stat.decimals,
+        format=unit,
+        graphMode='area' if single_stat.sparkline.show else 'none',
+        mappings=mappings,
+        noValue=single_stat.nullText if single_stat.nullText is not None else 'none',
+        reduceCalc=calc,
+        textMode='name' if single_stat.valueName == VTYPE_NAME else 'auto',
+        **kwargs)
+
+
+def column_style_override(style):
+    """Convert a ``ColumnStyle`` to a field override of a ``Table``.
+
+    :param style: a ``ColumnStyle``
+    :returns: a field override dict
+    """
+    properties = []
+    if style.alias:
+        properties.append({'id': 'displayName', 'value': style.alias})
+    if style.align != 'auto':
+        properties.append({'id': 'custom.align', 'value': style.align})
+    if style.link:
+        properties.append({'id': 'links', 'value': [{
+            'title': style.linkTooltip, 'url': style.linkUrl, 'targetBlank': style.linkOpenInNewTab,
+        }]})
+
+    kind = style.type
+    if isinstance(kind, HiddenColumnStyleType):
+        properties.append({'id': 'custom.hidden', 'value': True})
+    elif isinstance(kind, DateColumnStyleType):
+        properties.append({'id': 'unit', 'value': 'time: ' + kind.dateFormat})
+    else:
+        properties.append({'id': 'unit', 'value': kind.unit})
+        properties.append({'id': 'decimals', 'value': kind.decimals})
+        if kind.thresholds:
+            steps = _color_thresholds(kind.colors, kind.thresholds)
+            properties.append({'id': 'thresholds', 'value': {
+                'mode': 'absolute',
+                'steps': [{'color': s.color, 'value': None if s.index == 0 else s.value} for s in steps],
+            }})
+        if kind.colorMode in ('cell', 'row'):
+            properties.append({'id': 'custom.displayMode', 'value': 'color-background'})
+        elif kind.colorMode == 'value':
+            properties.append({'id': 'custom.displayMode', 'value': 'color-text'})
+        mappings = _legacy_mappings(
+            getattr(kind, 'mappingType', None), getattr(kind, 'valueMaps', []), getattr(kind, 'rangeMaps', []))
+        if mappings:
+            properties.append({'id': 'mappings', 'value': mappings})
+
+    return {'matcher': _matcher(style.pattern), 'properties': properties}
+
+
+def convert_panel(panel):
+    """Convert one angular panel to its modern replacement.
+
+    ``Graph`` and ``SingleStat`` panels are replaced, ``ColumnStyle`` entries
+    in the ``overrides`` of a ``Table`` become field overrides. Other panels
+    are returned unchanged.
+    """
+    if isinstance(panel, Graph):
+        return graph_to_time_series(panel)
+    if isinstance(panel, SingleStat):
+        return single_stat_to_stat(panel)
+    if isinstance(panel, Table) and any(isinstance(o, ColumnStyle) for o in panel.overrides):
+        return attr.evolve(panel, overrides=[
+            column_style_override(o) if isinstance(o, ColumnStyle) else o
+            for o in panel.overrides
+        ])
+    return panel
+
+
+def convert_dashboard(dashboard):
+    """Convert every angular panel of a dashboard, see ``convert_panel``.
+
+    Returns a new ``Dashboard``; panels in rows and ``RowPanel`` are
+    converted too.
+    """
+    return dashboard._map_panels(convert_panel)
+
+
+def angular_panels(dashboard):
+    """Return the panels of a dashboard that Grafana would still convert."""
+    return [
+        panel for panel in dashboard._iter_panels()
+        if isinstance(panel, SingleStat) or (isinstance(panel, Graph) and panel.xAxis.mode == 'time')
+    ]
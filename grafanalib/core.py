@@ -6,9 +6,10 @@ encourage it by way of some defaults. Rather, they are ways of building
 arbitrary Grafana JSON.
 """
 from __future__ import annotations
+import hashlib
 import itertools
 import math
-
+import re
 import string
 import warnings
 from numbers import Number
@@ -119,7 +120,14 @@ LIGHT_STYLE = 'light'
 
 UTC = 'utc'
 
+# Built-in datasources
+MIXED_DATASOURCE = '-- Mixed --'
+DASHBOARD_DATASOURCE = '-- Dashboard --'
+GRAFANA_DATASOURCE = '-- Grafana --'
+
 SCHEMA_VERSION = 12
+# Newest schema version grafanalib.schema can upgrade dashboards to.
+LATEST_SCHEMA_VERSION = 39
 
 # (DEPRECATED: use formatunits.py) Y Axis formats
 DURATION_FORMAT = 'dtdurations'
@@ -559,6 +567,82 @@ class Repeat(object):
         }
 
 
+# Letters of target refIds.
+REF_ID_LETTERS = string.ascii_uppercase
+
+# Length of the refIds derived from the content of targets.
+STABLE_REF_ID_LENGTH = 3
+
+
+def ref_id(index):
+    """Return the refId number ``index``, counting from 0: ``A`` to ``Z``,
+    then ``AA`` to ``ZZ``, then ``AAA`` and so on."""
+    letters = ''
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, len(REF_ID_LETTERS))
+        letters = REF_ID_LETTERS[rest] + letters
+    return letters
+
+
+# Target fields that only change how results are shown, not what is queried.
+TARGET_DISPLAY_FIELDS = ('refId', 'legendFormat', 'alias', 'hide')
+
+
+def target_key(target):
+    """Return the text of what a target queries, to derive a stable refId
+    from.
+
+    Targets with an ``expr`` or a Graphite ``target`` are keyed on it and
+    their datasource; others on all their fields but the ones in
+    ``TARGET_DISPLAY_FIELDS``. Renaming a series or hiding a target keeps
+    its refId.
+    """
+    if getattr(target, 'expr', '') or getattr(target, 'target', ''):
+        return repr((type(target).__name__, str(getattr(target, 'expr', '')),
+                     getattr(target, 'target', ''), getattr(target, 'datasource', None)))
+    if attr.has(type(target)):
+        return repr((type(target).__name__, tuple(
+            (field.name, getattr(target, field.name)) for field in attr.fields(type(target))
+            if field.name not in TARGET_DISPLAY_FIELDS)))
+    return repr(target)
+
+
+@attr.s
+class RefIdAllocator(object):
+    """Give out refIds that are unique within a panel.
+
+    Without a key, ``allocate`` returns the first refId not taken, in the
+    order of ``ref_id``. With a key, it derives a refId of
+    ``STABLE_REF_ID_LENGTH`` letters from it, taking the next free one if it
+    is taken, so the refId of a target does not depend on the other targets
+    of the panel or their order.
+
+    :param taken: refIds already used in the panel
+    """
+
+    taken = attr.ib(factory=set, converter=set)
+    _next = attr.ib(default=0, init=False)
+
+    def allocate(self, key=None):
+        """Return a free refId, derived from the text ``key`` if given."""
+        if key is None:
+            while ref_id(self._next) in self.taken:
+                self._next += 1
+            index = self._next
+        else:
+            size = len(REF_ID_LETTERS) ** STABLE_REF_ID_LENGTH
+            start = sum(len(REF_ID_LETTERS) ** n for n in range(1, STABLE_REF_ID_LENGTH))
+            digest = int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16)
+            offset = digest % size
+            while ref_id(start + offset) in self.taken:
+                offset = (offset + 1) % size
+            index = start + offset
+        value = ref_id(index)
+        self.taken.add(value)
+        return value
+
+
 def is_valid_target(instance, attribute, value):
     """
     Check if a given attribute is a valid Target
@@ -631,6 +715,33 @@ class LokiTarget(object):
         }
 
 
+@attr.s
+class DashboardTarget(object):
+    """
+    Target reusing the query results of another panel of the same dashboard,
+    to be used in panels with the ``DASHBOARD_DATASOURCE`` datasource
+
+    :param panelId: id of the panel whose results to show
+    :param withTransforms: also apply the transformations of that panel
+    :param refId: reference id of the target
+    """
+
+    panelId = attr.ib(validator=instance_of(int))
+    withTransforms = attr.ib(default=False, validator=instance_of(bool))
+    refId = attr.ib(default='A', validator=instance_of(str))
+
+    def to_json_data(self):
+        return {
+            'datasource': {
+                'type': 'datasource',
+                'uid': DASHBOARD_DATASOURCE,
+            },
+            'panelId': self.panelId,
+            'refId': self.refId,
+            'withTransforms': self.withTransforms,
+        }
+
+
 @attr.s
 class SqlTarget(Target):
     """
@@ -1018,6 +1129,9 @@ class Template(object):
     :param auto: Interval will be dynamically calculated by dividing time range by the count specified in auto_count.
     :param autoCount: Number of intervals for dividing the time range.
     :param autoMin: Smallest interval for auto interval generator.
+    :param minimalOptions: Leave the options of custom templates out of
+        their JSON, as Grafana builds them from the query on load, to keep
+        the JSON of templates with many values small.
     """
 
     name = attr.ib()
@@ -1057,25 +1171,13 @@ class Template(object):
         validator=instance_of(int)
     )
     autoMin = attr.ib(default=DEFAULT_MIN_AUTO_INTERVAL)
+    minimalOptions = attr.ib(default=False, validator=instance_of(bool))
 
     def __attrs_post_init__(self):
         if self.type == 'custom':
             if len(self.options) == 0:
-                for value in self.query.split(','):
-                    is_default = value == self.default
-                    option = {
-                        'selected': is_default,
-                        'text': value,
-                        'value': value,
-                    }
-                    if is_default:
-                        self._current = option
-                    self.options.append(option)
-            else:
-                for option in self.options:
-                    if option['selected']:
-                        self._current = option
-                        break
+                self.options.extend(self._query_options())
+            self._current = next((o for o in self.options if o.get('selected')), {})
         else:
             self._current = {
                 'selected': False if self.default is None or not self.default else True,
@@ -1084,6 +1186,23 @@ class Template(object):
                 'tags': [],
             }
 
+    def _query_options(self):
+        """Return an option per distinct value of the comma separated query
+        of a custom template, commas in values being escaped as ``\\,``.
+        Empty values are kept, as Grafana keeps them."""
+        values = [v.replace('\\,', ',') for v in re.split(r'(?<!\\),', self.query)]
+        return [
+            {'selected': value == self.default, 'text': value, 'value': value}
+            for value in dict.fromkeys(values)
+        ]
+
+    def _json_options(self):
+        # Grafana builds the options of custom variables from their query
+        # when the dashboard loads, only the current value is needed.
+        if self.minimalOptions and self.type == 'custom':
+            return []
+        return self.options
+
     def to_json_data(self):
         return {
             'allValue': self.allValue,
@@ -1094,7 +1213,7 @@ class Template(object):
             'label': self.label,
             'multi': self.multi,
             'name': self.name,
-            'options': self.options,
+            'options': self._json_options(),
             'query': self.query,
             'refresh': self.refresh,
             'regex': self.regex,
@@ -1764,6 +1883,69 @@ class Notification(object):
         }
 
 
+CACHE_TTL_REFRESH = 'refresh'
+
+
+@attr.s
+class CacheRule(object):
+    """A rule of a ``CachePolicy``.
+
+    A rule matches a panel when all of its set conditions hold; conditions
+    left to ``None`` match any panel.
+
+    :param ttl: how long query results of matching panels are cached, as a
+        duration such as ``'5m'``, ``CACHE_TTL_REFRESH`` for the refresh
+        interval of the dashboard, or ``None`` to not cache them
+    :param title: shell-style pattern matched against the panel title, to
+        override the policy for single panels
+    :param datasource: shell-style pattern matched against the datasource name
+    :param datasourceType: datasource plugin type, such as ``'prometheus'``;
+        see ``CachePolicy.datasourceTypes``
+    :param instant: ``True`` to match panels whose queries are all instant
+        queries, ``False`` for panels with range queries
+    :param minTimeRange: match panels querying at least this time range
+    :param maxTimeRange: match panels querying at most this time range
+    :param minRefresh: match dashboards refreshing at most this often
+    :param maxRefresh: match dashboards refreshing at least this often
+    """
+
+    ttl = attr.ib(default=CACHE_TTL_REFRESH, validator=attr.validators.optional(instance_of(str)))
+    title = attr.ib(default=None, validator=attr.validators.optional(instance_of(str)))
+    datasource = attr.ib(default=None, validator=attr.validators.optional(instance_of(str)))
+    datasourceType = attr.ib(default=None, validator=attr.validators.optional(instance_of(str)))
+    instant = attr.ib(default=None, validator=attr.validators.optional(instance_of(bool)))
+    minTimeRange = attr.ib(default=None, validator=attr.validators.optional(instance_of(str)))
+    maxTimeRange = attr.ib(default=None, validator=attr.validators.optional(instance_of(str)))
+    minRefresh = attr.ib(default=None, validator=attr.validators.optional(instance_of(str)))
+    maxRefresh = attr.ib(default=None, validator=attr.validators.optional(instance_of(str)))
+
+
+@attr.s
+class CachePolicy(object):
+    """Dashboard-wide query cache settings.
+
+    Every panel that does not set ``cacheTimeout`` or ``queryCachingTTL``
+    itself gets the TTL of the first rule that matches it, as both its
+    ``cacheTimeout`` and its ``queryCachingTTL``. See
+    ``grafanalib.optimize.apply_cache_policy``.
+
+    :param rules: list of ``CacheRule``, the first match wins
+    :param datasourceTypes: dict mapping datasource names to their plugin
+        type, used to match ``CacheRule.datasourceType``
+    :param defaultDatasource: name of the datasource of panels without one
+    """
+
+    rules = attr.ib(
+        default=attr.Factory(list),
+        validator=attr.validators.deep_iterable(
+            member_validator=instance_of(CacheRule),
+            iterable_validator=instance_of(list),
+        ),
+    )
+    datasourceTypes = attr.ib(default=attr.Factory(dict), validator=instance_of(dict))
+    defaultDatasource = attr.ib(default=None)
+
+
 @attr.s
 class Dashboard(object):
 
@@ -1772,6 +1954,10 @@ class Dashboard(object):
         default=attr.Factory(Annotations),
         validator=instance_of(Annotations),
     )
+    cachePolicy = attr.ib(
+        default=None,
+        validator=attr.validators.optional(instance_of(CachePolicy)),
+    )
     description = attr.ib(default="", validator=instance_of(str))
     editable = attr.ib(
         default=True,
@@ -1796,7 +1982,9 @@ class Dashboard(object):
     panels = attr.ib(default=attr.Factory(list), validator=instance_of(list))
     refresh = attr.ib(default=DEFAULT_REFRESH)
     rows = attr.ib(default=attr.Factory(list), validator=instance_of(list))
-    schemaVersion = attr.ib(default=SCHEMA_VERSION)
+    # Newer versions, up to LATEST_SCHEMA_VERSION, are upgraded to at build
+    # time by grafanalib.schema.
+    schemaVersion = attr.ib(default=SCHEMA_VERSION, validator=instance_of(int))
     sharedCrosshair = attr.ib(
         default=False,
         validator=instance_of(bool),
@@ -1853,6 +2041,14 @@ class Dashboard(object):
         return self._map_panels(set_id)
 
     def to_json_data(self):
+        if self.cachePolicy is not None:
+            # Imported here as grafanalib.optimize builds on this module.
+            from grafanalib import optimize
+            return attr.evolve(optimize.apply_cache_policy(self), cachePolicy=None).to_json_data()
+        if self.schemaVersion > SCHEMA_VERSION:
+            # Imported here as grafanalib.schema builds on this module.
+            from grafanalib import schema
+            return schema.upgrade_dashboard(self)
         if self.panels and self.rows:
             print(
                 "Warning: You are using both panels and rows in this dashboard, please use one or the other. "
@@ -1916,6 +2112,8 @@ class Panel(object):
     :param maxDataPoints: maximum metric query results,
            that will be used for rendering
     :param minSpan: minimum span number
+    :param queryCachingTTL: how long Grafana caches query results of this
+           panel, in milliseconds
     :param repeat: Template's name to repeat Graph on
     :param span: defines the number of spans that will be used for panel
     :param targets: list of metric requests for chosen datasource
@@ -1944,6 +2142,7 @@ class Panel(object):
     links = attr.ib(default=attr.Factory(list))
     maxDataPoints = attr.ib(default=100)
     minSpan = attr.ib(default=None)
+    queryCachingTTL = attr.ib(default=None, validator=attr.validators.optional(instance_of(int)))
     repeat = attr.ib(default=attr.Factory(Repeat), validator=instance_of(Repeat))
     span = attr.ib(default=None)
     thresholds = attr.ib(default=attr.Factory(list))
@@ -1957,6 +2156,41 @@ class Panel(object):
     def _map_panels(self, f):
         return f(self)
 
+    def _iter_targets(self):
+        for target in self.targets:
+            yield target
+
+    def _map_targets(self, f):
+        return attr.evolve(self, targets=[f(t) for t in self.targets])
+
+    def auto_ref_ids(self, stable=False):
+        """Give unique IDs all the targets without IDs.
+
+        Returns a new panel that is the same as this one, except all of
+        the metrics have their ``refId`` property set. Any targets which had
+        an ``refId`` property set will keep that property, all others will
+        have auto-generated IDs provided for them, see ``RefIdAllocator``.
+
+        :param stable: derive the IDs from the content of the targets rather
+            than their position, so that adding or moving targets does not
+            change the IDs of the others, nor alert conditions using them
+        """
+        targets = list(self._iter_targets())
+        allocator = RefIdAllocator(t.refId for t in targets if t.refId)
+        missing = [i for i, t in enumerate(targets) if not t.refId]
+        if stable:
+            # Allocate in the order of the keys, so that only colliding keys
+            # depend on each other, not on where the targets are.
+            keys = {i: target_key(targets[i]) for i in missing}
+            missing.sort(key=keys.get)
+            ref_ids = {i: allocator.allocate(keys[i]) for i in missing}
+        else:
+            ref_ids = {i: allocator.allocate() for i in missing}
+        return attr.evolve(self, targets=[
+            attr.evolve(t, refId=ref_ids[i]) if i in ref_ids else t
+            for i, t in enumerate(targets)
+        ])
+
     def panel_json(self, overrides):
         res = {
             'cacheTimeout': self.cacheTimeout,
@@ -1991,6 +2225,8 @@ class Panel(object):
             'transparent': self.transparent,
             'transformations': self.transformations,
         }
+        if self.queryCachingTTL is not None:
+            res['queryCachingTTL'] = self.queryCachingTTL
         _deep_update(res, overrides)
         _deep_update(res, self.extraJson)
         return res
@@ -2223,37 +2459,6 @@ class Graph(Panel):
             print("Warning: Graph threshold ignored as Alerts defined")
         return self.panel_json(graphObject)
 
-    def _iter_targets(self):
-        for target in self.targets:
-            yield target
-
-    def _map_targets(self, f):
-        return attr.evolve(self, targets=[f(t) for t in self.targets])
-
-    def auto_ref_ids(self):
-        """Give unique IDs all the panels without IDs.
-
-        Returns a new ``Graph`` that is the same as this one, except all of
-        the metrics have their ``refId`` property set. Any panels which had
-        an ``refId`` property set will keep that property, all others will
-        have auto-generated IDs provided for them.
-        """
-        ref_ids = set([t.refId for t in self._iter_targets() if t.refId])
-        double_candidate_refs = \
-            [p[0] + p[1] for p
-                in itertools.product(string.ascii_uppercase, repeat=2)]
-        candidate_ref_ids = itertools.chain(
-            string.ascii_uppercase,
-            double_candidate_refs,
-        )
-
-        auto_ref_ids = (i for i in candidate_ref_ids if i not in ref_ids)
-
-        def set_refid(t):
-            return t if t.refId else attr.evolve(t, refId=next(auto_ref_ids))
-
-        return self._map_targets(set_refid)
-
 
 @attr.s
 class TimeSeries(Panel):
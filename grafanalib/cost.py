@@ -0,0 +1,470 @@
+"""Static estimates of the load a dashboard puts on its datasources.
+
+``dashboard_cost`` counts, from the object model alone, the queries a
+dashboard issues when it is opened and on every automatic refresh:
+
+* one query per visible target of each panel, times the number of copies of
+  repeated panels. Panels of collapsed rows only query once expanded and
+  are counted apart;
+* one query per query variable refreshed on load or on time range change
+  (the latter also on every refresh);
+* one query per enabled annotation.
+
+``check_cost`` compares a report with a ``CostBudget``, so that a CI job can
+fail before an expensive dashboard is rolled out. ``datasource_load`` splits
+the same estimate by datasource, and ``fleet_load`` adds up the estimates of
+many dashboards to forecast the load on each datasource.
+``collapse_expensive_rows`` collapses the rows that are below the fold or do
+not fit a budget, so that opening a dashboard only queries what is visible.
+"""
+
+import attr
+from attr.validators import instance_of, optional
+
+from grafanalib.checks import Problem
+from grafanalib.core import (
+    DASHBOARD_DATASOURCE, REFRESH_ON_DASHBOARD_LOAD, REFRESH_ON_TIME_RANGE_CHANGE,
+    DashboardTarget, RowPanel,
+)
+from grafanalib.layout import ROW_PANEL_HEIGHT, rows_to_panels
+from grafanalib.optimize import (
+    panel_time_range, parse_duration, template_values, time_range_seconds,
+)
+
+QUERIES_PER_LOAD = 'queries-per-load'
+QUERIES_PER_SECOND = 'queries-per-second'
+POINTS_PER_LOAD = 'points-per-load'
+
+# Key of the targets and panels that do not set a datasource.
+DEFAULT_DATASOURCE = 'default'
+
+# Copies assumed for panels repeating over variables whose values are only
+# known in the browser.
+DEFAULT_REPEAT_FAN_OUT = 1
+
+# Time range assumed for dashboards with an absolute time range.
+DEFAULT_TIME_RANGE = 6 * 60 * 60
+
+
+@attr.s
+class PanelCost(object):
+    """The queries of one panel.
+
+    :param title: title of the panel
+    :param queries: queries per load, repeats included
+    :param points: data points requested per load
+    :param copies: number of copies of a repeated panel, 1 otherwise
+    :param collapsed: whether the panel is in a collapsed row
+    :param query_seconds: queries per load times the seconds of the time
+        range of the panel, ``timeFrom`` overriding the dashboard's
+    """
+
+    title = attr.ib()
+    queries = attr.ib(validator=instance_of(int))
+    points = attr.ib(validator=instance_of(int))
+    copies = attr.ib(default=1, validator=instance_of(int))
+    collapsed = attr.ib(default=False, validator=instance_of(bool))
+    query_seconds = attr.ib(default=0)
+
+
+@attr.s
+class CostReport(object):
+    """Estimated load of a dashboard, for a single viewer.
+
+    :param title: title of the dashboard
+    :param panels: list of ``PanelCost``
+    :param template_queries: variable queries run on load
+    :param template_refresh_queries: variable queries run on every refresh
+    :param annotation_queries: annotation queries run on load and refresh
+    :param refresh: seconds between automatic refreshes, ``None`` if the
+        dashboard does not refresh
+    """
+
+    title = attr.ib()
+    panels = attr.ib(default=attr.Factory(list))
+    template_queries = attr.ib(default=0, validator=instance_of(int))
+    template_refresh_queries = attr.ib(default=0, validator=instance_of(int))
+    annotation_queries = attr.ib(default=0, validator=instance_of(int))
+    refresh = attr.ib(default=None)
+
+    @property
+    def panel_queries(self):
+        """Queries of the panels shown when the dashboard is opened."""
+        return sum(p.queries for p in self.panels if not p.collapsed)
+
+    @property
+    def collapsed_queries(self):
+        """Queries of the panels of collapsed rows, run when expanded."""
+        return sum(p.queries for p in self.panels if p.collapsed)
+
+    @property
+    def queries_per_load(self):
+        return self.panel_queries + self.template_queries + self.annotation_queries
+
+    @property
+    def queries_per_refresh(self):
+        return self.panel_queries + self.template_refresh_queries + self.annotation_queries
+
+    @property
+    def queries_per_second(self):
+        """Queries per second while the dashboard refreshes automatically."""
+        if not self.refresh:
+            return 0.0
+        return self.queries_per_refresh / float(self.refresh)
+
+    @property
+    def points_per_load(self):
+        return sum(p.points for p in self.panels if not p.collapsed)
+
+    def to_json_data(self):
+        return {
+            'title': self.title,
+            'queriesPerLoad': self.queries_per_load,
+            'queriesPerRefresh': self.queries_per_refresh,
+            'queriesPerSecond': self.queries_per_second,
+            'pointsPerLoad': self.points_per_load,
+            'collapsedQueries': self.collapsed_queries,
+            'templateQueries': self.template_queries,
+            'annotationQueries': self.annotation_queries,
+            'refresh': self.refresh,
+        }
+
+
+@attr.s
+class CostBudget(object):
+    """Limits for ``check_cost``; limits left to ``None`` are not checked.
+
+    :param max_queries_per_load: most queries when the dashboard is opened
+    :param max_queries_per_second: most queries per second while it
+        refreshes, for all viewers together
+    :param max_points_per_load: most data points requested when opened
+    :param viewers: number of people viewing the dashboard at once
+    """
+
+    max_queries_per_load = attr.ib(default=None, validator=optional(instance_of(int)))
+    max_queries_per_second = attr.ib(default=None, validator=optional(instance_of((int, float))))
+    max_points_per_load = attr.ib(default=None, validator=optional(instance_of(int)))
+    viewers = attr.ib(default=1, validator=instance_of(int))
+
+
+def _get(obj, name, default=None):
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+
+def repeat_fan_out(panel, templates, fan_out=None):
+    """Return how many copies of a panel Grafana shows.
+
+    :param templates: dict of the templates of the dashboard by name
+    :param fan_out: dict of the number of values of variables whose values
+        are only known in the browser; others count as
+        ``DEFAULT_REPEAT_FAN_OUT``
+    """
+    repeat = _get(panel, 'repeat')
+    variable = _get(repeat, 'variable') or ''
+    if not variable:
+        return 1
+    name = variable.lstrip('$')
+    if fan_out and name in fan_out:
+        return fan_out[name]
+    template = templates.get(name)
+    values = template_values(template) if template is not None else None
+    return len(values) if values else DEFAULT_REPEAT_FAN_OUT
+
+
+def panel_queries(panel):
+    """Return the targets of a panel that reach a datasource."""
+    if _get(panel, 'dataSource') == DASHBOARD_DATASOURCE:
+        return []
+    return [
+        t for t in _get(panel, 'targets') or []
+        if not _get(t, 'hide', False) and not isinstance(t, DashboardTarget)
+    ]
+
+
+def dashboard_time_range(dashboard):
+    """Return the seconds of the time range of a dashboard,
+    ``DEFAULT_TIME_RANGE`` for absolute ones."""
+    return time_range_seconds(dashboard.time) or DEFAULT_TIME_RANGE
+
+
+def _panel_cost(panel, templates, fan_out, collapsed, time_range=DEFAULT_TIME_RANGE):
+    copies = repeat_fan_out(panel, templates, fan_out)
+    targets = panel_queries(panel)
+    max_points = _get(panel, 'maxDataPoints') or 0
+    points = sum(1 if _get(t, 'instant', False) else max_points for t in targets)
+    return PanelCost(
+        title=_get(panel, 'title', ''), queries=len(targets) * copies,
+        points=points * copies, copies=copies, collapsed=collapsed,
+        query_seconds=len(targets) * copies * panel_time_range(panel, time_range),
+    )
+
+
+def _templates_by_name(dashboard):
+    return {
+        _get(t, 'name'): t for t in dashboard.templating.list
+        if not isinstance(t, dict)
+    }
+
+
+def iter_shown_panels(dashboard):
+    """Yield ``(panel, collapsed)`` for every panel of a dashboard."""
+    for row in dashboard.rows:
+        for panel in row.panels:
+            yield panel, row.collapse
+    for panel in dashboard.panels:
+        if isinstance(panel, RowPanel):
+            for child in panel.panels:
+                yield child, panel.collapsed
+        else:
+            yield panel, False
+
+
+def refreshed_templates(dashboard):
+    """Return the ``(template, on_refresh)`` of the query variables of a
+    dashboard that are queried on load, ``on_refresh`` being whether they
+    are also queried on every refresh."""
+    templates = []
+    for template in dashboard.templating.list:
+        if _get(template, 'type') != 'query':
+            continue
+        refresh = _get(template, 'refresh')
+        if refresh in (REFRESH_ON_DASHBOARD_LOAD, REFRESH_ON_TIME_RANGE_CHANGE):
+            templates.append((template, refresh == REFRESH_ON_TIME_RANGE_CHANGE))
+    return templates
+
+
+def enabled_annotations(dashboard):
+    return [a for a in dashboard.annotations.list if _get(a, 'enable', True)]
+
+
+def dashboard_cost(dashboard, fan_out=None):
+    """Estimate the queries a dashboard issues, for a single viewer.
+
+    :param dashboard: a ``Dashboard``
+    :param fan_out: optional dict of the number of values of variables whose
+        values are only known in the browser, see ``repeat_fan_out``
+    :returns: a ``CostReport``
+    """
+    templates = _templates_by_name(dashboard)
+    time_range = dashboard_time_range(dashboard)
+    panels = [
+        _panel_cost(panel, templates, fan_out, collapsed, time_range)
+        for panel, collapsed in iter_shown_panels(dashboard)
+    ]
+    refreshed = refreshed_templates(dashboard)
+    return CostReport(
+        title=dashboard.title,
+        panels=panels,
+        template_queries=len(refreshed),
+        template_refresh_queries=len([t for t, on_refresh in refreshed if on_refresh]),
+        annotation_queries=len(enabled_annotations(dashboard)),
+        refresh=parse_duration(dashboard.refresh),
+    )
+
+
+def check_cost(report, budget):
+    """Return the ``Problem`` list of a ``CostReport`` over a ``CostBudget``."""
+    problems = []
+    if budget.max_queries_per_load is not None and report.queries_per_load > budget.max_queries_per_load:
+        problems.append(Problem(QUERIES_PER_LOAD, 'dashboard "{}" issues {} queries per load, more than {}'.format(
+            report.title, report.queries_per_load, budget.max_queries_per_load)))
+    qps = report.queries_per_second * budget.viewers
+    if budget.max_queries_per_second is not None and qps > budget.max_queries_per_second:
+        problems.append(Problem(QUERIES_PER_SECOND, 'dashboard "{}" issues {:.2f} queries/s for {} viewers, '
+                                'more than {}'.format(report.title, qps, budget.viewers,
+                                                      budget.max_queries_per_second)))
+    if budget.max_points_per_load is not None and report.points_per_load > budget.max_points_per_load:
+        problems.append(Problem(POINTS_PER_LOAD, 'dashboard "{}" requests {} points per load, more than {}'.format(
+            report.title, report.points_per_load, budget.max_points_per_load)))
+    return problems
+
+
+@attr.s
+class DatasourceLoad(object):
+    """Estimated load on one datasource.
+
+    :param datasource: name or uid of the datasource
+    :param queries_per_load: queries when the dashboards are opened
+    :param queries_per_second: queries per second while they refresh
+    :param points_per_second: data points per second while they refresh
+    :param dashboards: number of dashboards querying the datasource
+    """
+
+    datasource = attr.ib()
+    queries_per_load = attr.ib(default=0)
+    queries_per_second = attr.ib(default=0.0)
+    points_per_second = attr.ib(default=0.0)
+    dashboards = attr.ib(default=1, validator=instance_of(int))
+
+    def __add__(self, other):
+        return DatasourceLoad(
+            datasource=self.datasource,
+            queries_per_load=self.queries_per_load + other.queries_per_load,
+            queries_per_second=self.queries_per_second + other.queries_per_second,
+            points_per_second=self.points_per_second + other.points_per_second,
+            dashboards=self.dashboards + other.dashboards,
+        )
+
+    def to_json_data(self):
+        return {
+            'datasource': self.datasource,
+            'queriesPerLoad': self.queries_per_load,
+            'queriesPerSecond': self.queries_per_second,
+            'pointsPerSecond': self.points_per_second,
+            'dashboards': self.dashboards,
+        }
+
+
+def datasource_name(datasource):
+    """Return the name of a datasource given as a name, uid or reference."""
+    if isinstance(datasource, dict):
+        datasource = datasource.get('uid')
+    return datasource or DEFAULT_DATASOURCE
+
+
+def target_datasource(target, panel):
+    """Return the datasource a target queries.
+
+    Targets name their datasource as ``datasource`` or ``dataSource``; those
+    that do not, query the datasource of their panel.
+    """
+    datasource = _get(target, 'datasource') or _get(target, 'dataSource')
+    if datasource is None or datasource == '':
+        datasource = _get(panel, 'dataSource')
+    return datasource_name(datasource)
+
+
+def datasource_load(dashboard, viewers=1, fan_out=None):
+    """Estimate the load a dashboard puts on each of its datasources.
+
+    Panels of collapsed rows are left out, as they only query when expanded.
+
+    :param dashboard: a ``Dashboard``
+    :param viewers: number of people viewing the dashboard at once
+    :param fan_out: see ``dashboard_cost``
+    :returns: dict of ``DatasourceLoad`` by datasource
+    """
+    refresh = parse_duration(dashboard.refresh)
+    rate = viewers / float(refresh) if refresh else 0.0
+    queries = {}
+
+    def add(datasource, count, points=0, on_refresh=True):
+        load = queries.setdefault(datasource, DatasourceLoad(datasource))
+        load.queries_per_load += count * viewers
+        if on_refresh:
+            load.queries_per_second += count * rate
+            load.points_per_second += points * rate
+
+    templates = _templates_by_name(dashboard)
+    for panel, collapsed in iter_shown_panels(dashboard):
+        if collapsed:
+            continue
+        copies = repeat_fan_out(panel, templates, fan_out)
+        max_points = _get(panel, 'maxDataPoints') or 0
+        for target in panel_queries(panel):
+            points = 1 if _get(target, 'instant', False) else max_points
+            add(target_datasource(target, panel), copies, points * copies)
+    for template, on_refresh in refreshed_templates(dashboard):
+        add(datasource_name(_get(template, 'dataSource')), 1, on_refresh=on_refresh)
+    for annotation in enabled_annotations(dashboard):
+        add(datasource_name(_get(annotation, 'datasource')), 1)
+    return queries
+
+
+def fleet_load(loads):
+    """Add up the ``datasource_load`` of many dashboards.
+
+    :returns: list of ``DatasourceLoad``, by decreasing queries per second
+    """
+    total = {}
+    for load in loads:
+        for datasource, dashboard_load in load.items():
+            if datasource in total:
+                total[datasource] = total[datasource] + dashboard_load
+            else:
+                total[datasource] = dashboard_load
+    return sorted(total.values(), key=lambda load: (-load.queries_per_second, str(load.datasource)))
+
+
+def _bottom(panels):
+    return max(p.gridPos.y + p.gridPos.h for p in panels)
+
+
+def _move(panel, dy):
+    if not dy:
+        return panel
+    return attr.evolve(panel, gridPos=attr.evolve(panel.gridPos, y=panel.gridPos.y + dy))
+
+
+def collapse_expensive_rows(dashboard, fold=None, max_queries=None, max_points=None, fan_out=None,
+                            max_query_seconds=None):
+    """Collapse the rows of a dashboard that are not worth querying on load.
+
+    Going down the dashboard, an expanded ``RowPanel`` is collapsed, its
+    panels moved into ``RowPanel.panels``, when its panels start at or below
+    grid row ``fold``, or when their queries, points or query seconds would
+    take the dashboard over ``max_queries``, ``max_points`` or
+    ``max_query_seconds``. Panels above the first
+    row are always shown and count towards the budgets. Panels below a
+    collapsed row move up to take its place.
+
+    :param dashboard: a ``Dashboard`` whose panels all have a ``gridPos``,
+        see ``layout.auto_layout``; legacy rows are converted with
+        ``layout.rows_to_panels`` first
+    :param fold: grid row of the bottom of the screen, ``None`` to collapse
+        rows only over budget
+    :param max_queries: most queries on load, see ``dashboard_cost``
+    :param max_points: most data points on load
+    :param fan_out: see ``dashboard_cost``
+    :param max_query_seconds: most queries on load, each weighted by the
+        seconds of the time range of its panel, see ``PanelCost``
+    :returns: a new ``Dashboard``
+    """
+    dashboard = rows_to_panels(dashboard)
+    templates = _templates_by_name(dashboard)
+    time_range = dashboard_time_range(dashboard)
+    sections = [[]]
+    for panel in dashboard.panels:
+        if getattr(panel, 'gridPos', None) is None or panel.gridPos.y is None:
+            raise ValueError('Panel {!r} has no position, lay out the dashboard first'.format(panel.title))
+        if isinstance(panel, RowPanel):
+            sections.append([])
+        sections[-1].append(panel)
+
+    limits = (max_queries, max_points, max_query_seconds)
+
+    def fits(totals):
+        return all(limit is None or total <= limit for total, limit in zip(totals, limits))
+
+    def totals(costs):
+        return [
+            sum(c.queries for c in costs), sum(c.points for c in costs),
+            sum(c.query_seconds for c in costs),
+        ]
+
+    used = [0, 0, 0]
+    panels = []
+    dy = 0
+    for section in sections:
+        if not section:
+            continue
+        row, children = section[0], section[1:]
+        costs = [_panel_cost(p, templates, fan_out, False, time_range) for p in children]
+        if isinstance(row, RowPanel) and not row.collapsed and children:
+            with_section = [u + t for u, t in zip(used, totals(costs))]
+            below_fold = fold is not None and row.gridPos.y + dy + ROW_PANEL_HEIGHT >= fold
+            if below_fold or not fits(with_section):
+                header_bottom = row.gridPos.y + ROW_PANEL_HEIGHT
+                panels.append(attr.evolve(
+                    _move(row, dy), collapsed=True,
+                    panels=row.panels + [_move(p, dy) for p in children],
+                ))
+                dy -= max(0, _bottom(children) - header_bottom)
+                continue
+        if not isinstance(row, RowPanel):
+            costs.insert(0, _panel_cost(row, templates, fan_out, False, time_range))
+        used = [u + t for u, t in zip(used, totals(costs))]
+        panels.extend(_move(p, dy) for p in section)
+    return attr.evolve(dashboard, panels=panels)
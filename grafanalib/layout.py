@@ -0,0 +1,234 @@
+"""Automatic panel layout on Grafana's 24 column grid.
+
+Writing ``GridPos(h, w, x, y)`` by hand for every panel gets tedious and error
+prone on big dashboards. The helpers here compute the ``x`` and ``y`` of each
+panel from its size, so definitions only need to say how big a panel is (or
+rely on the defaults).
+
+Placement keeps a skyline: the height already used in each of the 24 columns.
+Each panel is dropped at the lowest position its width fits into, preferring
+the leftmost one, which is what Grafana itself does when it compacts a
+dashboard. Every placement looks at a fixed number of columns, so laying out a
+dashboard is linear in its number of panels, and since panels are placed one
+after the other, appending panels never moves the ones before them.
+"""
+
+import attr
+from attr.validators import in_, instance_of
+
+from grafanalib.core import (
+    DEFAULT_ROW_HEIGHT, TOTAL_SPAN, GridPos, Pixels, Repeat, RowPanel,
+)
+
+GRID_WIDTH = 24
+DEFAULT_PANEL_WIDTH = 12
+DEFAULT_PANEL_HEIGHT = 8
+ROW_PANEL_HEIGHT = 1
+
+# Constants of Grafana's row to grid migration (DashboardMigrator).
+GRID_CELL_HEIGHT = 30
+GRID_CELL_VMARGIN = 8
+MIN_PANEL_HEIGHT = 3 * GRID_CELL_HEIGHT
+LEGACY_PANEL_SPAN = 4
+
+LAYOUT_COMPACT = 'compact'
+LAYOUT_FLOW = 'flow'
+
+
+@attr.s
+class Skyline(object):
+    """The used height of each column of a section of the grid.
+
+    :param top: the first free grid row of the section
+    :param columns: number of grid columns
+    :param mode: ``LAYOUT_COMPACT`` to drop each panel into the lowest gap
+        it fits, or ``LAYOUT_FLOW`` to fill the grid row by row, starting a
+        new row below the tallest panel of the previous one when a panel does
+        not fit
+    """
+
+    top = attr.ib(default=0, validator=instance_of(int))
+    columns = attr.ib(default=GRID_WIDTH, validator=instance_of(int))
+    mode = attr.ib(default=LAYOUT_COMPACT, validator=in_([LAYOUT_COMPACT, LAYOUT_FLOW]))
+    heights = attr.ib(init=False)
+    _cursor = attr.ib(init=False, default=0)
+    _line = attr.ib(init=False)
+
+    def __attrs_post_init__(self):
+        self.heights = [self.top] * self.columns
+        self._line = self.top
+
+    @property
+    def bottom(self):
+        """The first grid row below every placed panel."""
+        return max(self.heights)
+
+    def place(self, w, h):
+        """Reserve a ``w`` x ``h`` rectangle and return its ``(x, y)``."""
+        w = max(1, min(w, self.columns))
+        heights = self.heights
+        if self.mode == LAYOUT_FLOW:
+            if self._cursor + w > self.columns:
+                self._cursor = 0
+                self._line = self.bottom
+            x, y = self._cursor, self._line
+            self._cursor += w
+        else:
+            x, y = 0, max(heights[0:w])
+            for candidate in range(1, self.columns - w + 1):
+                candidate_y = max(heights[candidate:candidate + w])
+                if candidate_y < y:
+                    x, y = candidate, candidate_y
+        heights[x:x + w] = [y + h] * w
+        return x, y
+
+
+def panel_size(panel, width=DEFAULT_PANEL_WIDTH, height=DEFAULT_PANEL_HEIGHT):
+    """Return the ``(w, h)`` a panel asks for, falling back to the defaults."""
+    pos = getattr(panel, 'gridPos', None)
+    if pos is None:
+        return width, height
+    return (
+        pos.w if pos.w is not None else width,
+        pos.h if pos.h is not None else height,
+    )
+
+
+def layout_panels(panels, width=DEFAULT_PANEL_WIDTH, height=DEFAULT_PANEL_HEIGHT,
+                  mode=LAYOUT_COMPACT, top=0, columns=GRID_WIDTH):
+    """Give every panel of a list a ``gridPos``.
+
+    Panels keep the ``w`` and ``h`` of an existing ``gridPos``; panels
+    without one get ``width`` and ``height``. Their ``x`` and ``y`` are always
+    recomputed.
+
+    A ``RowPanel`` starts a new section: it is placed across the whole grid
+    below everything laid out so far, and the panels after it are laid out
+    below it. Panels nested in a ``RowPanel`` (collapsed rows) are laid out in
+    a section of their own, starting right below the row header; since they
+    are hidden, the next panels are placed right below the header too.
+
+    :param panels: list of panels
+    :param width: width of panels without a ``gridPos``
+    :param height: height of panels without a ``gridPos``
+    :param mode: ``LAYOUT_COMPACT`` or ``LAYOUT_FLOW``, see ``Skyline``
+    :param top: grid row to start from
+    :param columns: number of grid columns
+    :returns: a new list of panels
+    """
+    skyline = Skyline(top=top, columns=columns, mode=mode)
+    result = []
+    for panel in panels:
+        if isinstance(panel, RowPanel):
+            y = skyline.bottom
+            children = layout_panels(
+                panel.panels, width=width, height=height, mode=mode,
+                top=y + ROW_PANEL_HEIGHT, columns=columns)
+            panel = attr.evolve(
+                panel,
+                gridPos=GridPos(h=ROW_PANEL_HEIGHT, w=columns, x=0, y=y),
+                panels=children,
+            )
+            next_top = y + ROW_PANEL_HEIGHT
+            if not panel.collapsed:
+                # Children of an expanded row are shown, keep clear of them.
+                next_top = max([next_top] + [c.gridPos.y + c.gridPos.h for c in children])
+            skyline = Skyline(top=next_top, columns=columns, mode=mode)
+        else:
+            w, h = panel_size(panel, width, height)
+            x, y = skyline.place(w, h)
+            panel = attr.evolve(panel, gridPos=GridPos(h=h, w=min(w, columns), x=x, y=y))
+        result.append(panel)
+    return result
+
+
+def auto_layout(dashboard, width=DEFAULT_PANEL_WIDTH, height=DEFAULT_PANEL_HEIGHT,
+                mode=LAYOUT_COMPACT):
+    """Lay out all the panels of a dashboard on the grid.
+
+    Returns a new ``Dashboard`` that is the same as this one, except that
+    every entry of ``panels`` has a computed ``gridPos``. See
+    ``layout_panels`` for the meaning of the parameters.
+    """
+    return attr.evolve(
+        dashboard,
+        panels=layout_panels(dashboard.panels, width=width, height=height, mode=mode),
+    )
+
+
+def grid_height(height):
+    """Convert a legacy row or panel height to grid units.
+
+    :param height: ``Pixels``, a string such as ``'250px'`` or a number of
+        pixels
+    """
+    if isinstance(height, Pixels):
+        height = height.num
+    elif isinstance(height, str):
+        height = int(height.strip().replace('px', ''))
+    height = max(height, MIN_PANEL_HEIGHT)
+    return -(-height // (GRID_CELL_HEIGHT + GRID_CELL_VMARGIN))
+
+
+def _row_shows_title(row):
+    if row.showTitle is not None:
+        return row.showTitle
+    return row.title is not None
+
+
+def rows_to_panels(dashboard):
+    """Convert the legacy ``rows`` of a dashboard to grid positioned ``panels``.
+
+    This does at build time what Grafana's dashboard migrator otherwise does
+    in the browser every time the dashboard is viewed, following the same
+    rules: spans are doubled to grid widths, pixel heights become grid
+    heights, and if any row has a title, is collapsed or repeats, each row
+    becomes a ``RowPanel`` header. The panels of collapsed rows are moved
+    into their ``RowPanel``.
+
+    Returns a new ``Dashboard`` whose ``panels`` replace its ``rows``.
+    Dashboards without rows are returned unchanged.
+    """
+    if not dashboard.rows:
+        return dashboard
+
+    width_factor = GRID_WIDTH // TOTAL_SPAN
+    show_rows = any(
+        row.collapse or row.repeat or _row_shows_title(row)
+        for row in dashboard.rows
+    )
+    panels = []
+    y = 0
+    for row in dashboard.rows:
+        row_height = grid_height(row.height or DEFAULT_ROW_HEIGHT)
+        row_panel = None
+        if show_rows:
+            row_panel = RowPanel(
+                title=row.title or '',
+                collapsed=row.collapse,
+                repeat=Repeat(variable=row.repeat),
+                gridPos=GridPos(h=ROW_PANEL_HEIGHT, w=GRID_WIDTH, x=0, y=y),
+            )
+            panels.append(row_panel)
+            y += ROW_PANEL_HEIGHT
+
+        skyline = Skyline(top=y, mode=LAYOUT_FLOW)
+        children = []
+        for panel in row.panels:
+            w = min(GRID_WIDTH, int(panel.span or LEGACY_PANEL_SPAN) * width_factor)
+            height = getattr(panel, 'height', None)
+            h = grid_height(height) if height else row_height
+            x, panel_y = skyline.place(w, h)
+            changes = {'gridPos': GridPos(h=h, w=w, x=x, y=panel_y), 'span': None}
+            if getattr(panel, 'minSpan', None):
+                changes['minSpan'] = min(GRID_WIDTH, panel.minSpan * width_factor)
+            children.append(attr.evolve(panel, **changes))
+
+        if row_panel is not None and row.collapse:
+            panels[-1] = attr.evolve(row_panel, panels=children)
+        else:
+            panels.extend(children)
+            y = max(skyline.bottom, y + row_height)
+
+    # Dashboard.to_json_data drops ``panels`` when there are rows, so do we.
+    return attr.evolve(dashboard, rows=[], panels=panels)
@@ -0,0 +1,541 @@
+"""Build time passes that make dashboards cheaper to query.
+
+Each pass takes a ``Dashboard`` and returns a new one, so they can be chained
+in a dashboard definition::
+
+    dashboard = optimize.size_queries(dashboard, min_interval='15s')
+
+``apply_cache_policy`` is also run by ``Dashboard.to_json_data`` for
+dashboards with a ``CachePolicy``.
+"""
+
+import fnmatch
+import json
+import math
+import itertools
+import re
+
+import attr
+
+from grafanalib.core import (
+    CACHE_TTL_REFRESH, DASHBOARD_DATASOURCE, BarGauge, DashboardTarget,
+    GaugePanel, GridPos, Panel, PieChartv2, Repeat, RowPanel, SqlTarget,
+    Stat, Target,
+)
+from grafanalib.schema import to_plain_json
+
+# Width in pixels of the screen the dashboards are sized for.
+DEFAULT_SCREEN_WIDTH = 1920
+GRID_WIDTH = 24
+
+DEFAULT_MAX_DATA_POINTS = attr.fields(Panel).maxDataPoints.default
+
+DURATION_UNITS = {
+    'ms': 0.001,
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 24 * 60 * 60,
+    'w': 7 * 24 * 60 * 60,
+    'M': 30 * 24 * 60 * 60,
+    'y': 365 * 24 * 60 * 60,
+}
+
+# Intervals queries are rounded up to, like Grafana rounds $__interval.
+NICE_INTERVALS = [
+    1, 2, 5, 10, 15, 20, 30,
+    60, 2 * 60, 5 * 60, 10 * 60, 15 * 60, 20 * 60, 30 * 60,
+    60 * 60, 2 * 60 * 60, 3 * 60 * 60, 6 * 60 * 60, 12 * 60 * 60,
+    24 * 60 * 60, 7 * 24 * 60 * 60, 30 * 24 * 60 * 60, 365 * 24 * 60 * 60,
+]
+
+# Value of the All option of template variables.
+ALL_VALUE = '$__all'
+
+# Most panels per row of horizontal repeats, when Repeat.maxPerRow is unset.
+DEFAULT_MAX_PER_ROW = 4
+
+# Reducers that only look at the last value of a series.
+INSTANT_REDUCERS = frozenset(['last', 'lastNotNull'])
+
+_DURATION = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*(ms|s|m|h|d|w|M|y)\s*$')
+_RELATIVE_TIME = re.compile(r'^now(?:-(\d+(?:\.\d+)?(?:ms|s|m|h|d|w|M|y)))?(?:/\w+)?$')
+
+
+def parse_duration(text):
+    """Return the number of seconds of a duration such as ``'5m'``.
+
+    :returns: seconds, or ``None`` if ``text`` is not a duration
+    """
+    if not isinstance(text, str):
+        return None
+    match = _DURATION.match(text)
+    if not match:
+        return None
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def format_duration(seconds):
+    """Format a number of seconds as the largest whole duration unit."""
+    for unit in ('y', 'w', 'd', 'h', 'm', 's'):
+        size = DURATION_UNITS[unit]
+        if seconds >= size and seconds % size == 0:
+            return '{}{}'.format(int(seconds // size), unit)
+    return '{}ms'.format(int(round(seconds * 1000)))
+
+
+def _seconds_ago(text):
+    match = _RELATIVE_TIME.match(text) if isinstance(text, str) else None
+    if not match:
+        return None
+    return parse_duration(match.group(1)) if match.group(1) else 0
+
+
+def time_range_seconds(time):
+    """Return the length of a relative ``Time`` range, such as ``now-6h``.
+
+    :returns: seconds, or ``None`` for absolute time ranges
+    """
+    start, end = _seconds_ago(time.start), _seconds_ago(time.end)
+    if start is None or end is None or start <= end:
+        return None
+    return start - end
+
+
+def panel_time_range(panel, dashboard_range):
+    """Return the time range a panel queries, honouring ``timeFrom``."""
+    return parse_duration(getattr(panel, 'timeFrom', None)) or dashboard_range
+
+
+def panel_width(panel):
+    """Return the width of a panel in grid columns, or ``None`` if unknown."""
+    pos = getattr(panel, 'gridPos', None)
+    if pos is not None and pos.w:
+        return min(pos.w, GRID_WIDTH)
+    span = getattr(panel, 'span', None)
+    if span:
+        return min(int(span * 2), GRID_WIDTH)
+    return None
+
+
+def nice_interval(seconds):
+    """Round an interval up to the next interval of ``NICE_INTERVALS``."""
+    for interval in NICE_INTERVALS:
+        if interval >= seconds:
+            return interval
+    return NICE_INTERVALS[-1]
+
+
+def size_queries(dashboard, screen_width=DEFAULT_SCREEN_WIDTH, min_interval=None, overwrite=False):
+    """Size the queries of every panel to the resolution it can draw.
+
+    Each panel gets one data point per pixel of its width on a
+    ``screen_width`` pixels wide screen as ``maxDataPoints``, and the time
+    range of the dashboard (or the ``timeFrom`` of the panel) divided by that
+    as its minimum ``interval``, rounded up to a ``NICE_INTERVALS`` value.
+    Narrow panels thus ask for fewer points, wide ones for more.
+
+    Grafana never queries at a finer interval than the minimum, so zooming
+    into a shorter time range than the dashboard's does not add resolution.
+
+    :param dashboard: a ``Dashboard``
+    :param screen_width: width of the screen in pixels
+    :param min_interval: optional lower bound of the interval, such as the
+        scrape interval of the data, e.g. ``'15s'``
+    :param overwrite: also size panels that set their own ``interval`` or a
+        ``maxDataPoints`` other than the default
+    :returns: a new ``Dashboard``
+    """
+    time_range = time_range_seconds(dashboard.time)
+    floor = parse_duration(min_interval) or 0
+
+    def size(panel):
+        if isinstance(panel, RowPanel) or not getattr(panel, 'targets', None):
+            return panel
+        width = panel_width(panel)
+        if width is None:
+            return panel
+        changes = {}
+        points = max(1, int(math.ceil(screen_width * width / float(GRID_WIDTH))))
+        if overwrite or panel.maxDataPoints == DEFAULT_MAX_DATA_POINTS:
+            changes['maxDataPoints'] = points
+        else:
+            points = panel.maxDataPoints or points
+        seconds = panel_time_range(panel, time_range)
+        if seconds and (overwrite or panel.interval is None):
+            changes['interval'] = format_duration(max(nice_interval(seconds / points), floor))
+        return attr.evolve(panel, **changes) if changes else panel
+
+    return dashboard._map_panels(size)
+
+
+def _datasource_names(panel, default):
+    """Return the datasource names a panel queries."""
+    names = set()
+    for target in panel.targets:
+        datasource = getattr(target, 'datasource', None)
+        if isinstance(datasource, dict):
+            datasource = datasource.get('uid')
+        if datasource:
+            names.add(datasource)
+    if not names:
+        datasource = panel.dataSource
+        if isinstance(datasource, dict):
+            datasource = datasource.get('uid')
+        names.add(datasource or default)
+    return names
+
+
+def _within(value, low, high):
+    if low is None and high is None:
+        return True
+    if value is None:
+        return False
+    return (low is None or value >= parse_duration(low)) and (high is None or value <= parse_duration(high))
+
+
+def _rule_matches(rule, panel, policy, time_range, refresh):
+    if rule.title is not None and not fnmatch.fnmatchcase(panel.title or '', rule.title):
+        return False
+    names = _datasource_names(panel, policy.defaultDatasource)
+    if rule.datasource is not None and not all(
+            name is not None and fnmatch.fnmatchcase(name, rule.datasource) for name in names):
+        return False
+    if rule.datasourceType is not None and not all(
+            policy.datasourceTypes.get(name) == rule.datasourceType for name in names):
+        return False
+    if rule.instant is not None:
+        instant = all(getattr(target, 'instant', False) for target in panel.targets)
+        if instant != rule.instant:
+            return False
+    if not _within(panel_time_range(panel, time_range), rule.minTimeRange, rule.maxTimeRange):
+        return False
+    return _within(refresh, rule.minRefresh, rule.maxRefresh)
+
+
+def apply_cache_policy(dashboard, policy=None):
+    """Give every panel the query cache TTL of its ``CacheRule``.
+
+    Panels that set ``cacheTimeout`` or ``queryCachingTTL`` themselves keep
+    them. Other panels get the TTL of the first rule of the policy that
+    matches them, as ``cacheTimeout`` in seconds and ``queryCachingTTL`` in
+    milliseconds; panels that match no rule, or a rule without TTL, are not
+    cached.
+
+    ``Dashboard.to_json_data`` calls this for dashboards with a
+    ``cachePolicy``.
+
+    :param dashboard: a ``Dashboard``
+    :param policy: a ``CachePolicy``, defaults to the one of the dashboard
+    :returns: a new ``Dashboard``
+    """
+    policy = policy or dashboard.cachePolicy
+    if policy is None:
+        return dashboard
+    time_range = time_range_seconds(dashboard.time)
+    refresh = parse_duration(dashboard.refresh)
+
+    def cache(panel):
+        if isinstance(panel, RowPanel) or not getattr(panel, 'targets', None):
+            return panel
+        if panel.cacheTimeout is not None or panel.queryCachingTTL is not None:
+            return panel
+        for rule in policy.rules:
+            if _rule_matches(rule, panel, policy, time_range, refresh):
+                ttl = refresh if rule.ttl == CACHE_TTL_REFRESH else parse_duration(rule.ttl)
+                if not ttl:
+                    return panel
+                return attr.evolve(
+                    panel, cacheTimeout=str(int(ttl)), queryCachingTTL=int(ttl * 1000))
+        return panel
+
+    return dashboard._map_panels(cache)
+
+
+def _reducers(panel):
+    """Return the reducers of a single value panel, or ``None`` if it needs every value."""
+    if isinstance(panel, Stat):
+        # The sparkline of a stat panel draws the whole range.
+        return None if panel.graphMode != 'none' else [panel.reduceCalc]
+    if isinstance(panel, (GaugePanel, BarGauge)):
+        return None if panel.allValues else [panel.calc]
+    if isinstance(panel, PieChartv2):
+        return None if panel.reduceOptionsValues else panel.reduceOptionsCalcs
+    return None
+
+
+def use_instant_queries(dashboard, prometheus_datasources=None):
+    """Turn the queries of panels that only show the last value into instant queries.
+
+    ``Stat`` (without sparkline), ``GaugePanel``, ``BarGauge`` and
+    ``PieChartv2`` panels whose reducers are all in ``INSTANT_REDUCERS`` only
+    show the last value of each series, yet range queries fetch every sample
+    of the time range. Their Prometheus targets are switched to instant
+    queries, which return one sample per series.
+
+    Panels with other reducers, or showing all values, are left alone. An
+    instant query only looks back as far as Prometheus' lookback delta
+    (5 minutes by default), where ``lastNotNull`` over a range finds older
+    values too.
+
+    :param dashboard: a ``Dashboard``
+    :param prometheus_datasources: optional names of the Prometheus
+        datasources; by default every ``Target`` with an ``expr`` is taken
+        for a Prometheus query
+    :returns: a new ``Dashboard``
+    """
+    if prometheus_datasources is not None:
+        prometheus_datasources = set(prometheus_datasources)
+
+    def is_prometheus(target, panel):
+        if not isinstance(target, Target) or isinstance(target, SqlTarget) or not target.expr:
+            return False
+        if prometheus_datasources is None:
+            return True
+        return (target.datasource or panel.dataSource) in prometheus_datasources
+
+    def instant(panel):
+        reducers = _reducers(panel)
+        if not reducers or not INSTANT_REDUCERS.issuperset(reducers):
+            return panel
+        if not any(is_prometheus(t, panel) and not t.instant for t in panel.targets):
+            return panel
+        return attr.evolve(panel, targets=[
+            attr.evolve(t, instant=True) if is_prometheus(t, panel) else t
+            for t in panel.targets
+        ])
+
+    return dashboard._map_panels(instant)
+
+
+def _query_key(panel):
+    """Return what determines the query results of a panel, or ``None``."""
+    if isinstance(panel, RowPanel) or not getattr(panel, 'targets', None):
+        return None
+    if panel.repeat.variable or panel.dataSource == DASHBOARD_DATASOURCE:
+        return None
+    if getattr(panel, 'alert', None):
+        # Legacy alerts evaluate the targets of their panel themselves.
+        return None
+    queries = []
+    for target in panel.targets:
+        if isinstance(target, DashboardTarget):
+            return None
+        query = to_plain_json(target)
+        if not isinstance(query, dict):
+            return None
+        query.pop('refId', None)
+        query['datasource'] = query.get('datasource') or panel.dataSource
+        queries.append(json.dumps(query, sort_keys=True, default=str))
+    return (
+        json.dumps(panel.dataSource, sort_keys=True, default=str),
+        panel.interval, panel.maxDataPoints, panel.timeFrom, panel.timeShift,
+        tuple(sorted(queries)),
+    )
+
+
+def share_queries(dashboard):
+    """Run queries shared by several panels only once.
+
+    Panels whose targets are the same as those of an earlier panel, with the
+    same datasource, interval, ``maxDataPoints`` and time overrides, so
+    querying at the same resolution over the same range, are rewritten to show the
+    results of that panel through Grafana's ``-- Dashboard --`` datasource
+    instead of querying again. Only ``refId`` may differ between the targets.
+
+    Only the top level ``panels`` are considered: the source of a shared
+    query has to be rendered for the panels using it to get data, which is
+    not the case in collapsed rows. Repeated panels are left alone too, and
+    so are panels with a legacy ``alert``, whose conditions need queries the
+    alerting engine can run.
+    Panels get ids with ``Dashboard.auto_panel_ids`` if any query is shared.
+
+    :param dashboard: a ``Dashboard``
+    :returns: a new ``Dashboard``
+    """
+    keys = [_query_key(panel) for panel in dashboard.panels]
+    shared = [key for key in keys if key is not None]
+    if len(set(shared)) == len(shared):
+        return dashboard
+
+    dashboard = dashboard.auto_panel_ids()
+    sources = {}
+    panels = []
+    for key, panel in zip(keys, dashboard.panels):
+        source = sources.setdefault(key, panel) if key is not None else panel
+        if source is not panel:
+            panel = attr.evolve(
+                panel,
+                dataSource=DASHBOARD_DATASOURCE,
+                targets=[DashboardTarget(panelId=source.id)],
+            )
+        panels.append(panel)
+    return attr.evolve(dashboard, panels=panels)
+
+
+def template_values(template):
+    """Return the selected values of a custom or constant template.
+
+    The values selected by default are the ones a dashboard opens with: all
+    options when the All option is the default, the ``selected`` options
+    otherwise, or the first option if none is.
+
+    :param template: a ``Template``
+    :returns: list of values, or ``None`` for templates whose values are
+        only known when the dashboard is viewed
+    """
+    if template.type == 'constant':
+        return [template.query]
+    if template.type != 'custom':
+        return None
+    options = template.options
+    values = [option['value'] for option in options]
+    if template.includeAll and template.default in (ALL_VALUE, 'All'):
+        return values
+    selected = [option['value'] for option in options if option.get('selected')]
+    return selected or values[:1]
+
+
+def substitute(text, name, value):
+    """Replace the references to variable ``name`` in ``text`` by ``value``.
+
+    ``$name``, ``${name}``, ``${name:format}`` and ``[[name]]`` are
+    replaced; the ``regex`` format escapes ``value``, other formats are the
+    same for a single value.
+    """
+    pattern = re.compile(
+        r'\$\{%(name)s(?::(\w+))?\}|\[\[%(name)s(?::(\w+))?\]\]|\$%(name)s\b' % {'name': re.escape(name)})
+
+    def replace(match):
+        fmt = match.group(1) or match.group(2)
+        return re.escape(value) if fmt == 'regex' else value
+    return pattern.sub(replace, text)
+
+
+def _substitute_all(obj, name, value):
+    """Substitute ``name`` in every string of a target, dict or list."""
+    if isinstance(obj, str):
+        return substitute(obj, name, value)
+    if isinstance(obj, dict):
+        return {k: _substitute_all(v, name, value) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_substitute_all(v, name, value) for v in obj]
+    if attr.has(type(obj)):
+        changes = {}
+        for field in attr.fields(type(obj)):
+            if not field.init or field.name.startswith('_'):
+                continue
+            current = getattr(obj, field.name)
+            if isinstance(current, (str, dict, list)) or attr.has(type(current)):
+                new = _substitute_all(current, name, value)
+                if new != current:
+                    changes[field.name] = new
+        return attr.evolve(obj, **changes) if changes else obj
+    return obj
+
+
+def _repeat_positions(pos, count, repeat):
+    """Return the ``GridPos`` of each copy and the bottom of the copies."""
+    if pos is None:
+        return [None] * count, None
+    positions = []
+    if repeat.direction == 'v':
+        y = pos.y
+        for _ in range(count):
+            positions.append(GridPos(h=pos.h, w=pos.w, x=pos.x, y=y))
+            y += pos.h
+        return positions, y
+    per_row = repeat.maxPerRow or DEFAULT_MAX_PER_ROW
+    w = max(GRID_WIDTH // count, GRID_WIDTH // per_row)
+    x, y = 0, pos.y
+    for _ in range(count):
+        positions.append(GridPos(h=pos.h, w=w, x=x, y=y))
+        x += w
+        if x + w > GRID_WIDTH:
+            x, y = 0, y + pos.h
+    return positions, y + pos.h if x else y
+
+
+def _ends_below(panel, y):
+    """Whether a panel reaches further down than ``y``."""
+    pos = panel.gridPos
+    return pos is not None and pos.y is not None and pos.y + (pos.h or 0) > y
+
+
+def _shift(panel, below, extra):
+    """Move a panel down by ``extra`` if it reaches further down than
+    ``below``, with the panels of a row."""
+    if not _ends_below(panel, below):
+        return panel
+    changes = {'gridPos': attr.evolve(panel.gridPos, y=panel.gridPos.y + extra)}
+    if isinstance(panel, RowPanel):
+        changes['panels'] = [_shift(child, -1, extra) for child in panel.panels]
+    return attr.evolve(panel, **changes)
+
+
+def expand_repeats(dashboard, max_repeats=None):
+    """Replace repeated panels by one copy per value, at build time.
+
+    Top level panels repeating over a custom or constant template are
+    replaced by one copy for each value selected by default (see
+    ``template_values``), laid out the way Grafana lays out repeats. The
+    references to the variable in the title and targets of each copy are
+    replaced by its value, and the panels below are moved down to make
+    room, as are the panels beside horizontally repeated ones. The first copy keeps the id of the panel; the other copies, and
+    the first one if the panel has no id, get ids above the largest id of
+    the dashboard, so they cannot clash with the ids of other panels.
+
+    The copies no longer follow the variable: changing its value in the
+    browser does not change them. Panels repeating over other variables
+    are left for Grafana to repeat.
+
+    :param dashboard: a ``Dashboard``
+    :param max_repeats: optional most copies per panel; further values are
+        dropped
+    :returns: a new ``Dashboard``
+    """
+    templates = {
+        getattr(t, 'name', None): t for t in dashboard.templating.list
+        if not isinstance(t, dict)
+    }
+    ids = [getattr(p, 'id', None) for p in dashboard._iter_panels()]
+    new_ids = itertools.count(max([i for i in ids if isinstance(i, int)] or [0]) + 1)
+    panels = list(dashboard.panels)
+    result = []
+    for index in range(len(panels)):
+        panel = panels[index]
+        repeat = getattr(panel, 'repeat', None)
+        variable = repeat.variable if repeat and not isinstance(panel, RowPanel) else None
+        template = templates.get((variable or '').lstrip('$'))
+        values = template_values(template) if template is not None else None
+        if not values:
+            result.append(panel)
+            continue
+        if max_repeats is not None:
+            values = values[:max_repeats]
+
+        name = template.name
+        positions, bottom = _repeat_positions(panel.gridPos, len(values), panel.repeat)
+        if bottom is not None:
+            # Vertical copies stay in the columns of the panel, so only what
+            # is below it moves. Horizontal copies take the whole width, so
+            # the panels beside it move below them too.
+            below = top = panel.gridPos.y + panel.gridPos.h
+            if panel.repeat.direction != 'v':
+                below = panel.gridPos.y
+                top = min([p.gridPos.y for p in result + panels[index + 1:] if _ends_below(p, below)] + [top])
+            extra = max(bottom - top, 0)
+            if extra:
+                result = [_shift(p, below, extra) for p in result]
+                panels[index + 1:] = [_shift(p, below, extra) for p in panels[index + 1:]]
+        for i, (value, pos) in enumerate(zip(values, positions)):
+            value = str(value)
+            result.append(attr.evolve(
+                panel,
+                id=panel.id if i == 0 and panel.id is not None else next(new_ids),
+                title=substitute(panel.title or '', name, value),
+                targets=[_substitute_all(t, name, value) for t in panel.targets],
+                gridPos=pos,
+                repeat=Repeat(),
+            ))
+    return attr.evolve(dashboard, panels=result)
@@ -1,38 +1,696 @@
-"""Helpers for Prometheus-driven graphs."""
+"""Helpers for Prometheus-driven graphs, and PromQL expressions.
 
-import string
+Expressions can be built with ``selector``, ``rate``, ``aggregate``, ``call``
+and ``binary``, or read from text with ``parse``. Either way they are trees of
+``Expr`` nodes that render to canonical PromQL text, and can be used as
+``Target.expr``. Equal sub-expressions are interned, so the same query
+written in different panels ends up as the same object and the same text.
+"""
+
+import math
+import re
+import weakref
+
+import attr
+from attr.validators import in_, instance_of
 
 import grafanalib.core as G
 
 
-def PromGraph(data_source, title, expressions, **kwargs):
+def PromGraph(data_source, title, expressions, stable_ref_ids=False, **kwargs):
     """Create a graph that renders Prometheus data.
 
     :param str data_source: The name of the data source that provides
         Prometheus data.
     :param title: The title of the graph.
     :param expressions: List of tuples of (legend, expr), where 'expr' is a
-        Prometheus expression. Or a list of dict where keys are Target's args.
+        Prometheus expression, as text or an ``Expr``. Or a list of dict where
+        keys are Target's args. Targets without a refId get one, see
+        ``Panel.auto_ref_ids``.
+    :param stable_ref_ids: Derive refIds from the expressions rather than
+        their position.
     :param kwargs: Passed on to Graph.
     """
-    letters = string.ascii_uppercase
     expressions = list(expressions)
-    if len(expressions) > len(letters):
-        raise ValueError(
-            'Too many expressions. Can support at most {}, but got {}'.format(
-                len(letters), len(expressions)))
-
     if all(isinstance(expr, dict) for expr in expressions):
-        targets = [
-            G.Target(refId=refId, **args)
-            for (args, refId) in zip(expressions, letters)]
+        targets = [G.Target(**args) for args in expressions]
     else:
         targets = [
-            G.Target(expr=expr, legendFormat=legend, refId=refId)
-            for ((legend, expr), refId) in zip(expressions, letters)]
+            G.Target(expr=expr, legendFormat=legend)
+            for (legend, expr) in expressions]
     return G.Graph(
         title=title,
         dataSource=data_source,
         targets=targets,
         **kwargs
-    )
+    ).auto_ref_ids(stable=stable_ref_ids)
+
+
+"""
+PromQL expressions
+"""
+
+# Operators by precedence, lowest first.
+BINARY_PRECEDENCE = {
+    'or': 1,
+    'and': 2, 'unless': 2,
+    '==': 3, '!=': 3, '<=': 3, '<': 3, '>=': 3, '>': 3,
+    '+': 4, '-': 4,
+    '*': 5, '/': 5, '%': 5, 'atan2': 5,
+    '^': 6,
+}
+COMPARISON_OPERATORS = ('==', '!=', '<=', '<', '>=', '>')
+SET_OPERATORS = ('and', 'or', 'unless')
+MATCH_OPERATORS = ('=', '!=', '=~', '!~')
+
+AGGREGATIONS = (
+    'sum', 'min', 'max', 'avg', 'group', 'stddev', 'stdvar', 'count',
+    'count_values', 'bottomk', 'topk', 'quantile', 'limitk', 'limit_ratio',
+)
+PARAMETER_AGGREGATIONS = ('count_values', 'bottomk', 'topk', 'quantile', 'limitk', 'limit_ratio')
+
+DURATION_UNITS = (
+    ('y', 365 * 24 * 3600 * 1000), ('w', 7 * 24 * 3600 * 1000), ('d', 24 * 3600 * 1000),
+    ('h', 3600 * 1000), ('m', 60 * 1000), ('s', 1000), ('ms', 1),
+)
+
+# Interned nodes by their type and fields, which hold their children but not
+# the node itself: a node is dropped from the table once nothing else uses it.
+_interned = weakref.WeakValueDictionary()
+
+
+def intern(node):
+    """Return the one instance of the expressions equal to ``node``.
+
+    The builders and ``parse`` intern every node they create, so equal
+    sub-expressions are shared, compare by identity and are rendered once.
+    Nodes are only kept while they are in use.
+    """
+    key = (type(node),) + tuple(getattr(node, field.name) for field in attr.fields(type(node)))
+    return _interned.setdefault(key, node)
+
+
+# Rendered text of nodes, kept while the nodes are in use.
+_rendered = weakref.WeakKeyDictionary()
+
+
+def render(node):
+    """Return the canonical PromQL text of an expression."""
+    text = _rendered.get(node)
+    if text is None:
+        text = _rendered[node] = node._render()
+    return text
+
+
+class Expr(object):
+    """Base of PromQL expression nodes.
+
+    Nodes render to canonical PromQL with ``str()``, and as their JSON data,
+    so they can be used as ``Target.expr``.
+    """
+
+    def __str__(self):
+        return render(self)
+
+    def to_json_data(self):
+        return render(self)
+
+
+def _escape(value):
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+
+def duration_ms(text):
+    """Return the milliseconds of a PromQL duration such as ``1h30m``,
+    ``None`` if it is not one."""
+    if not re.match(r'^(\d+(ms|[smhdwy]))+$', text):
+        return None
+    units = dict(DURATION_UNITS)
+    return sum(int(n) * units[unit] for n, unit in re.findall(r'(\d+)(ms|[smhdwy])', text))
+
+
+def normalize_duration(text):
+    """Return a duration in its canonical form, ``90s`` becoming ``1m30s``.
+
+    Grafana variables such as ``$__rate_interval`` are kept as they are.
+    """
+    if text is None:
+        return None
+    sign = ''
+    if text.startswith('-'):
+        sign, text = '-', text[1:]
+    ms = duration_ms(text)
+    if ms is None:
+        return sign + text
+    if ms == 0:
+        return '0s'
+    parts = []
+    for unit, size in DURATION_UNITS:
+        if ms >= size:
+            parts.append('{}{}'.format(ms // size, unit))
+            ms %= size
+    return sign + ''.join(parts)
+
+
+def _labels(labels):
+    return tuple(sorted(set(labels))) if labels is not None else None
+
+
+@attr.s(frozen=True, cache_hash=True)
+class Matcher(object):
+    """A label matcher of a selector.
+
+    :param label: label name
+    :param op: one of ``MATCH_OPERATORS``
+    :param value: value or regex to match
+    """
+
+    label = attr.ib(validator=instance_of(str))
+    op = attr.ib(validator=in_(MATCH_OPERATORS))
+    value = attr.ib(validator=instance_of(str))
+
+    def _render(self):
+        return '{}{}{}'.format(self.label, self.op, _escape(self.value))
+
+
+@attr.s(frozen=True, cache_hash=True)
+class Selector(Expr):
+    """An instant or range vector selector, ``metric{matchers}[range]``.
+
+    :param metric: metric name, ``None`` to select by matchers only
+    :param matchers: tuple of ``Matcher``, rendered sorted
+    :param range: range of a range vector selector, such as ``5m``
+    :param offset: offset modifier, such as ``1h``
+    :param at: ``@`` modifier, a timestamp, ``start()`` or ``end()``
+    """
+
+    metric = attr.ib(default=None)
+    matchers = attr.ib(default=(), converter=lambda ms: tuple(sorted(set(ms), key=attr.astuple)))
+    range = attr.ib(default=None, converter=normalize_duration)
+    offset = attr.ib(default=None, converter=normalize_duration)
+    at = attr.ib(default=None)
+
+    def _render(self):
+        text = self.metric or ''
+        if self.matchers or not text:
+            text += '{' + ','.join(render(m) for m in self.matchers) + '}'
+        if self.range is not None:
+            text += '[{}]'.format(self.range)
+        return text + _modifiers(self)
+
+    def over(self, range):
+        """Return this selector as a range vector selector over ``range``."""
+        return intern(attr.evolve(self, range=range))
+
+
+@attr.s(frozen=True, cache_hash=True)
+class Subquery(Expr):
+    """A subquery, ``expr[range:step]``."""
+
+    expr = attr.ib()
+    range = attr.ib(converter=normalize_duration)
+    step = attr.ib(default=None, converter=normalize_duration)
+    offset = attr.ib(default=None, converter=normalize_duration)
+    at = attr.ib(default=None)
+
+    def _render(self):
+        return '{}[{}:{}]{}'.format(
+            _operand(self.expr, BINARY_PRECEDENCE['^'] + 2), self.range, self.step or '', _modifiers(self))
+
+
+def _modifiers(node):
+    text = ''
+    if node.offset is not None:
+        text += ' offset {}'.format(node.offset)
+    if node.at is not None:
+        text += ' @ {}'.format(node.at)
+    return text
+
+
+@attr.s(frozen=True, cache_hash=True)
+class Number(Expr):
+    """A number literal."""
+
+    value = attr.ib(converter=float)
+
+    def _render(self):
+        if math.isnan(self.value):
+            return 'NaN'
+        if math.isinf(self.value):
+            return 'Inf' if self.value > 0 else '-Inf'
+        if self.value == int(self.value) and abs(self.value) < 1e15:
+            return str(int(self.value))
+        return repr(self.value)
+
+
+@attr.s(frozen=True, cache_hash=True)
+class String(Expr):
+    """A string literal."""
+
+    value = attr.ib(validator=instance_of(str))
+
+    def _render(self):
+        return _escape(self.value)
+
+
+@attr.s(frozen=True, cache_hash=True)
+class Raw(Expr):
+    """Text kept as it is, such as a Grafana variable standing for a
+    number or an expression."""
+
+    text = attr.ib(validator=instance_of(str))
+
+    def _render(self):
+        return self.text
+
+
+@attr.s(frozen=True, cache_hash=True)
+class Call(Expr):
+    """A function call, ``name(args)``."""
+
+    name = attr.ib(validator=instance_of(str))
+    args = attr.ib(default=(), converter=tuple)
+
+    def _render(self):
+        return '{}({})'.format(self.name, ', '.join(render(a) for a in self.args))
+
+
+@attr.s(frozen=True, cache_hash=True)
+class Aggregation(Expr):
+    """An aggregation, ``op by (labels) ([param, ]expr)``.
+
+    :param op: one of ``AGGREGATIONS``
+    :param expr: the aggregated expression
+    :param by: labels to keep, rendered sorted
+    :param without: labels to drop, rendered sorted
+    :param param: parameter of ``topk``, ``quantile``, ...
+    """
+
+    op = attr.ib(validator=in_(AGGREGATIONS))
+    expr = attr.ib()
+    by = attr.ib(default=None, converter=_labels)
+    without = attr.ib(default=None, converter=_labels)
+    param = attr.ib(default=None)
+
+    def _render(self):
+        text = self.op
+        if self.by is not None:
+            text += ' by ({})'.format(', '.join(self.by))
+        if self.without is not None:
+            text += ' without ({})'.format(', '.join(self.without))
+        args = [self.expr] if self.param is None else [self.param, self.expr]
+        return '{} ({})'.format(text, ', '.join(render(a) for a in args))
+
+
+@attr.s(frozen=True, cache_hash=True)
+class Binary(Expr):
+    """A binary operation, ``lhs op rhs``.
+
+    :param op: one of ``BINARY_PRECEDENCE``
+    :param on: labels to match on
+    :param ignoring: labels to ignore when matching
+    :param group_left: labels to include from the right hand side, for
+        many-to-one matching, ``()`` for none
+    :param group_right: same for one-to-many matching
+    :param bool: whether a comparison returns 0 or 1 instead of filtering
+    """
+
+    op = attr.ib(validator=in_(list(BINARY_PRECEDENCE)))
+    lhs = attr.ib()
+    rhs = attr.ib()
+    on = attr.ib(default=None, converter=_labels)
+    ignoring = attr.ib(default=None, converter=_labels)
+    group_left = attr.ib(default=None, converter=_labels)
+    group_right = attr.ib(default=None, converter=_labels)
+    bool = attr.ib(default=False, validator=instance_of(bool))
+
+    def _render(self):
+        precedence = BINARY_PRECEDENCE[self.op]
+        right_assoc = self.op == '^'
+        lhs = _operand(self.lhs, precedence + (1 if right_assoc else 0))
+        rhs = _operand(self.rhs, precedence + (0 if right_assoc else 1))
+        op = self.op
+        if self.bool:
+            op += ' bool'
+        for keyword in ('on', 'ignoring', 'group_left', 'group_right'):
+            labels = getattr(self, keyword)
+            if labels is not None:
+                op += ' {} ({})'.format(keyword, ', '.join(labels))
+        return '{} {} {}'.format(lhs, op, rhs)
+
+
+@attr.s(frozen=True, cache_hash=True)
+class Unary(Expr):
+    """A unary minus or plus."""
+
+    op = attr.ib(validator=in_(('-', '+')))
+    expr = attr.ib()
+
+    def _render(self):
+        return self.op + _operand(self.expr, BINARY_PRECEDENCE['^'])
+
+
+def _operand(node, min_precedence):
+    """Render ``node``, in parentheses if it binds less than ``min_precedence``."""
+    if isinstance(node, Binary) and BINARY_PRECEDENCE[node.op] < min_precedence:
+        return '({})'.format(render(node))
+    if isinstance(node, Unary) and min_precedence > BINARY_PRECEDENCE['^']:
+        return '({})'.format(render(node))
+    return render(node)
+
+
+def _expr(value):
+    """Turn numbers into ``Number`` and strings into parsed expressions."""
+    if isinstance(value, Expr):
+        return value
+    if isinstance(value, (int, float)):
+        return intern(Number(value))
+    return parse(value)
+
+
+def selector(metric=None, *matchers, **labels):
+    """Build a selector.
+
+    :param metric: metric name
+    :param matchers: ``Matcher`` objects, or ``(label, op, value)`` tuples
+    :param labels: labels to match exactly
+    """
+    matchers = [m if isinstance(m, Matcher) else Matcher(*m) for m in matchers]
+    matchers += [Matcher(label, '=', value) for label, value in labels.items()]
+    return intern(Selector(metric=metric, matchers=[intern(m) for m in matchers]))
+
+
+def call(name, *args):
+    """Build a function call."""
+    return intern(Call(name, [_expr(a) for a in args]))
+
+
+def rate(expr, range='$__rate_interval', name='rate'):
+    """Build ``rate(expr[range])``, or another range function with ``name``."""
+    expr = _expr(expr)
+    if isinstance(expr, Selector):
+        expr = expr.over(range)
+    else:
+        expr = intern(Subquery(expr, range))
+    return call(name, expr)
+
+
+def aggregate(op, expr, by=None, without=None, param=None):
+    """Build an aggregation."""
+    if param is not None:
+        param = _expr(param) if not isinstance(param, str) else intern(String(param))
+    return intern(Aggregation(op, _expr(expr), by=by, without=without, param=param))
+
+
+def binary(op, lhs, rhs, **modifiers):
+    """Build a binary operation; ``modifiers`` are the ones of ``Binary``."""
+    return intern(Binary(op, _expr(lhs), _expr(rhs), **modifiers))
+
+
+def iter_nodes(node):
+    """Yield an expression and all its sub-expressions, depth first."""
+    yield node
+    for field in attr.fields(type(node)):
+        value = getattr(node, field.name)
+        children = value if isinstance(value, tuple) else (value,)
+        for child in children:
+            if isinstance(child, Expr):
+                for descendant in iter_nodes(child):
+                    yield descendant
+
+
+"""
+PromQL parser
+"""
+
+
+class ParseError(ValueError):
+    """Raised for expressions ``parse`` cannot read."""
+
+
+_TOKEN = re.compile(r'''
+    (?P<space>\s+|\#[^\n]*)
+  | (?P<variable>\$\{[^}]+\}|\$\w+|\[\[\w+(?::\w+)?\]\])
+  | (?P<duration>(?:\d+(?:ms|[smhdwy]))+(?![\w.]))
+  | (?P<number>0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|(?i:inf|nan)(?![\w:]))
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|`[^`]*`)
+  | (?P<ident>[a-zA-Z_][\w:]*)
+  | (?P<op>==|!=|<=|>=|=~|!~|[-+*/%^<>=(){}\[\],:@])
+''', re.X)
+
+_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '\\': '\\', '"': '"', "'": "'"}
+
+
+def _unquote(text):
+    if text[0] == '`':
+        return text[1:-1]
+    return re.sub(r'\\(.)', lambda m: _ESCAPES.get(m.group(1), '\\' + m.group(1)), text[1:-1])
+
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if not match:
+            raise ParseError('Unexpected {!r} at {} in {!r}'.format(text[pos], pos, text))
+        if match.lastgroup != 'space':
+            tokens.append((match.lastgroup, match.group()))
+        pos = match.end()
+    tokens.append(('end', ''))
+    return tokens
+
+
+class _Parser(object):
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def error(self, expected):
+        kind, value = self.peek()
+        raise ParseError('Expected {} but got {!r} in {!r}'.format(expected, value or 'the end', self.text))
+
+    def expect(self, value):
+        if self.peek()[1] != value:
+            self.error(repr(value))
+        return self.next()
+
+    def accept(self, value):
+        if self.peek()[1] == value:
+            self.next()
+            return True
+        return False
+
+    def parse(self):
+        node = self.expression(0)
+        if self.peek()[0] != 'end':
+            self.error('the end')
+        return node
+
+    def binary_op(self):
+        kind, value = self.peek()
+        if (kind == 'op' or kind == 'ident') and value in BINARY_PRECEDENCE:
+            return value
+        return None
+
+    def expression(self, min_precedence):
+        lhs = self.unary()
+        while True:
+            op = self.binary_op()
+            if op is None or BINARY_PRECEDENCE[op] < min_precedence:
+                return lhs
+            self.next()
+            modifiers = {}
+            if self.accept('bool'):
+                modifiers['bool'] = True
+            for keyword in ('on', 'ignoring'):
+                if self.accept(keyword):
+                    modifiers[keyword] = self.label_list()
+            for keyword in ('group_left', 'group_right'):
+                if self.accept(keyword):
+                    modifiers[keyword] = self.label_list() if self.peek()[1] == '(' else ()
+            precedence = BINARY_PRECEDENCE[op]
+            rhs = self.expression(precedence if op == '^' else precedence + 1)
+            lhs = intern(Binary(op, lhs, rhs, **modifiers))
+
+    def unary(self):
+        if self.peek()[1] in ('-', '+'):
+            op = self.next()[1]
+            return intern(Unary(op, self.expression(BINARY_PRECEDENCE['^'])))
+        return self.postfix(self.primary())
+
+    def postfix(self, node):
+        while True:
+            if self.peek()[1] == '[':
+                self.next()
+                range = self.duration()
+                if self.accept(':'):
+                    step = None if self.peek()[1] == ']' else self.duration()
+                    self.expect(']')
+                    node = intern(Subquery(node, range, step))
+                elif isinstance(node, Selector) and node.range is None:
+                    self.expect(']')
+                    node = intern(attr.evolve(node, range=range))
+                else:
+                    self.error("':'")
+            elif self.peek()[1] == 'offset' and isinstance(node, (Selector, Subquery)):
+                self.next()
+                sign = '-' if self.accept('-') else ''
+                node = intern(attr.evolve(node, offset=sign + self.duration()))
+            elif self.peek()[1] == '@' and isinstance(node, (Selector, Subquery)):
+                self.next()
+                kind, value = self.next()
+                if kind == 'ident' and self.peek()[1] == '(':
+                    self.expect('(')
+                    self.expect(')')
+                    value += '()'
+                node = intern(attr.evolve(node, at=value))
+            else:
+                return node
+
+    def duration(self):
+        kind, value = self.next()
+        if kind in ('duration', 'variable'):
+            return value
+        if kind == 'number' and value.isdigit():
+            return value + 's'
+        self.pos -= 1
+        self.error('a duration')
+
+    def label_list(self):
+        self.expect('(')
+        labels = []
+        while not self.accept(')'):
+            kind, value = self.next()
+            if kind not in ('ident', 'variable'):
+                self.pos -= 1
+                self.error('a label name')
+            labels.append(value)
+            if not self.accept(','):
+                self.expect(')')
+                break
+        return labels
+
+    def matchers(self):
+        self.expect('{')
+        matchers = []
+        while not self.accept('}'):
+            label_kind, label = self.next()
+            if label_kind not in ('ident', 'string'):
+                self.pos -= 1
+                self.error('a label name')
+            if label_kind == 'string':
+                label = _unquote(label)
+            op = self.next()[1]
+            if op not in MATCH_OPERATORS:
+                self.pos -= 1
+                self.error('a label matcher')
+            kind, value = self.next()
+            if kind != 'string':
+                self.pos -= 1
+                self.error('a string')
+            matchers.append(intern(Matcher(label, op, _unquote(value))))
+            if not self.accept(','):
+                self.expect('}')
+                break
+        return matchers
+
+    def primary(self):
+        kind, value = self.peek()
+        if kind == 'number':
+            self.next()
+            return intern(Number(int(value, 16) if value.lower().startswith('0x') else value))
+        if kind == 'string':
+            self.next()
+            return intern(String(_unquote(value)))
+        if kind == 'variable':
+            self.next()
+            if self.peek()[1] == '{':
+                return self.selector(value)
+            return intern(Raw(value))
+        if value == '(':
+            self.next()
+            node = self.expression(0)
+            self.expect(')')
+            return node
+        if value == '{':
+            return self.selector(None)
+        if kind == 'ident':
+            self.next()
+            if value in AGGREGATIONS and self.peek()[1] in ('(', 'by', 'without'):
+                return self.aggregation(value)
+            if self.peek()[1] == '(':
+                return self.call(value)
+            return self.selector(value)
+        self.error('an expression')
+
+    def selector(self, metric):
+        matchers = self.matchers() if self.peek()[1] == '{' else []
+        names = [m for m in matchers if m.label == '__name__' and m.op == '=']
+        if metric is None and names:
+            metric = names[0].value
+            matchers.remove(names[0])
+        return intern(Selector(metric=metric, matchers=matchers))
+
+    def arguments(self):
+        self.expect('(')
+        args = []
+        while not self.accept(')'):
+            args.append(self.expression(0))
+            if not self.accept(','):
+                self.expect(')')
+                break
+        return args
+
+    def call(self, name):
+        return intern(Call(name, self.arguments()))
+
+    def grouping(self, modifiers):
+        for keyword in ('by', 'without'):
+            if self.accept(keyword):
+                modifiers[keyword] = self.label_list()
+
+    def aggregation(self, op):
+        modifiers = {}
+        self.grouping(modifiers)
+        args = self.arguments()
+        self.grouping(modifiers)
+        if op in PARAMETER_AGGREGATIONS and len(args) == 2:
+            modifiers['param'] = args.pop(0)
+        elif op in PARAMETER_AGGREGATIONS:
+            args = []
+        if len(args) != 1:
+            raise ParseError('{} takes {} arguments in {!r}'.format(
+                op, 2 if op in PARAMETER_AGGREGATIONS else 1, self.text))
+        return intern(Aggregation(op, args[0], **modifiers))
+
+
+def parse(text):
+    """Parse a PromQL expression.
+
+    Grafana variables are kept: in durations, label values, label lists,
+    metric names and as whole operands, such as
+    ``sum by ($group) ($metric{job="api"}[$__rate_interval]) > $threshold``.
+
+    :raises ParseError: if ``text`` is not a PromQL expression
+    """
+    return _Parser(text).parse()
+
+
+def normalize(text):
+    """Return the canonical text of a PromQL expression.
+
+    Equal expressions written differently, with other spacing, matcher or
+    label order, or durations, get the same text.
+    """
+    return render(parse(text))
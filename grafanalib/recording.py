@@ -0,0 +1,239 @@
+"""Recording rules for PromQL aggregations repeated across dashboards.
+
+The same ``sum by (job) (rate(x[5m]))`` often appears in many targets, and
+Prometheus evaluates it again for every panel on every load. ``find_rules``
+ranks the aggregations of rates found in the targets of dashboards and alert
+rules by how many targets use them, and names a recording rule for each.
+``rules_yaml`` writes them as a Prometheus rules file, and
+``rewrite_dashboard`` makes the targets read the recorded series instead.
+
+Only aggregations of range functions over fixed ranges, without Grafana
+variables, can be recorded: Prometheus evaluates rules without knowing what
+is selected on a dashboard.
+"""
+
+import collections
+import hashlib
+import json
+import re
+
+import attr
+from attr.validators import instance_of
+
+from grafanalib.core import PLUGIN_ID_PROMETHEUS, AlertGroup, Dashboard, RowPanel, Target
+from grafanalib.prometheus import (
+    Aggregation, Call, Expr, ParseError, Raw, Selector, Subquery, intern,
+    iter_nodes, parse, render,
+)
+
+# Functions whose cost grows with the range they look over.
+RANGE_FUNCTIONS = (
+    'rate', 'irate', 'increase', 'delta', 'idelta', 'deriv', 'changes', 'resets',
+    'avg_over_time', 'min_over_time', 'max_over_time', 'sum_over_time',
+    'count_over_time', 'quantile_over_time', 'stddev_over_time', 'stdvar_over_time',
+    'last_over_time', 'present_over_time',
+)
+
+DEFAULT_GROUP_NAME = 'grafanalib'
+DEFAULT_INTERVAL = '1m'
+DEFAULT_MIN_COUNT = 2
+
+
+@attr.s
+class RecordingRule(object):
+    """A recording rule and how many targets use its expression.
+
+    :param record: name of the recorded series
+    :param expr: the recorded ``Expr``
+    :param count: number of targets using the expression
+    """
+
+    record = attr.ib(validator=instance_of(str))
+    expr = attr.ib()
+    count = attr.ib(default=0, validator=instance_of(int))
+
+
+def iter_targets(obj):
+    """Yield the targets of a dashboard or alert group."""
+    if isinstance(obj, Dashboard):
+        for panel in obj._iter_panels():
+            for target in getattr(panel, 'targets', None) or []:
+                yield target
+    elif isinstance(obj, AlertGroup):
+        for rule in obj.rules:
+            for trigger in getattr(rule, 'triggers', None) or []:
+                yield trigger[0] if isinstance(trigger, tuple) else trigger
+
+
+def _promql(target):
+    """Return the PromQL of a target, as text or an ``Expr``, ``None`` if
+    it has none."""
+    if not isinstance(target, Target) or not target.expr:
+        return None
+    if isinstance(target.datasource, dict) and target.datasource.get('type', PLUGIN_ID_PROMETHEUS) != PLUGIN_ID_PROMETHEUS:
+        return None
+    return target.expr
+
+
+def target_expr(target):
+    """Return the parsed PromQL of a target, ``None`` if it has none.
+
+    Targets whose datasource is given with a type other than Prometheus,
+    such as ``{'type': 'loki', 'uid': 'logs'}``, have none: their ``expr``
+    is in another query language.
+    """
+    expr = _promql(target)
+    if not isinstance(expr, str):
+        return expr
+    try:
+        return parse(expr)
+    except ParseError:
+        return None
+
+
+def unparsed_expr(target):
+    """Return the PromQL text of a target ``parse`` cannot read, ``None``
+    if it has none or it can be read."""
+    expr = _promql(target)
+    if isinstance(expr, str) and target_expr(target) is None:
+        return expr
+    return None
+
+
+def _has_variables(node):
+    for child in iter_nodes(node):
+        if isinstance(child, Raw):
+            return True
+        if isinstance(child, Selector):
+            texts = [m.value for m in child.matchers] + [child.range or '', child.offset or '']
+        elif isinstance(child, Subquery):
+            texts = [child.range, child.step or '', child.offset or '']
+        else:
+            continue
+        if any('$' in text or '[[' in text for text in texts):
+            return True
+    return False
+
+
+def is_recordable(node):
+    """Whether ``node`` is an aggregation over a range function worth
+    recording, without Grafana variables."""
+    if not isinstance(node, Aggregation):
+        return False
+    if not any(isinstance(n, Call) and n.name in RANGE_FUNCTIONS for n in iter_nodes(node)):
+        return False
+    return not _has_variables(node)
+
+
+def rule_name(node):
+    """Return a ``level:metric:operations`` name for recording ``node``.
+
+    ``sum by (job) (rate(http_requests_total[5m]))`` is recorded as
+    ``job:http_requests_total:rate5m``.
+    """
+    if node.by:
+        level = '_'.join(node.by)
+    elif node.without:
+        level = 'without_' + '_'.join(node.without)
+    else:
+        level = 'all'
+    nodes = list(iter_nodes(node))
+    metrics = [n.metric for n in nodes if isinstance(n, Selector) and n.metric]
+    calls = [n for n in nodes if isinstance(n, Call) and n.name in RANGE_FUNCTIONS]
+    operations = []
+    for function in calls[:1]:
+        ranges = [a.range for a in function.args if isinstance(a, (Selector, Subquery)) and a.range]
+        operations.append(function.name + (ranges[0] if ranges else ''))
+    if node.op != 'sum':
+        operations.append(node.op)
+    name = '{}:{}:{}'.format(level, metrics[0] if metrics else 'expr', '_'.join(operations))
+    return re.sub(r'[^a-zA-Z0-9_:]', '_', name)
+
+
+def find_rules(objs, min_count=DEFAULT_MIN_COUNT, max_rules=None):
+    """Find the aggregations worth recording in dashboards and alert groups.
+
+    :param objs: ``Dashboard`` and ``AlertGroup`` objects
+    :param min_count: fewest targets an aggregation must be used in
+    :param max_rules: most rules to return, ``None`` for all
+    :returns: list of ``RecordingRule``, the most used first
+    """
+    counts = collections.Counter()
+    for obj in objs:
+        for target in iter_targets(obj):
+            expr = target_expr(target)
+            if expr is not None:
+                counts.update(set(n for n in iter_nodes(expr) if is_recordable(n)))
+    ranked = sorted(
+        (node for node, count in counts.items() if count >= min_count),
+        key=lambda node: (-counts[node], render(node)))
+    # Expressions differing only in their matchers get the same name. The
+    # most used of them keeps it, the others get a suffix derived from their
+    # text. Names are given before max_rules applies, so do not depend on it.
+    names = {}
+    for node in ranked:
+        name = rule_name(node)
+        if name in names.values():
+            name += '_' + hashlib.sha1(render(node).encode('utf-8')).hexdigest()[:6]
+        names[node] = name
+    return [RecordingRule(record=names[node], expr=node, count=counts[node]) for node in ranked[:max_rules]]
+
+
+def rules_yaml(rules, name=DEFAULT_GROUP_NAME, interval=DEFAULT_INTERVAL):
+    """Return a Prometheus rules file recording ``rules`` in one group."""
+    lines = [
+        'groups:',
+        '  - name: {}'.format(json.dumps(name)),
+        '    interval: {}'.format(interval),
+        '    rules:',
+    ]
+    for rule in rules:
+        lines.append('      - record: {}'.format(rule.record))
+        lines.append('        expr: {}'.format(json.dumps(render(rule.expr))))
+    return '\n'.join(lines) + '\n'
+
+
+def rewrite_expr(expr, rules):
+    """Replace the recorded sub-expressions of ``expr`` by their series."""
+    records = rules if isinstance(rules, dict) else {rule.expr: rule.record for rule in rules}
+    if expr in records:
+        return intern(Selector(metric=records[expr]))
+    changes = {}
+    for field in attr.fields(type(expr)):
+        value = getattr(expr, field.name)
+        if isinstance(value, tuple):
+            new = tuple(rewrite_expr(v, records) if isinstance(v, Expr) else v for v in value)
+        elif isinstance(value, Expr):
+            new = rewrite_expr(value, records)
+        else:
+            continue
+        if new != value:
+            changes[field.name] = new
+    return intern(attr.evolve(expr, **changes)) if changes else expr
+
+
+def rewrite_dashboard(dashboard, rules):
+    """Make the targets of a dashboard read recorded series.
+
+    Alert rules are left alone, as recorded series lag one rule evaluation
+    behind.
+
+    :param rules: list of ``RecordingRule``
+    :returns: a new ``Dashboard``
+    """
+    records = {rule.expr: rule.record for rule in rules}
+
+    def rewrite_panel(panel):
+        targets = getattr(panel, 'targets', None)
+        if isinstance(panel, RowPanel) or not targets:
+            return panel
+        new_targets = []
+        for target in targets:
+            expr = target_expr(target)
+            if expr is not None:
+                new = rewrite_expr(expr, records)
+                if new is not expr:
+                    target = attr.evolve(target, expr=render(new) if isinstance(target.expr, str) else new)
+            new_targets.append(target)
+        return attr.evolve(panel, targets=new_targets)
+    return dashboard._map_panels(rewrite_panel)
@@ -0,0 +1,504 @@
+"""Emit dashboards in the shape of a recent Grafana schema version.
+
+grafanalib builds dashboards in the shape of schema version 12
+(``SCHEMA_VERSION``). Grafana upgrades such dashboards in the browser, running
+every step of its dashboard migrator on every load. Setting
+``Dashboard.schemaVersion`` to a newer version (up to
+``LATEST_SCHEMA_VERSION``) makes ``Dashboard.to_json_data`` run the steps
+that apply to grafanalib's output here instead, once, at build time.
+
+The steps mirror the ones of Grafana's ``DashboardMigrator`` of the same
+version. Keep the default schema version for Grafana servers older than the
+version you emit.
+"""
+
+import re
+
+import attr
+
+from grafanalib.core import (
+    BAR_CHART_TYPE, BARGAUGE_TYPE, DASHBOARD_DATASOURCE, GAUGE_TYPE,
+    GRAFANA_DATASOURCE, GRAPH_TYPE, HEATMAP_TYPE, HISTOGRAM_TYPE,
+    LATEST_SCHEMA_VERSION, LOGS_TYPE, MIXED_DATASOURCE, PIE_CHART_V2_TYPE,
+    SCHEMA_VERSION, STAT_TYPE, STATE_TIMELINE_TYPE, TABLE_TYPE, TIMESERIES_TYPE,
+)
+from grafanalib.layout import rows_to_panels
+
+BUILTIN_DATASOURCE_REFS = {
+    MIXED_DATASOURCE: {'type': 'datasource', 'uid': MIXED_DATASOURCE},
+    DASHBOARD_DATASOURCE: {'type': 'datasource', 'uid': DASHBOARD_DATASOURCE},
+    GRAFANA_DATASOURCE: {'type': 'datasource', 'uid': 'grafana'},
+}
+
+GRID_WIDTH = 24
+
+# Panel types whose field options live in ``fieldConfig``. Rows, text and
+# list panels have no fields.
+FIELD_CONFIG_PANEL_TYPES = frozenset([
+    BAR_CHART_TYPE, BARGAUGE_TYPE, GAUGE_TYPE, GRAPH_TYPE, HEATMAP_TYPE,
+    HISTOGRAM_TYPE, LOGS_TYPE, PIE_CHART_V2_TYPE, STAT_TYPE, STATE_TIMELINE_TYPE,
+    TABLE_TYPE, TIMESERIES_TYPE, 'status-history', 'xychart', 'candlestick',
+    'geomap', 'trend', 'nodeGraph', 'canvas',
+])
+
+
+def to_plain_json(obj):
+    """Return ``obj`` with every grafanalib object replaced by its JSON data."""
+    to_json_data = getattr(obj, 'to_json_data', None)
+    if to_json_data:
+        return to_plain_json(to_json_data())
+    if isinstance(obj, dict):
+        return {k: to_plain_json(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_plain_json(v) for v in obj]
+    return obj
+
+
+def iter_panels(panels):
+    """Yield every panel of a list of JSON panels, including nested ones."""
+    for panel in panels:
+        yield panel
+        for child in panel.get('panels') or []:
+            yield child
+
+
+def datasource_ref(datasource, datasources=None):
+    """Convert a datasource name to the reference used by newer schemas.
+
+    :param datasource: a datasource name, a reference dict or ``None``
+    :param datasources: optional dict mapping datasource names to their
+        ``{'type': ..., 'uid': ...}`` reference. Names that are not in it
+        become ``{'uid': name}``, which Grafana resolves by uid or by name,
+        just like its own migration does for unknown datasources.
+    :returns: a reference dict, or ``None`` for the default datasource
+    """
+    if datasource is None or datasource == 'default' or isinstance(datasource, dict):
+        return datasource
+    if datasources and datasource in datasources:
+        return dict(datasources[datasource])
+    if datasource in BUILTIN_DATASOURCE_REFS:
+        return dict(BUILTIN_DATASOURCE_REFS[datasource])
+    return {'uid': datasource}
+
+
+def _graph_grid_thresholds(data, datasources):
+    for panel in iter_panels(data['panels']):
+        grid = panel.get('grid')
+        if panel.get('type') != 'graph' or not isinstance(grid, dict):
+            continue
+        thresholds = panel.setdefault('thresholds', [])
+        for name in ('threshold1', 'threshold2'):
+            color = grid.pop(name + 'Color', None)
+            value = grid.pop(name, None)
+            if value is not None:
+                thresholds.append({
+                    'value': value, 'colorMode': 'custom', 'op': 'gt',
+                    'fill': True, 'line': False, 'fillColor': color,
+                })
+
+
+def _shared_crosshair(data, datasources):
+    if data.pop('sharedCrosshair', False) and not data.get('graphTooltip'):
+        data['graphTooltip'] = 1
+
+
+def _min_span(data, datasources):
+    factors = [f for f in range(1, GRID_WIDTH + 1) if GRID_WIDTH % f == 0]
+    for panel in iter_panels(data['panels']):
+        min_span = panel.pop('minSpan', None)
+        if min_span:
+            most = GRID_WIDTH / min_span
+            panel['maxPerRow'] = max(f for f in factors if f <= most) if most >= 1 else 1
+
+
+_LEGACY_LINK_VARIABLES = [
+    (re.compile(r'\$__series_name'), '${__series.name}'),
+    (re.compile(r'\$__field_name'), '${__field.name}'),
+    (re.compile(r'__series_name'), '__series.name'),
+    (re.compile(r'__value_time'), '__value.time'),
+    (re.compile(r'__field_name'), '__field.name'),
+]
+
+
+def _links(panel):
+    links = list(panel.get('links') or [])
+    links += (panel.get('options') or {}).get('dataLinks') or []
+    links += ((panel.get('fieldConfig') or {}).get('defaults') or {}).get('links') or []
+    return [link for link in links if isinstance(link, dict) and isinstance(link.get('url'), str)]
+
+
+def _data_link_variables(data, datasources):
+    for panel in iter_panels(data['panels']):
+        for link in _links(panel):
+            for pattern, replacement in _LEGACY_LINK_VARIABLES:
+                link['url'] = pattern.sub(replacement.replace('$', r'\$'), link['url'])
+
+
+def _data_link_labels(data, datasources):
+    for panel in iter_panels(data['panels']):
+        for link in _links(panel):
+            link['url'] = link['url'].replace('__series.labels', '__field.labels')
+
+
+def _multi_value_current(data, datasources):
+    for variable in data['templating']['list']:
+        current = variable.get('current')
+        if not variable.get('multi') or not current:
+            continue
+        for key in ('text', 'value'):
+            if key in current and not isinstance(current[key], list):
+                current[key] = [] if current[key] is None else [current[key]]
+
+
+def _constant_variables(data, datasources):
+    for variable in data['templating']['list']:
+        if variable.get('type') != 'constant':
+            continue
+        if variable.get('hide') in (0, 1):
+            variable['type'] = 'textbox'
+        current = {'selected': True, 'text': variable.get('query'), 'value': variable.get('query')}
+        variable['current'] = current
+        variable['options'] = [current]
+
+
+def _singlestat_and_tags(data, datasources):
+    for panel in iter_panels(data['panels']):
+        if panel.get('type') == 'singlestat':
+            panel['autoMigrateFrom'] = 'singlestat'
+            panel['type'] = 'stat'
+    for variable in data['templating']['list']:
+        for key in ('tags', 'tagsQuery', 'tagValuesQuery', 'useTags'):
+            variable.pop(key, None)
+
+
+def _query_variable_refresh(data, datasources):
+    for variable in data['templating']['list']:
+        if variable.get('type') != 'query':
+            continue
+        if variable.get('refresh') not in (1, 2):
+            variable['refresh'] = 1
+        if variable.get('options'):
+            variable['options'] = []
+
+
+def upgrade_value_mappings(mappings):
+    """Convert legacy numbered value and range mappings to typed mappings."""
+    values = {}
+    result = []
+    for mapping in mappings or []:
+        if not isinstance(mapping, dict):
+            continue
+        if isinstance(mapping.get('type'), str):
+            result.append(mapping)
+        elif mapping.get('type') == 1 and mapping.get('value') not in (None, ''):
+            if mapping['value'] == 'null':
+                result.append({'type': 'special', 'options': {
+                    'match': 'null', 'result': {'text': mapping.get('text')}}})
+            else:
+                values[str(mapping['value'])] = {'text': mapping.get('text')}
+        elif mapping.get('type') == 2:
+            result.append({'type': 'range', 'options': {
+                'from': _number(mapping.get('from')),
+                'to': _number(mapping.get('to')),
+                'result': {'text': mapping.get('text')},
+            }})
+    if values:
+        result.insert(0, {'type': 'value', 'options': values})
+    return result
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _value_mappings(data, datasources):
+    for panel in iter_panels(data['panels']):
+        field_config = panel.get('fieldConfig')
+        if not isinstance(field_config, dict):
+            continue
+        defaults = field_config.get('defaults') or {}
+        if 'mappings' in defaults:
+            defaults['mappings'] = upgrade_value_mappings(defaults['mappings'])
+        for override in field_config.get('overrides') or []:
+            for prop in override.get('properties') or []:
+                if prop.get('id') == 'mappings':
+                    prop['value'] = upgrade_value_mappings(prop.get('value'))
+        options = panel.get('options')
+        if isinstance(options, dict) and 'tooltipOptions' in options:
+            options['tooltip'] = options.pop('tooltipOptions')
+
+
+def _labels_to_fields(data, datasources):
+    for panel in iter_panels(data['panels']):
+        transformations = panel.get('transformations') or []
+        upgraded = []
+        for transformation in transformations:
+            upgraded.append(transformation)
+            if isinstance(transformation, dict) and transformation.get('id') == 'labelsToFields':
+                upgraded.append({'id': 'merge', 'options': {}})
+        if transformations:
+            panel['transformations'] = upgraded
+
+
+def _panel_datasource_refs(data, datasources):
+    for panel in iter_panels(data['panels']):
+        if 'datasource' in panel:
+            panel['datasource'] = datasource_ref(panel['datasource'], datasources)
+        for target in panel.get('targets') or []:
+            ref = datasource_ref(target.get('datasource'), datasources)
+            if ref is not None:
+                target['datasource'] = ref
+
+
+def _next_ref_id(targets):
+    used = {t.get('refId') for t in targets}
+    letters = [chr(c) for c in range(ord('A'), ord('Z') + 1)]
+    for ref_id in letters + [a + b for a in letters for b in letters]:
+        if ref_id not in used:
+            return ref_id
+
+
+def _cloudwatch_statistics(data, datasources):
+    for panel in iter_panels(data['panels']):
+        targets = panel.get('targets') or []
+        for target in list(targets):
+            if 'namespace' not in target or 'statistics' not in target:
+                continue
+            statistics = target.pop('statistics') or []
+            if not statistics:
+                continue
+            target['statistic'] = statistics[0]
+            for statistic in statistics[1:]:
+                extra = dict(target, statistic=statistic)
+                extra['refId'] = _next_ref_id(targets)
+                targets.append(extra)
+
+
+def _hidden_x_axis(data, datasources):
+    for panel in iter_panels(data['panels']):
+        if panel.get('type') != 'timeseries':
+            continue
+        custom = panel.get('fieldConfig', {}).get('defaults', {}).get('custom') or {}
+        if custom.get('axisPlacement') == 'hidden':
+            panel['fieldConfig'].setdefault('overrides', []).append({
+                'matcher': {'id': 'byType', 'options': 'time'},
+                'properties': [{'id': 'custom.axisPlacement', 'value': 'auto'}],
+            })
+
+
+def _annotation_and_variable_refs(data, datasources):
+    for annotation in data['annotations']['list']:
+        if isinstance(annotation, dict) and 'datasource' in annotation:
+            annotation['datasource'] = datasource_ref(annotation['datasource'], datasources)
+    for variable in data['templating']['list']:
+        if variable.get('datasource') is not None:
+            variable['datasource'] = datasource_ref(variable['datasource'], datasources)
+    for panel in iter_panels(data['panels']):
+        ref = panel.get('datasource')
+        if not ref or ref.get('uid') == MIXED_DATASOURCE:
+            continue
+        for target in panel.get('targets') or []:
+            if target.get('datasource') is None:
+                target['datasource'] = dict(ref)
+
+
+def _hidden_legend(data, datasources):
+    for panel in iter_panels(data['panels']):
+        legend = (panel.get('options') or {}).get('legend')
+        if not isinstance(legend, dict):
+            continue
+        if legend.get('displayMode') == 'hidden':
+            legend['displayMode'] = 'list'
+            legend['showLegend'] = False
+        else:
+            legend.setdefault('showLegend', True)
+
+
+_TABLE_CELL_OPTIONS = {
+    'basic': {'type': 'gauge', 'mode': 'basic'},
+    'gradient-gauge': {'type': 'gauge', 'mode': 'gradient'},
+    'lcd-gauge': {'type': 'gauge', 'mode': 'lcd'},
+    'color-background': {'type': 'color-background', 'mode': 'gradient'},
+    'color-background-solid': {'type': 'color-background', 'mode': 'basic'},
+}
+
+
+def _cell_options(display_mode):
+    return dict(_TABLE_CELL_OPTIONS.get(display_mode, {'type': display_mode}))
+
+
+def _table_display_mode(data, datasources):
+    for panel in iter_panels(data['panels']):
+        if panel.get('type') != 'table':
+            continue
+        field_config = panel.get('fieldConfig') or {}
+        custom = (field_config.get('defaults') or {}).get('custom') or {}
+        if 'displayMode' in custom:
+            custom['cellOptions'] = _cell_options(custom.pop('displayMode'))
+        for override in field_config.get('overrides') or []:
+            for prop in override.get('properties') or []:
+                if prop.get('id') == 'custom.displayMode':
+                    prop['id'] = 'custom.cellOptions'
+                    prop['value'] = _cell_options(prop.get('value'))
+
+
+def _time_series_table(data, datasources):
+    for panel in iter_panels(data['panels']):
+        for transformation in panel.get('transformations') or []:
+            if not isinstance(transformation, dict) or transformation.get('id') != 'timeSeriesTable':
+                continue
+            options = transformation.get('options') or {}
+            ref_id_to_stat = options.pop('refIdToStat', None)
+            if ref_id_to_stat:
+                for ref_id, stat in ref_id_to_stat.items():
+                    options[ref_id] = {'stat': stat}
+                transformation['options'] = options
+
+
+MIGRATIONS = [
+    (13, _graph_grid_thresholds),
+    (14, _shared_crosshair),
+    (17, _min_span),
+    (20, _data_link_variables),
+    (21, _data_link_labels),
+    (23, _multi_value_current),
+    (27, _constant_variables),
+    (28, _singlestat_and_tags),
+    (29, _query_variable_refresh),
+    (30, _value_mappings),
+    (31, _labels_to_fields),
+    (33, _panel_datasource_refs),
+    (34, _cloudwatch_statistics),
+    (35, _hidden_x_axis),
+    (36, _annotation_and_variable_refs),
+    (37, _hidden_legend),
+    (38, _table_display_mode),
+    (39, _time_series_table),
+]
+
+
+def _threshold_steps(thresholds):
+    steps = thresholds.get('steps')
+    if not isinstance(steps, list) or not steps:
+        return None
+    if not all(isinstance(step, dict) and 'color' in step for step in steps):
+        return thresholds
+    return {
+        'mode': thresholds.get('mode') or 'absolute',
+        'steps': [
+            {'color': step['color'], 'value': None if step.get('value') == 'null' else step.get('value')}
+            for step in steps
+        ],
+    }
+
+
+def _field_config_layout(panel):
+    """Bring the field options of a panel to the ``fieldConfig`` layout.
+
+    Bar gauges are built with the ``options.fieldOptions`` layout of Grafana
+    6 and gauges with their reducer settings in ``fieldConfig.defaults``;
+    both move to ``fieldConfig.defaults`` and ``options.reduceOptions``.
+    Threshold steps keep only their color and value.
+    """
+    options = panel.get('options')
+    field_config = panel.setdefault('fieldConfig', {'defaults': {}, 'overrides': []})
+    defaults = field_config.setdefault('defaults', {})
+    reduce_options = {}
+
+    field_options = options.pop('fieldOptions', None) if isinstance(options, dict) else None
+    if field_options:
+        defaults.update(field_options.get('defaults') or {})
+        if 'title' in defaults:
+            defaults['displayName'] = defaults.pop('title')
+        defaults['mappings'] = field_options.get('mappings') or []
+        if field_options.get('thresholds') is not None:
+            defaults['thresholds'] = {'mode': 'absolute', 'steps': field_options['thresholds']}
+        reduce_options = {
+            'calcs': field_options.get('calcs'),
+            'limit': field_options.get('limit'),
+            'values': field_options.get('values'),
+        }
+
+    if panel.get('type') == 'gauge' and 'calcs' in defaults:
+        reduce_options = {
+            'calcs': defaults.pop('calcs'),
+            'limit': defaults.pop('limit', None),
+            'values': defaults.pop('values', False),
+        }
+        if 'title' in defaults:
+            defaults['displayName'] = defaults.pop('title')
+        options = panel.setdefault('options', {})
+        for key in ('showThresholdLabels', 'showThresholdMarkers'):
+            if key in field_config:
+                options[key] = field_config.pop(key)
+
+    if reduce_options:
+        panel.setdefault('options', {})['reduceOptions'] = reduce_options
+    defaults.pop('override', None)
+    field_config.setdefault('overrides', [])
+
+    if isinstance(defaults.get('thresholds'), dict):
+        thresholds = _threshold_steps(defaults['thresholds'])
+        if thresholds is None:
+            del defaults['thresholds']
+        else:
+            defaults['thresholds'] = thresholds
+
+
+def _grid_layout(data):
+    """Drop the settings the grid layout replaced."""
+    data.pop('rows', None)
+    for panel in iter_panels(data['panels']):
+        panel.pop('span', None)
+        if panel.get('height') is None:
+            panel.pop('height', None)
+        if panel.get('type') in FIELD_CONFIG_PANEL_TYPES:
+            _field_config_layout(panel)
+        elif panel.get('type') == 'row':
+            panel.pop('fieldConfig', None)
+
+
+def upgrade_dashboard_json(data, schemaVersion=LATEST_SCHEMA_VERSION, datasources=None):
+    """Upgrade the JSON data of a dashboard to a newer schema version.
+
+    :param data: plain JSON data of a dashboard, as returned by
+        ``to_plain_json``. It is modified in place.
+    :param schemaVersion: schema version to upgrade to
+    :param datasources: optional dict mapping datasource names to
+        ``{'type': ..., 'uid': ...}`` references, see ``datasource_ref``
+    :returns: ``data``
+    """
+    if schemaVersion > LATEST_SCHEMA_VERSION:
+        raise ValueError('Can upgrade dashboards to schema version {} at most, not {}'.format(
+            LATEST_SCHEMA_VERSION, schemaVersion))
+    current = data.get('schemaVersion') or SCHEMA_VERSION
+    if current >= schemaVersion:
+        return data
+    if data.get('rows'):
+        raise ValueError(
+            'Dashboards with legacy rows must be converted with layout.rows_to_panels first')
+    for version, migration in MIGRATIONS:
+        if current < version <= schemaVersion:
+            migration(data, datasources)
+    _grid_layout(data)
+    data['schemaVersion'] = schemaVersion
+    return data
+
+
+def upgrade_dashboard(dashboard, datasources=None):
+    """Return the JSON data of a dashboard in the shape of its schema version.
+
+    ``Dashboard.to_json_data`` calls this for dashboards whose
+    ``schemaVersion`` is newer than ``SCHEMA_VERSION``. Legacy rows are
+    converted with ``layout.rows_to_panels`` first.
+
+    :param dashboard: a ``Dashboard``
+    :param datasources: see ``datasource_ref``
+    """
+    target = dashboard.schemaVersion
+    legacy = rows_to_panels(attr.evolve(dashboard, schemaVersion=SCHEMA_VERSION))
+    return upgrade_dashboard_json(
+        to_plain_json(legacy.to_json_data()), target, datasources)
@@ -0,0 +1,160 @@
+"""Split dashboards that are too big into several linked dashboards.
+
+Grafana gets slow loading dashboards with thousands of panels, and its API
+rejects very large payloads. ``shard_dashboard`` splits a dashboard into
+shards that each stay within a panel count and a JSON size budget. Splits
+happen between ``RowPanel`` sections, so each row stays together; only a
+section that does not fit a shard on its own is split between panels.
+
+Every shard keeps the templating and annotations of the dashboard, gets its
+own uid, and links to the other shards through a ``DashboardLink`` on a tag
+they share. The links pass on the time range and variable values.
+"""
+
+import hashlib
+import json
+
+import attr
+
+from grafanalib.core import DashboardLink, RowPanel
+from grafanalib.layout import rows_to_panels
+from grafanalib.schema import to_plain_json
+
+# Longest uid Grafana accepts.
+MAX_UID_LENGTH = 40
+
+# Dashboards are written with this indentation by generate-dashboard(s).
+JSON_INDENT = 2
+
+
+def _json_size(obj, depth=0):
+    """Size of ``obj`` as written by ``generate-dashboard``, nested ``depth`` levels deep."""
+    text = json.dumps(to_plain_json(obj), sort_keys=True, indent=JSON_INDENT)
+    return len(text) + depth * JSON_INDENT * text.count('\n')
+
+
+def _panel_count(panel):
+    return 1 + len(getattr(panel, 'panels', None) or [])
+
+
+def _sections(panels):
+    """Split panels into sections, each starting at a ``RowPanel``."""
+    sections = []
+    for panel in panels:
+        if isinstance(panel, RowPanel) or not sections:
+            sections.append([])
+        sections[-1].append(panel)
+    return sections
+
+
+def _shift_up(panels):
+    """Move panels up so the first of them is at the top of the dashboard."""
+    tops = [p.gridPos.y for p in panels if getattr(p, 'gridPos', None) is not None and p.gridPos.y is not None]
+    if not tops or min(tops) == 0:
+        return panels
+    top = min(tops)
+
+    def shift(panel):
+        pos = getattr(panel, 'gridPos', None)
+        if pos is None or pos.y is None:
+            return panel
+        changes = {'gridPos': attr.evolve(pos, y=pos.y - top)}
+        if isinstance(panel, RowPanel):
+            changes['panels'] = [shift(child) for child in panel.panels]
+        return attr.evolve(panel, **changes)
+    return [shift(panel) for panel in panels]
+
+
+def shard_uid(uid, index):
+    """Return the uid of shard ``index`` (counting from 1) of a dashboard."""
+    if index == 1:
+        return uid
+    suffix = '-{}'.format(index)
+    return uid[:MAX_UID_LENGTH - len(suffix)] + suffix
+
+
+def shard_tag(uid):
+    """Return the tag shared by the shards of the dashboard with ``uid``."""
+    return 'shard:{}'.format(uid)
+
+
+def _base_uid(dashboard):
+    if dashboard.uid:
+        return dashboard.uid
+    return hashlib.sha1(dashboard.title.encode('utf-8')).hexdigest()[:MAX_UID_LENGTH // 2]
+
+
+def shard_dashboard(dashboard, max_panels=None, max_bytes=None):
+    """Split a dashboard into dashboards within a panel count and size budget.
+
+    :param dashboard: a ``Dashboard``; legacy rows are converted with
+        ``layout.rows_to_panels`` first
+    :param max_panels: most panels per shard, counting row panels and the
+        panels of collapsed rows
+    :param max_bytes: largest size of the JSON of each shard, as written by
+        ``generate-dashboard``
+    :returns: list of ``Dashboard``, just ``[dashboard]``, unchanged, if it
+        is within budget. The first shard keeps the uid of the dashboard (one derived
+        from its title if it has none), the others get ``-2``, ``-3``, ...
+        appended to it.
+    """
+    if max_panels is None and max_bytes is None:
+        return [dashboard]
+    original, dashboard = dashboard, rows_to_panels(dashboard)
+
+    base_uid = _base_uid(dashboard)
+    tag = shard_tag(base_uid)
+    link = DashboardLink(
+        title=dashboard.title, type='dashboards', tags=[tag],
+        asDropdown=True, includeVars=True, keepTime=True,
+    )
+    # The JSON of a shard is the dashboard without panels, plus the link and
+    # the tag, plus its panels.
+    empty = attr.evolve(
+        dashboard, panels=[], links=dashboard.links + [link],
+        tags=dashboard.tags + [tag], title=dashboard.title + ' (00/00)', uid=shard_uid(base_uid, 99),
+    )
+    base_bytes = _json_size(empty)
+
+    def fits(count, size):
+        if max_panels is not None and count > max_panels:
+            return False
+        return max_bytes is None or size <= max_bytes
+
+    shards = [[]]
+    count = 0
+    size = base_bytes
+    for section in _sections(dashboard.panels):
+        section_count = sum(_panel_count(p) for p in section)
+        section_size = sum(_json_size(p, depth=2) + 2 for p in section)
+        if not fits(count + section_count, size + section_size) and shards[-1]:
+            shards.append([])
+            count, size = 0, base_bytes
+        if fits(count + section_count, size + section_size):
+            shards[-1].extend(section)
+            count += section_count
+            size += section_size
+            continue
+        # The section does not fit a shard on its own, split it between panels.
+        for panel in section:
+            panel_count, panel_size = _panel_count(panel), _json_size(panel, depth=2) + 2
+            if not fits(count + panel_count, size + panel_size) and shards[-1]:
+                shards.append([])
+                count, size = 0, base_bytes
+            shards[-1].append(panel)
+            count += panel_count
+            size += panel_size
+
+    if len(shards) == 1:
+        return [original]
+    return [
+        attr.evolve(
+            dashboard,
+            title='{} ({}/{})'.format(dashboard.title, index, len(shards)),
+            uid=shard_uid(base_uid, index),
+            tags=dashboard.tags + [tag],
+            links=dashboard.links + [link],
+            panels=_shift_up(panels),
+        )
+        for index, panels in enumerate(shards, 1)
+    ]
@@ -0,0 +1,56 @@
+"""Tests for the used metrics allowlist."""
+
+import json
+import os
+
+import grafanalib.core as G
+from grafanalib import _gen, allowlist
+
+
+def used_dashboard():
+    return G.Dashboard(title='API', panels=[
+        G.TimeSeries(targets=[
+            G.Target(expr='sum by (job) (rate(http_requests_total{code=~"5..",job="$job"}[5m]))'),
+            G.Target(expr='up{job="api"} or up'),
+        ]),
+        G.Stat(targets=[G.Target(expr='count({__name__=~"node_.*"})'), G.Target(expr='{job="api"}')]),
+        G.TimeSeries(targets=[G.Target(expr='$metric{job="api"}'), G.Target(expr='not promql(')]),
+        G.TimeSeries(targets=[G.Target(expr='sum by ($group) (rate(node_cpu_seconds_total[5m]))')]),
+        G.Logs(targets=[G.LokiTarget(expr='{job="api"}')]),
+    ])
+
+
+def used_alertgroup():
+    return G.AlertGroup(name='api', rules=[G.AlertRulev9(
+        title='down', condition='B', triggers=[G.Target(expr='absent(up{job="db"})', refId='A')])])
+
+
+def test_used_metrics():
+    metrics, unknown = allowlist.used_metrics([used_dashboard(), used_alertgroup()])
+    assert metrics == {
+        'http_requests_total': {'code=~"5.."', 'job="$job"'},
+        'up': {'job="api"', 'job="db"'},
+        'node_.*': set(),
+        'node_cpu_seconds_total': set(),
+    }
+    assert unknown == ['$metric{job="api"}', 'not promql(', '{job="api"}']
+    assert allowlist.keep_rule(metrics) == (
+        '- source_labels: [__name__]\n'
+        '  regex: "http_requests_total|node_.*|node_cpu_seconds_total|up"\n'
+        '  action: keep\n'
+    )
+    assert json.loads(allowlist.used_metrics_json(metrics))['up'] == ['job="api"', 'job="db"']
+
+
+def test_export_used_metrics_script(tmpdir, capsys):
+    for name, function in (('api.dashboard.py', 'used_dashboard'), ('api.alertgroup.py', 'used_alertgroup')):
+        with open(os.path.join(str(tmpdir), name), 'w') as f:
+            f.write('from grafanalib.tests.test_allowlist import {0}\n{1} = {0}()\n'.format(
+                function, name.split('.')[1]))
+    assert _gen.export_used_metrics([str(tmpdir)]) == 0
+    out, err = capsys.readouterr()
+    assert out == 'http_requests_total\nnode_.*\nnode_cpu_seconds_total\nup\n'
+    assert err == ''.join('WARNING: {} may read any metric\n'.format(text) for text in (
+        '$metric{job="api"}', 'not promql(', '{job="api"}'))
+    assert _gen.export_used_metrics([str(tmpdir), '--format', 'relabel', '--strict']) == 1
+    assert capsys.readouterr().out.startswith('- source_labels: [__name__]\n')
@@ -0,0 +1,126 @@
+"""Tests for the PromQL cost estimates."""
+
+import json
+import os
+
+import pytest
+
+import grafanalib.core as G
+from grafanalib import _gen, cardinality
+from grafanalib.prometheus import parse
+
+STATUS = {
+    'status': 'success',
+    'data': {
+        'headStats': {'numSeries': 10000},
+        'seriesCountByMetricName': [
+            {'name': 'http_requests_total', 'value': 2000},
+            {'name': 'up', 'value': 100},
+        ],
+        'labelValueCountByLabelName': [
+            {'name': 'pod', 'value': 5000},
+            {'name': 'instance', 'value': 100},
+            {'name': 'job', 'value': 10},
+        ],
+        'seriesCountByLabelValuePair': [{'name': 'job=api', 'value': 1000}],
+    },
+}
+
+
+def snapshot():
+    return cardinality.snapshot_from_status(STATUS)
+
+
+@pytest.mark.parametrize('text,series', [
+    ('http_requests_total', 2000),
+    ('http_requests_total{job="api"}', 200),
+    ('http_requests_total{job=~"web|db"}', 400),
+    ('http_requests_total{job="$job"}', 200),
+    ('http_requests_total{job=~"w.*"}', 2000),
+    ('http_requests_total{job!="api"}', 2000),
+    ('{job="api"}', 1000),
+    ('{__name__="up"}', 100),
+    ('unlisted', 100),
+])
+def test_selector_series(text, series):
+    assert cardinality.selector_series(parse(text), snapshot()) == series
+
+
+def test_expr_cost():
+    context = cardinality.QueryContext(time_range=600, step=60, steps=10)
+    cost = cardinality.expr_cost(
+        parse('sum by (job) (rate(http_requests_total{job="api"}[5m]))'), snapshot(), context)
+    assert (cost.series, cost.samples) == (200, 200 * 20 * 10)
+
+    cost = cardinality.expr_cost(parse('rate(up[$__rate_interval])'), snapshot(), context)
+    assert cost.samples == 100 * 5 * 10
+
+    instant = cardinality.QueryContext(time_range=600, step=60)
+    cost = cardinality.expr_cost(parse('max_over_time(rate(up{job="api"}[1m])[1h:5m])'), snapshot(), instant)
+    assert (cost.series, cost.samples) == (10, 10 * 4 * 12)
+
+
+def test_lint_expr():
+    problems = cardinality.lint_expr(parse('sum by (pod) (rate(up{job=~".*"}[2d]))'), snapshot())
+    assert [p.check for p in problems] == [
+        cardinality.HIGH_CARDINALITY_GROUPING, cardinality.MATCH_ALL_REGEX, cardinality.LONG_RANGE]
+    assert cardinality.lint_expr(parse('sum by (job) (rate(up{job="api"}[5m]))'), snapshot()) == []
+    assert [p.check for p in cardinality.lint_expr(parse('up'))] == [cardinality.MISSING_MATCHERS]
+
+
+def expensive_dashboard():
+    return G.Dashboard(
+        title='Expensive',
+        time=G.Time('now-1h', 'now'),
+        panels=[
+            G.TimeSeries(title='pods', maxDataPoints=60, targets=[
+                G.Target(expr='sum by (pod) (rate(http_requests_total[5m]))', intervalFactor=1),
+            ]),
+            G.Stat(title='up', targets=[G.Target(expr='up{job=~".*"}', instant=True)]),
+            G.TimeSeries(title='broken', targets=[G.Target(expr='rate(up[5m]')]),
+            G.RowPanel(collapsed=True, panels=[
+                G.TimeSeries(targets=[G.Target(expr='max_over_time(up{job="api"}[2d])')]),
+            ]),
+        ],
+    )
+
+
+def test_dashboard_query_cost():
+    report = cardinality.dashboard_query_cost(expensive_dashboard(), snapshot())
+    assert [p.title for p in report.panels] == ['pods', 'up', '']
+    assert report.panels[0].queries[0].steps == 61
+    assert report.series_per_load == 2000 + 100
+    assert report.samples_per_load == 2000 * 20 * 61 + 100
+    assert [p.check for p in report.problems] == [
+        cardinality.HIGH_CARDINALITY_GROUPING, cardinality.MISSING_MATCHERS,
+        cardinality.MATCH_ALL_REGEX, cardinality.UNPARSEABLE_QUERY, cardinality.LONG_RANGE]
+    assert report.problems[0].message.startswith('panel "pods": ')
+    assert report.problems[3].message == 'panel "broken": cannot estimate the cost of rate(up[5m]'
+
+    problems = cardinality.check_query_cost(report, cardinality.QueryBudget(
+        max_series_per_load=5000, max_samples_per_load=1000000))
+    assert [p.check for p in problems] == [cardinality.UNPARSEABLE_QUERY, cardinality.SAMPLES_PER_LOAD]
+    assert cardinality.check_query_cost(report, cardinality.QueryBudget()) == []
+
+
+def test_dashboard_cost_script_cardinality(tmpdir, capsys):
+    definition = os.path.join(str(tmpdir), 'expensive.dashboard.py')
+    with open(definition, 'w') as f:
+        f.write('from grafanalib.tests.test_cardinality import expensive_dashboard\n'
+                'dashboard = expensive_dashboard()\n')
+    status = os.path.join(str(tmpdir), 'tsdb.json')
+    with open(status, 'w') as f:
+        json.dump(STATUS, f)
+    assert _gen.report_dashboard_cost([definition, '--cardinality', status]) == 0
+    out, err = capsys.readouterr()
+    assert 'Expensive: about 2100 series and 2440100 samples per load' in out
+    assert 'WARNING: high-cardinality-grouping: panel "pods"' in err
+    assert 'WARNING: unparseable-query: panel "broken"' in err
+
+    assert _gen.report_dashboard_cost([definition, '--cardinality', status, '--max-series-per-load', '5000']) == 1
+    err = capsys.readouterr().err
+    assert 'ERROR: unparseable-query: panel "broken"' in err
+    assert 'WARNING: unparseable-query' not in err
+
+    assert _gen.report_dashboard_cost([definition, '--cardinality', status, '--max-samples-per-load', '1000000']) == 1
+    assert 'ERROR: samples-per-load' in capsys.readouterr().err
@@ -0,0 +1,76 @@
+"""Tests for cross-object consistency checks."""
+
+import grafanalib.core as G
+from grafanalib import checks
+
+
+def test_consistent_dashboard():
+    dashboard = G.Dashboard(
+        title='ok',
+        templating=G.Templating(list=[G.Template(name='pod', query='up')]),
+        panels=[
+            G.RowPanel(title='row', gridPos=G.GridPos(h=1, w=24, x=0, y=0)),
+            G.TimeSeries(
+                title='a', gridPos=G.GridPos(h=8, w=12, x=0, y=1),
+                targets=[G.Target(refId='A'), G.Target(refId='B')],
+                repeat=G.Repeat('h', 'pod'),
+            ),
+            G.TimeSeries(title='b', gridPos=G.GridPos(h=8, w=12, x=12, y=1)),
+        ],
+    ).auto_panel_ids()
+    assert checks.check_dashboard(dashboard) == []
+
+
+def test_dashboard_problems():
+    dashboard = G.Dashboard(
+        title='broken',
+        templating=G.Templating([
+            G.Template(name='a', query='label_values(x{b="$b"}, a)'),
+            G.Template(name='b', query='label_values(x{a="$a"}, b)'),
+        ]),
+        panels=[
+            G.TimeSeries(
+                id=1, title='a', gridPos=G.GridPos(h=8, w=12, x=0, y=0),
+                targets=[G.Target(refId='A'), G.Target(refId='A')],
+            ),
+            G.Stat(
+                id=1, title='b', gridPos=G.GridPos(h=4, w=4, x=10, y=6),
+                repeat=G.Repeat('h', '$missing'),
+            ),
+            G.RowPanel(
+                id=3, title='collapsed', collapsed=True,
+                gridPos=G.GridPos(h=1, w=24, x=0, y=10),
+                panels=[G.Text(id=4, gridPos=G.GridPos(h=8, w=12, x=0, y=0))],
+            ),
+        ],
+    )
+    problems = checks.check_dashboard(dashboard)
+    assert sorted(p.check for p in problems) == [
+        checks.CYCLIC_VARIABLES,
+        checks.DUPLICATE_PANEL_ID,
+        checks.DUPLICATE_REF_ID,
+        checks.OVERLAPPING_PANELS,
+        checks.UNKNOWN_REPEAT_VARIABLE,
+    ]
+
+
+def test_alertgroup_problems():
+    group = G.AlertGroup(name='group', rules=[
+        G.AlertRulev9(
+            title='good',
+            triggers=[
+                G.Target(refId='A'),
+                G.AlertExpression(refId='B', expression='A'),
+            ],
+            condition='B',
+        ),
+        G.AlertRulev9(
+            title='bad',
+            triggers=[G.Target(refId='A'), G.Target(refId='A')],
+            condition='C',
+        ),
+    ])
+    problems = checks.check(group)
+    assert [p.check for p in problems] == [
+        checks.DUPLICATE_REF_ID, checks.MISSING_CONDITION,
+    ]
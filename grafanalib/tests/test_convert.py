@@ -0,0 +1,89 @@
+"""Tests for converting angular panels."""
+
+import grafanalib.core as G
+from grafanalib import convert
+from grafanalib.schema import to_plain_json
+
+
+def test_graph_to_time_series():
+    graph = G.Graph(
+        title='requests',
+        dataSource='prom',
+        targets=[G.Target(expr='rate(requests_total[5m])')],
+        gridPos=G.GridPos(h=8, w=12, x=0, y=0),
+        stack=True,
+        fill=2,
+        legend=G.Legend(current=True, max=True, rightSide=True),
+        aliasColors={'errors': 'red'},
+        seriesOverrides=[G.SeriesOverride(alias='/latency/', yaxis=2), G.SeriesOverride(alias='unchanged')],
+        thresholds=[G.GraphThreshold(value=90.0, line=False)],
+        yAxes=G.YAxes(
+            left=G.YAxis(format=G.OPS_FORMAT, min=0, max='0.5'),
+            right=G.YAxis(format=G.SECONDS_FORMAT),
+        ),
+    )
+    panel = convert.graph_to_time_series(graph)
+    assert isinstance(panel, G.TimeSeries)
+    assert panel.targets == graph.targets and panel.gridPos == graph.gridPos
+    assert panel.unit == G.OPS_FORMAT
+    assert panel.valueMin == 0
+    assert panel.fillOpacity == 20
+    assert panel.stacking == {'mode': 'normal', 'group': 'A'}
+    assert panel.legendPlacement == 'right'
+    assert panel.legendCalcs == ['max', 'lastNotNull']
+    assert panel.thresholdsStyleMode == 'area'
+    assert [(t.color, t.value) for t in panel.thresholds[1:]] == [('red', 90.0)]
+
+    data = to_plain_json(panel.to_json_data())
+    assert data['fieldConfig']['defaults']['max'] == 0.5
+    overrides = data['fieldConfig']['overrides']
+    assert overrides[0] == {
+        'matcher': {'id': 'byName', 'options': 'errors'},
+        'properties': [{'id': 'color', 'value': {'mode': 'fixed', 'fixedColor': 'red'}}],
+    }
+    assert overrides[1]['matcher'] == {'id': 'byRegexp', 'options': '/latency/'}
+    assert {'id': 'unit', 'value': G.SECONDS_FORMAT} in overrides[1]['properties']
+    assert len(overrides) == 2
+
+
+def test_single_stat_to_stat():
+    stat = convert.single_stat_to_stat(G.SingleStat(
+        title='up',
+        format='none',
+        postfix=' pods',
+        colorBackground=True,
+        thresholds='1,5',
+        valueName=G.VTYPE_CURR,
+        valueMaps=[G.ValueMap(text='down', value='0')],
+    ))
+    assert isinstance(stat, G.Stat)
+    assert stat.format == 'suffix: pods'
+    assert stat.colorMode == 'background'
+    assert stat.graphMode == 'none'
+    assert stat.reduceCalc == 'lastNotNull'
+    assert [(t.color, t.value) for t in stat.thresholds] == [(G.GREEN, 0.0), (G.ORANGE, 1.0), (G.RED, 5.0)]
+    assert stat.mappings == [{'type': 'value', 'options': {'0': {'text': 'down'}}}]
+
+    gauge = convert.single_stat_to_stat(G.SingleStat(gauge=G.Gauge(show=True, maxValue=10)))
+    assert isinstance(gauge, G.GaugePanel)
+    assert gauge.max == 10
+
+
+def test_convert_dashboard():
+    dashboard = convert.convert_dashboard(G.Dashboard(title='old', panels=[
+        G.Graph(xAxis=G.XAxis(mode='series')),
+        G.RowPanel(panels=[G.SingleStat()]),
+        G.Table(overrides=[G.ColumnStyle(
+            alias='Host', pattern='instance',
+            type=G.StringColumnStyleType(colorMode='cell', thresholds=['10'])),
+        ]),
+    ]))
+    graph, row, table = dashboard.panels
+    assert isinstance(graph, G.Graph)
+    assert isinstance(row.panels[0], G.Stat)
+    assert convert.angular_panels(dashboard) == []
+
+    override = table.overrides[0]
+    assert override['matcher'] == {'id': 'byName', 'options': 'instance'}
+    assert {'id': 'displayName', 'value': 'Host'} in override['properties']
+    assert {'id': 'custom.displayMode', 'value': 'color-background'} in override['properties']
@@ -1,6 +1,7 @@
 """Tests for core."""
 
 import random
+import attr
 import grafanalib.core as G
 import pytest
 
@@ -66,6 +67,29 @@ def test_custom_template_ok():
     assert t.to_json_data()['current']['value'] == '1'
 
 
+def test_custom_template_options():
+    t = G.Template(
+        name='test',
+        query='a,b\\,c,a,d',
+        default='d',
+        type='custom',
+    )
+    assert t.options == [
+        {'selected': False, 'text': 'a', 'value': 'a'},
+        {'selected': False, 'text': 'b,c', 'value': 'b,c'},
+        {'selected': True, 'text': 'd', 'value': 'd'},
+    ]
+    assert t.to_json_data()['current']['value'] == 'd'
+
+    # Empty values are options too, as in Grafana.
+    empty = G.Template(name='test', query='a,,b', type='custom')
+    assert [o['value'] for o in empty.options] == ['a', '', 'b']
+
+    minimal = attr.evolve(t, minimalOptions=True).to_json_data()
+    assert minimal['options'] == []
+    assert minimal['current']['value'] == 'd' and minimal['query'] == t.query
+
+
 def test_custom_template_dont_override_options():
     t = G.Template(
         name='test',
@@ -0,0 +1,123 @@
+"""Tests for the static dashboard cost report."""
+
+import os
+
+import grafanalib.core as G
+from grafanalib import _gen, cost
+
+
+def costly_dashboard():
+    return G.Dashboard(
+        title='Costly',
+        refresh='30s',
+        templating=G.Templating([
+            G.Template(name='dc', type='custom', query='eu,us,ap', includeAll=True, default='$__all'),
+            G.Template(name='job', query='label_values(job)'),
+            G.Template(name='pod', query='label_values(pod)', refresh=G.REFRESH_ON_TIME_RANGE_CHANGE),
+            G.Template(name='node', query='label_values(node)', refresh=G.REFRESH_NEVER),
+        ]),
+        annotations=G.Annotations([{'name': 'deploys', 'enable': True}, {'name': 'off', 'enable': False}]),
+        panels=[
+            G.TimeSeries(targets=[G.Target(expr='up'), G.Target(expr='down', hide=True)], maxDataPoints=500),
+            G.Stat(targets=[G.Target(expr='up', instant=True)], repeat=G.Repeat(variable='dc')),
+            G.TimeSeries(targets=[G.Target(expr='up')], repeat=G.Repeat(variable='job'), maxDataPoints=100),
+            G.TimeSeries(dataSource=G.DASHBOARD_DATASOURCE, targets=[G.DashboardTarget(panelId=1)]),
+            G.RowPanel(collapsed=True, panels=[G.TimeSeries(targets=[G.Target(expr='a'), G.Target(expr='b')])]),
+        ],
+    )
+
+
+def test_dashboard_cost():
+    report = cost.dashboard_cost(costly_dashboard())
+    assert [p.queries for p in report.panels] == [1, 3, 1, 0, 2]
+    assert report.panel_queries == 5
+    assert report.collapsed_queries == 2
+    assert report.queries_per_load == 5 + 2 + 1
+    assert report.queries_per_refresh == 5 + 1 + 1
+    assert report.queries_per_second == 7 / 30.0
+    assert report.points_per_load == 500 + 3 + 100
+
+    report = cost.dashboard_cost(costly_dashboard(), fan_out={'job': 10})
+    assert report.panel_queries == 14
+    assert report.points_per_load == 500 + 3 + 1000
+
+    problems = cost.check_cost(report, cost.CostBudget(
+        max_queries_per_load=20, max_queries_per_second=5, max_points_per_load=1000, viewers=100))
+    assert [p.check for p in problems] == [cost.QUERIES_PER_SECOND, cost.POINTS_PER_LOAD]
+    assert cost.check_cost(report, cost.CostBudget()) == []
+
+
+def test_dashboard_cost_script(tmpdir, capsys):
+    definition = os.path.join(str(tmpdir), 'costly.dashboard.py')
+    with open(definition, 'w') as f:
+        f.write('from grafanalib.tests.test_cost import costly_dashboard\ndashboard = costly_dashboard()\n')
+    assert _gen.report_dashboard_cost([definition, '--max-queries-per-load', '8']) == 0
+    assert capsys.readouterr().out.startswith('Costly: 8 queries per load (2 more in collapsed rows)')
+    assert _gen.report_dashboard_cost([definition, '--fan-out', 'job=10', '--max-queries-per-load', '8']) == 1
+    assert 'queries-per-load' in capsys.readouterr().err
+
+
+def test_fleet_load(tmpdir, capsys):
+    dashboard = G.Dashboard(
+        title='Logs',
+        refresh='1m',
+        templating=G.Templating([G.Template(name='job', query='label_values(job)', dataSource='prom')]),
+        annotations=G.Annotations([{'name': 'deploys', 'datasource': {'uid': 'loki'}}]),
+        panels=[
+            G.Logs(dataSource='es', targets=[G.LokiTarget(datasource='loki', expr='{job="x"}'), G.Target()]),
+        ],
+    )
+    load = cost.datasource_load(dashboard, viewers=6)
+    assert sorted(load) == ['es', 'loki', 'prom']
+    assert load['loki'].queries_per_load == 12
+    assert load['loki'].queries_per_second == 12 / 60.0
+    assert load['prom'].queries_per_second == 0
+
+    total = cost.fleet_load([load, cost.datasource_load(costly_dashboard())])
+    assert [(t.datasource, t.dashboards) for t in total] == [
+        ('default', 1), ('loki', 1), ('es', 1), ('prom', 1)]
+
+    for name in ('costly', os.path.join('team', 'costly')):
+        os.makedirs(os.path.join(str(tmpdir), os.path.dirname(name)), exist_ok=True)
+        with open(os.path.join(str(tmpdir), name + '.dashboard.py'), 'w') as f:
+            f.write('from grafanalib.tests.test_cost import costly_dashboard\ndashboard = costly_dashboard()\n')
+    assert _gen.forecast_fleet_load([str(tmpdir), '--jobs', '2', '--dashboard-viewers', 'Costly=15']) == 0
+    assert capsys.readouterr().out == 'default: 7.00 queries/s, 603 points/s, 240 queries on load, 2 dashboards\n'
+
+
+def test_collapse_expensive_rows():
+    def stat(y, x=0, expr='up'):
+        return G.Stat(targets=[G.Target(expr=expr)], gridPos=G.GridPos(h=8, w=12, x=x, y=y))
+
+    dashboard = G.Dashboard(title='Long', panels=[
+        stat(0), stat(0, 12),
+        G.RowPanel(title='details', gridPos=G.GridPos(h=1, w=24, x=0, y=8)),
+        stat(9), stat(9, 12), stat(17),
+        G.RowPanel(title='more', gridPos=G.GridPos(h=1, w=24, x=0, y=25)),
+        stat(26),
+        G.RowPanel(title='end', gridPos=G.GridPos(h=1, w=24, x=0, y=34)),
+    ])
+    folded = cost.collapse_expensive_rows(dashboard, fold=20)
+    assert [p.title for p in folded.panels] == ['', '', 'details', '', '', '', 'more', 'end']
+    assert folded.panels[6].collapsed and folded.panels[6].panels[0].gridPos.y == 26
+    assert folded.panels[7].gridPos.y == 26
+
+    budgeted = cost.collapse_expensive_rows(dashboard, max_queries=3)
+    top, _, details, more, shown, end = budgeted.panels
+    assert details.collapsed and len(details.panels) == 3
+    assert [p.gridPos.y for p in details.panels] == [9, 9, 17]
+    assert (more.gridPos.y, more.collapsed, shown.gridPos.y, end.gridPos.y) == (9, False, 10, 18)
+    assert cost.dashboard_cost(budgeted).queries_per_load == 3
+
+    # Rows querying longer time ranges cost more.
+    ranged = G.Dashboard(title='Ranges', time=G.Time('now-1h', 'now'), panels=[
+        stat(0),
+        G.RowPanel(title='week', gridPos=G.GridPos(h=1, w=24, x=0, y=8)),
+        G.Stat(targets=[G.Target(expr='up')], timeFrom='7d', gridPos=G.GridPos(h=8, w=12, x=0, y=9)),
+        G.RowPanel(title='hour', gridPos=G.GridPos(h=1, w=24, x=0, y=17)),
+        stat(18),
+    ])
+    folded = cost.collapse_expensive_rows(ranged, max_query_seconds=2 * 3600)
+    _, week, hour, _ = folded.panels
+    assert week.collapsed and not hour.collapsed
+    assert cost.dashboard_cost(ranged).panels[1].query_seconds == 7 * 24 * 3600
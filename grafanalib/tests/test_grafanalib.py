@@ -1,8 +1,11 @@
 """Tests for Grafanalib."""
 
+import attr
+
 import grafanalib.core as G
 from grafanalib import _gen
 
+import os
 import sys
 if sys.version_info[0] < 3:
     from io import BytesIO as StringIO
@@ -176,6 +179,36 @@ def test_auto_refids():
     assert dashboard.rows[0].panels[0].targets[52].refId == 'BA'
 
 
+def test_ref_id():
+    assert [G.ref_id(i) for i in (0, 25, 26, 701, 702)] == ['A', 'Z', 'AA', 'ZZ', 'AAA']
+    allocator = G.RefIdAllocator(['A', 'C'])
+    assert [allocator.allocate() for _ in range(3)] == ['B', 'D', 'E']
+    assert len(allocator.allocate('up')) == G.STABLE_REF_ID_LENGTH
+    assert allocator.allocate('up') != allocator.allocate('up')
+
+
+def test_stable_auto_refids():
+    """
+    auto_ref_ids(stable=True) gives targets refIds that do not change when
+    other targets are added.
+    """
+    targets = [G.Target(expr="metric %d" % i) for i in range(40)]
+    panel = G.TimeSeries(targets=targets).auto_ref_ids(stable=True)
+    ref_ids = [t.refId for t in panel.targets]
+    assert len(set(ref_ids)) == 40
+
+    panel = G.TimeSeries(
+        targets=[G.Target(expr='new')] + targets[:20] + [G.Target(expr='other', refId='B')] + targets[20:],
+    ).auto_ref_ids(stable=True)
+    assert [t.refId for t in panel.targets if t.expr.startswith('metric')] == ref_ids
+
+    renamed = [attr.evolve(t, legendFormat='{{job}}', hide=True) for t in targets]
+    panel = G.TimeSeries(targets=renamed).auto_ref_ids(stable=True)
+    assert [t.refId for t in panel.targets] == ref_ids
+    assert G.target_key(G.Target(expr='up', datasource='a')) != G.target_key(G.Target(expr='up', datasource='b'))
+    assert G.target_key(G.SqlTarget(rawSql='a', legendFormat='x')) == G.target_key(G.SqlTarget(rawSql='a'))
+
+
 def test_row_show_title():
     row = G.Row().to_json_data()
     assert row['title'] == 'New row'
@@ -209,3 +242,46 @@ def test_row_panel_collapsed():
 
     row = G.RowPanel(collapsed=True).to_json_data()
     assert row['collapsed'] is True
+
+
+def test_generate_dashboard_deferred_validation(tmpdir):
+    """Deferred validation reports every invalid field of a definition."""
+    path = os.path.join(str(tmpdir), 'broken.dashboard.py')
+    with open(path, 'w') as f:
+        f.write(
+            'import grafanalib.core as G\n'
+            'dashboard = G.Dashboard(\n'
+            '    title="broken", editable="yes",\n'
+            '    panels=[G.Stat(transparent="no")],\n'
+            ')\n'
+        )
+
+    stderr = StringIO()
+    old_stderr, sys.stderr = sys.stderr, stderr
+    try:
+        ret = _gen.generate_dashboard(['--validation', 'deferred', path])
+    finally:
+        sys.stderr = old_stderr
+    assert ret == 1
+    assert 'Dashboard.editable' in stderr.getvalue()
+    assert 'Dashboard.panels[0].transparent' in stderr.getvalue()
+
+    dashboard = _gen.load(path, _gen.VALIDATION_TRUSTED)
+    assert dashboard.editable == 'yes'
+
+
+def test_generate_dashboard_schema_version(tmpdir):
+    """--schema-version upgrades the generated JSON at build time."""
+    path = os.path.join(str(tmpdir), 'legacy.dashboard.py')
+    output = os.path.join(str(tmpdir), 'legacy.json')
+    with open(path, 'w') as f:
+        f.write(
+            'import grafanalib.core as G\n'
+            'dashboard = G.Dashboard(title="legacy", sharedCrosshair=True)\n'
+        )
+
+    assert _gen.generate_dashboard(['--schema-version', '39', '-o', output, path]) == 0
+    with open(output) as f:
+        data = f.read()
+    assert '"schemaVersion": 39' in data
+    assert 'sharedCrosshair' not in data
@@ -0,0 +1,102 @@
+"""Tests for automatic panel layout."""
+
+import grafanalib.core as G
+from grafanalib import checks, layout
+
+
+def positions(panels):
+    return [(p.gridPos.x, p.gridPos.y, p.gridPos.w, p.gridPos.h) for p in panels]
+
+
+def test_compact_layout_fills_lowest_gap():
+    panels = layout.layout_panels([
+        G.TimeSeries(gridPos=G.GridPos(h=10, w=12, x=0, y=0)),
+        G.Stat(gridPos=G.GridPos(h=4, w=12, x=0, y=0)),
+        G.Stat(gridPos=G.GridPos(h=4, w=6, x=0, y=0)),
+        G.Stat(gridPos=G.GridPos(h=4, w=6, x=0, y=0)),
+        G.Text(),
+    ])
+    assert positions(panels) == [
+        (0, 0, 12, 10),
+        (12, 0, 12, 4),
+        (12, 4, 6, 4),
+        (18, 4, 6, 4),
+        (12, 8, 12, 8),
+    ]
+
+
+def test_flow_layout_wraps_rows():
+    panels = layout.layout_panels([
+        G.TimeSeries(gridPos=G.GridPos(h=10, w=12, x=0, y=0)),
+        G.Stat(gridPos=G.GridPos(h=4, w=12, x=0, y=0)),
+        G.Stat(gridPos=G.GridPos(h=4, w=6, x=0, y=0)),
+    ], mode=layout.LAYOUT_FLOW)
+    assert positions(panels) == [
+        (0, 0, 12, 10),
+        (12, 0, 12, 4),
+        (0, 10, 6, 4),
+    ]
+
+
+def test_row_panels_start_sections():
+    dashboard = layout.auto_layout(G.Dashboard(title='rows', panels=[
+        G.TimeSeries(),
+        G.RowPanel(title='collapsed', collapsed=True, panels=[G.Stat(), G.Stat(), G.Stat()]),
+        G.RowPanel(title='open'),
+        G.TimeSeries(gridPos=G.GridPos(h=3, w=30, x=0, y=0)),
+    ]))
+    assert positions(dashboard.panels) == [
+        (0, 0, 12, 8),
+        (0, 8, 24, 1),
+        (0, 9, 24, 1),
+        (0, 10, 24, 3),
+    ]
+    assert positions(dashboard.panels[1].panels) == [
+        (0, 9, 12, 8),
+        (12, 9, 12, 8),
+        (0, 17, 12, 8),
+    ]
+
+
+def test_layout_is_stable_when_appending():
+    panels = [G.Stat(gridPos=G.GridPos(h=1 + i % 5, w=1 + i % 13, x=0, y=0)) for i in range(5000)]
+    first = layout.layout_panels(panels[:4000])
+    every = layout.layout_panels(panels)
+    assert positions(every[:4000]) == positions(first)
+
+    dashboard = G.Dashboard(title='big', panels=every).auto_panel_ids()
+    assert checks.check_dashboard(dashboard) == []
+
+
+def test_grid_height():
+    assert layout.grid_height(G.Pixels(250)) == 7
+    assert layout.grid_height('300px') == 8
+    assert layout.grid_height(10) == 3
+
+
+def test_rows_to_panels():
+    dashboard = G.Dashboard(title='legacy', rows=[
+        G.Row(title='first', panels=[G.Graph(title='a'), G.Graph(title='b', span=8)]),
+        G.Row(title='second', collapse=True, height=G.Pixels(400), panels=[
+            G.SingleStat(title='c'), G.SingleStat(title='d'),
+        ]),
+        G.Row(repeat='pod', panels=[G.Graph(title='e', span=12, height='100px')]),
+    ])
+    converted = layout.rows_to_panels(dashboard)
+    assert converted.rows == []
+    assert [(p.title, p.gridPos.to_json_data()) for p in converted.panels] == [
+        ('first', {'h': 1, 'w': 24, 'x': 0, 'y': 0}),
+        ('a', {'h': 7, 'w': 8, 'x': 0, 'y': 1}),
+        ('b', {'h': 7, 'w': 16, 'x': 8, 'y': 1}),
+        ('second', {'h': 1, 'w': 24, 'x': 0, 'y': 8}),
+        ('', {'h': 1, 'w': 24, 'x': 0, 'y': 9}),
+        ('e', {'h': 3, 'w': 24, 'x': 0, 'y': 10}),
+    ]
+    collapsed = converted.panels[3]
+    assert collapsed.collapsed
+    assert [(p.title, p.span, p.gridPos.to_json_data()) for p in collapsed.panels] == [
+        ('c', None, {'h': 11, 'w': 12, 'x': 0, 'y': 9}),
+        ('d', None, {'h': 11, 'w': 12, 'x': 12, 'y': 9}),
+    ]
+    assert converted.panels[4].repeat.variable == 'pod'
+    assert converted.to_json_data()['rows'] == []
@@ -0,0 +1,189 @@
+"""Tests for the query optimization passes."""
+
+import grafanalib.core as G
+from grafanalib import checks, optimize
+
+
+def test_parse_and_format_duration():
+    assert optimize.parse_duration('90s') == 90
+    assert optimize.parse_duration('now') is None
+    assert optimize.format_duration(120) == '2m'
+    assert optimize.format_duration(0.5) == '500ms'
+    assert optimize.time_range_seconds(G.Time('now-6h', 'now')) == 6 * 3600
+    assert optimize.time_range_seconds(G.Time('now-7d/d', 'now-1d/d')) == 6 * 86400
+    assert optimize.time_range_seconds(G.Time('2024-01-01', 'now')) is None
+
+
+def test_size_queries():
+    target = [G.Target(expr='up')]
+    dashboard = optimize.size_queries(G.Dashboard(
+        title='sized',
+        time=G.Time('now-24h', 'now'),
+        panels=[
+            G.TimeSeries(targets=target, gridPos=G.GridPos(h=8, w=24, x=0, y=0)),
+            G.Stat(targets=target, gridPos=G.GridPos(h=4, w=3, x=0, y=8)),
+            G.Stat(targets=target, gridPos=G.GridPos(h=4, w=3, x=3, y=8), timeFrom='5m'),
+            G.TimeSeries(targets=target, gridPos=G.GridPos(h=8, w=12, x=0, y=12), interval='1h'),
+            G.Text(gridPos=G.GridPos(h=8, w=12, x=12, y=12)),
+        ],
+    ), min_interval='15s')
+    wide, narrow, recent, manual, text = dashboard.panels
+    assert (wide.maxDataPoints, wide.interval) == (1920, '1m')
+    assert (narrow.maxDataPoints, narrow.interval) == (240, '10m')
+    assert (recent.maxDataPoints, recent.interval) == (240, '15s')
+    assert (manual.maxDataPoints, manual.interval) == (960, '1h')
+    assert text.maxDataPoints == 100
+
+
+def test_cache_policy():
+    policy = G.CachePolicy(
+        datasourceTypes={'prom': 'prometheus', 'logs': 'elasticsearch'},
+        defaultDatasource='prom',
+        rules=[
+            G.CacheRule(title='Live *', ttl=None),
+            G.CacheRule(datasourceType='prometheus', instant=True, ttl='5m'),
+            G.CacheRule(datasourceType='elasticsearch', minTimeRange='1d', ttl='1h'),
+            G.CacheRule(datasourceType='prometheus', maxRefresh='5m'),
+        ],
+    )
+    dashboard = G.Dashboard(
+        title='noc',
+        refresh='1m',
+        cachePolicy=policy,
+        panels=[
+            G.Stat(title='Live errors', targets=[G.Target(expr='up')]),
+            G.Stat(title='up', targets=[G.Target(expr='up', instant=True)]),
+            G.TimeSeries(title='rate', targets=[G.Target(expr='rate(x[5m])')]),
+            G.TimeSeries(title='logs', dataSource='logs', targets=[G.Target()]),
+            G.TimeSeries(title='logs today', dataSource='logs', timeFrom='1d', targets=[G.Target()]),
+            G.TimeSeries(title='manual', cacheTimeout='10', targets=[G.Target()]),
+        ],
+    )
+    panels = [p.to_json_data() for p in dashboard.to_json_data()['panels']]
+    assert [p.get('queryCachingTTL') for p in panels] == [None, 300000, 60000, None, 3600000, None]
+    assert [p['cacheTimeout'] for p in panels] == [None, '300', '60', None, '3600', '10']
+
+
+def test_use_instant_queries():
+    targets = [G.Target(expr='up'), G.SqlTarget(rawSql='select 1')]
+    dashboard = optimize.use_instant_queries(G.Dashboard(title='overview', panels=[
+        G.Stat(targets=targets, reduceCalc='lastNotNull', graphMode='none'),
+        G.Stat(targets=targets, reduceCalc='lastNotNull'),
+        G.Stat(targets=targets, reduceCalc='mean', graphMode='none'),
+        G.GaugePanel(targets=targets, calc='last'),
+        G.BarGauge(targets=targets, calc='last', allValues=True),
+        G.PieChartv2(targets=targets),
+        G.TimeSeries(targets=targets),
+    ]))
+    assert [[t.instant for t in p.targets] for p in dashboard.panels] == [
+        [True, False],
+        [False, False],
+        [False, False],
+        [True, False],
+        [False, False],
+        [True, False],
+        [False, False],
+    ]
+
+    dashboard = optimize.use_instant_queries(G.Dashboard(title='other', panels=[
+        G.GaugePanel(dataSource='influx', calc='last', targets=[G.Target(expr='up')]),
+    ]), prometheus_datasources=['prom'])
+    assert not dashboard.panels[0].targets[0].instant
+
+
+def test_share_queries():
+    errors = G.Target(expr='sum(rate(errors_total[5m]))', refId='A')
+    dashboard = optimize.share_queries(G.Dashboard(title='errors', panels=[
+        G.Stat(dataSource='prom', targets=[errors]),
+        G.TimeSeries(dataSource='prom', targets=[G.Target(expr=errors.expr, refId='B')]),
+        G.Table(dataSource='prom', targets=[errors], timeFrom='1d'),
+        G.TimeSeries(dataSource='other', targets=[errors]),
+        G.Text(),
+    ]))
+    source, shared, other_range, other_datasource, text = dashboard.panels
+    assert source.id == 1 and source.targets == [errors]
+    assert shared.dataSource == G.DASHBOARD_DATASOURCE
+    assert shared.targets == [G.DashboardTarget(panelId=1)]
+    assert shared.to_json_data()['targets'][0].to_json_data()['panelId'] == 1
+    assert other_range.targets == [errors]
+    assert other_datasource.targets == [errors]
+
+    unshared = G.Dashboard(title='unshared', panels=[G.Stat(targets=[errors])])
+    assert optimize.share_queries(unshared) is unshared
+
+    # Panels querying at other resolutions keep their own queries.
+    resized = G.Dashboard(title='resized', panels=[
+        G.TimeSeries(targets=[errors], maxDataPoints=100),
+        G.TimeSeries(targets=[errors], maxDataPoints=400),
+        G.TimeSeries(targets=[errors], maxDataPoints=100, interval='1m'),
+    ])
+    assert optimize.share_queries(resized) is resized
+
+    # Legacy alerts cannot evaluate queries of the -- Dashboard -- datasource.
+    alert = G.Alert(name='errors', message='', alertConditions=[
+        G.AlertCondition(target=errors, evaluator=G.GreaterThan(1), timeRange=G.TimeRange('5m', 'now'))])
+    alerting = G.Dashboard(title='alerting', panels=[
+        G.Graph(title='source', dataSource='prom', targets=[errors]),
+        G.Graph(title='alert', dataSource='prom', targets=[errors], alert=alert),
+    ])
+    assert optimize.share_queries(alerting) is alerting
+
+
+def test_expand_repeats():
+    dashboard = optimize.expand_repeats(G.Dashboard(
+        title='repeats',
+        templating=G.Templating([
+            G.Template(name='dc', type='custom', query='eu,us,ap', includeAll=True, default='$__all'),
+            G.Template(name='job', query='label_values(job)'),
+        ]),
+        panels=[
+            G.TimeSeries(
+                id=7, title='Load $dc',
+                targets=[G.Target(expr='load{dc="${dc}", re=~"${dc:regex}"}', legendFormat='[[dc]]')],
+                repeat=G.Repeat(variable='dc', direction='h', maxPerRow=2),
+                gridPos=G.GridPos(h=4, w=24, x=0, y=0),
+            ),
+            G.Stat(id=9, repeat=G.Repeat(variable='job'), gridPos=G.GridPos(h=4, w=6, x=0, y=4)),
+            G.RowPanel(gridPos=G.GridPos(h=1, w=24, x=0, y=8), collapsed=True,
+                       panels=[G.Text(gridPos=G.GridPos(h=2, w=24, x=0, y=9))]),
+        ],
+    ))
+    eu, us, ap, stat, row = dashboard.panels
+    assert [p.title for p in (eu, us, ap)] == ['Load eu', 'Load us', 'Load ap']
+    assert eu.targets[0].expr == 'load{dc="eu", re=~"eu"}'
+    assert us.targets[0].legendFormat == 'us'
+    assert [(p.gridPos.x, p.gridPos.y, p.gridPos.w) for p in (eu, us, ap)] == [(0, 0, 12), (12, 0, 12), (0, 4, 12)]
+    assert (eu.id, us.id, ap.id) == (7, 10, 11)
+    assert not eu.repeat.variable
+    # Panels below make room for the extra row of copies.
+    assert stat.repeat.variable == 'job' and stat.gridPos.y == 8
+    assert row.gridPos.y == 12 and row.panels[0].gridPos.y == 13
+
+    capped = optimize.expand_repeats(G.Dashboard(
+        title='capped',
+        templating=G.Templating([G.Template(name='dc', type='custom', query='eu,us,ap', default='us')]),
+        panels=[
+            G.Stat(title='$dc', repeat=G.Repeat(variable='dc', direction='v'), gridPos=G.GridPos(h=4, w=6, x=0, y=0)),
+            G.Text(id=3, gridPos=G.GridPos(h=4, w=6, x=6, y=0)),
+        ],
+    ), max_repeats=1)
+    stat, text = capped.panels
+    assert stat.title == 'us' and not stat.repeat.variable
+    # The copy of a panel without an id gets one above those of the dashboard.
+    assert (stat.id, text.id) == (4, 3)
+
+    beside = optimize.expand_repeats(G.Dashboard(
+        title='beside',
+        templating=G.Templating([G.Template(
+            name='dc', type='custom', query='eu,us,ap,sa', includeAll=True, default='$__all')]),
+        panels=[
+            G.Stat(title='$dc', repeat=G.Repeat(variable='dc', direction='h'), gridPos=G.GridPos(h=8, w=12, x=0, y=0)),
+            G.Text(title='beside', gridPos=G.GridPos(h=8, w=12, x=12, y=0)),
+            G.Text(title='below', gridPos=G.GridPos(h=4, w=24, x=0, y=8)),
+        ],
+    ).auto_panel_ids())
+    *copies, text, below = beside.panels
+    assert [(p.gridPos.x, p.gridPos.y) for p in copies] == [(0, 0), (6, 0), (12, 0), (18, 0)]
+    # Horizontal copies take the whole width: the panels beside them move below.
+    assert (text.gridPos.y, below.gridPos.y) == (8, 16)
+    assert checks.check_dashboard(beside) == []
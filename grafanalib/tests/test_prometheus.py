@@ -0,0 +1,81 @@
+"""Tests for PromQL expressions."""
+
+import gc
+import json
+
+import pytest
+
+import grafanalib.core as G
+from grafanalib import _gen, optimize, prometheus as P
+
+
+@pytest.mark.parametrize('text,canonical', [
+    ('sum(rate(http_requests_total{job="api",code=~"5.."}[300s])) by (job)',
+     'sum by (job) (rate(http_requests_total{code=~"5..",job="api"}[5m]))'),
+    ('histogram_quantile(0.99, sum by(le)(rate(x_bucket[$__rate_interval])))',
+     'histogram_quantile(0.99, sum by (le) (rate(x_bucket[$__rate_interval])))'),
+    ('(a + b) * c - (d - e)', '(a + b) * c - (d - e)'),
+    ('a+(b*c)', 'a + b * c'),
+    ('2 ^ (3 ^ 2)', '2 ^ 3 ^ 2'),
+    ('-(a + b)', '-(a + b)'),
+    ('a / on(job) group_left(instance) b', 'a / on (job) group_left (instance) b'),
+    ('up == bool 1 and on() vector(1)', 'up == bool 1 and on () vector(1)'),
+    ('topk(5, x)', 'topk (5, x)'),
+    ('max_over_time(rate(x[1m])[90m:60s] offset 1d)', 'max_over_time(rate(x[1m])[1h30m:1m] offset 1d)'),
+    ('{__name__="up", job=\'a"b\'}', 'up{job="a\\"b"}'),
+    ('x > $threshold', 'x > $threshold'),
+    ('sum by ($group, job) (rate(x[5m]))', 'sum by ($group, job) (rate(x[5m]))'),
+    ('rate($metric{job="api"}[$__rate_interval])', 'rate($metric{job="api"}[$__rate_interval])'),
+])
+def test_normalize(text, canonical):
+    assert P.normalize(text) == canonical
+    assert P.normalize(canonical) == canonical
+
+
+@pytest.mark.parametrize('text', ['sum(', 'x{a=1}', 'x[5m][5m]', 'a +', 'topk(x)', 'x ~ y'])
+def test_parse_errors(text):
+    with pytest.raises(P.ParseError):
+        P.parse(text)
+
+
+def test_builder_interns_expressions():
+    built = P.aggregate(
+        'sum', P.rate(P.selector('http_requests_total', ('code', '=~', '5..'), job='api'), '5m'), by=['job'])
+    parsed = P.parse('sum by (job) (rate(http_requests_total{job="api", code=~"5.."}[5m]))')
+    assert built is parsed
+    assert P.binary('/', built, P.aggregate('sum', parsed.expr, by=['job'])).lhs is built
+    assert P.iter_nodes(built).__next__() is built
+    assert len(list(P.iter_nodes(built))) == 3
+
+    dashboard = optimize.share_queries(G.Dashboard(title='shared', panels=[
+        G.Stat(targets=[G.Target(expr=built)]),
+        G.TimeSeries(targets=[G.Target(expr=parsed)]),
+    ]))
+    assert dashboard.panels[1].targets == [G.DashboardTarget(panelId=1)]
+    data = json.loads(json.dumps(dashboard.to_json_data(), cls=_gen.DashboardEncoder))
+    assert data['panels'][0]['targets'][0]['expr'] == str(built)
+
+
+def test_interned_expressions_are_released():
+    gc.collect()
+    count = len(P._interned)
+    node = P.selector('interned_once', job='interned_once')
+    assert P.selector('interned_once', job='interned_once') is node
+    assert len(P._interned) == count + 2
+    del node
+    gc.collect()
+    assert len(P._interned) == count
+
+    # Rendering does not keep expressions alive.
+    for i in range(100):
+        assert str(P.parse('sum by (job) (rate(released_total{{i="{}"}}[5m]))'.format(i)))
+    gc.collect()
+    assert len(P._interned) == count
+
+
+def test_prom_graph_ref_ids():
+    graph = P.PromGraph('prom', 'many', [('m%d' % i, 'up{i="%d"}' % i) for i in range(40)])
+    assert [t.refId for t in graph.targets[24:28]] == ['Y', 'Z', 'AA', 'AB']
+
+    graph = P.PromGraph('prom', 'dicts', [{'expr': 'a', 'refId': 'A'}, {'expr': 'b'}], stable_ref_ids=True)
+    assert graph.targets[0].refId == 'A' and len(graph.targets[1].refId) == G.STABLE_REF_ID_LENGTH
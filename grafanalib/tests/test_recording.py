@@ -0,0 +1,67 @@
+"""Tests for recording rule extraction."""
+
+import json
+import os
+
+import grafanalib.core as G
+from grafanalib import _gen, recording
+from grafanalib.prometheus import normalize
+
+ERRORS = 'sum by (job) (rate(http_requests_total{code=~"5.."}[5m]))'
+REQUESTS = 'sum(rate(http_requests_total[5m])) by (job)'
+LOGS = 'sum(rate({app="x"}[5m]))'
+LOKI = {'type': 'loki', 'uid': 'logs'}
+
+
+def recorded_dashboard():
+    return G.Dashboard(title='API', panels=[
+        G.TimeSeries(targets=[G.Target(expr=ERRORS + ' / ' + REQUESTS)]),
+        G.Stat(targets=[G.Target(expr=ERRORS)]),
+        G.TimeSeries(targets=[G.Target(expr='max(rate(x[$__rate_interval]))')]),
+        G.TimeSeries(targets=[G.Target(expr='max(rate(x[$__rate_interval]))')]),
+        G.RowPanel(collapsed=True, panels=[G.Stat(targets=[G.Target(expr='sum(' + REQUESTS + ')')])]),
+        G.TimeSeries(targets=[G.Target(expr=LOGS, datasource=LOKI), G.Target(expr=LOGS, datasource=LOKI)]),
+    ])
+
+
+def test_find_rules():
+    alerts = G.AlertGroup(name='api', rules=[G.AlertRulev9(
+        title='errors', condition='B', triggers=[G.Target(expr=ERRORS, refId='A')])])
+    rules = recording.find_rules([recorded_dashboard(), alerts])
+    assert [(r.record, str(r.expr), r.count) for r in rules] == [
+        ('job:http_requests_total:rate5m', normalize(ERRORS), 3),
+        ('job:http_requests_total:rate5m_5df037', normalize(REQUESTS), 2),
+    ]
+    assert recording.find_rules([recorded_dashboard(), alerts], max_rules=1) == rules[:1]
+    assert recording.rules_yaml(rules[1:], interval='30s') == (
+        'groups:\n'
+        '  - name: "grafanalib"\n'
+        '    interval: 30s\n'
+        '    rules:\n'
+        '      - record: job:http_requests_total:rate5m_5df037\n'
+        '        expr: "sum by (job) (rate(http_requests_total[5m]))"\n'
+    )
+
+    rewritten = recording.rewrite_dashboard(recorded_dashboard(), rules)
+    exprs = [t.expr for p in rewritten._iter_panels() for t in getattr(p, 'targets', [])]
+    assert exprs == [
+        'job:http_requests_total:rate5m / job:http_requests_total:rate5m_5df037',
+        'job:http_requests_total:rate5m',
+        'max(rate(x[$__rate_interval]))',
+        'max(rate(x[$__rate_interval]))',
+        'sum (job:http_requests_total:rate5m_5df037)',
+        LOGS,
+        LOGS,
+    ]
+
+
+def test_extract_recording_rules_script(tmpdir):
+    definition = os.path.join(str(tmpdir), 'api.dashboard.py')
+    with open(definition, 'w') as f:
+        f.write('from grafanalib.tests.test_recording import recorded_dashboard\ndashboard = recorded_dashboard()\n')
+    rules = os.path.join(str(tmpdir), 'rules.yml')
+    assert _gen.extract_recording_rules([str(tmpdir), '-o', rules, '--rewrite']) == 0
+    with open(rules) as f:
+        assert f.read().count('record:') == 2
+    with open(os.path.join(str(tmpdir), 'api.json')) as f:
+        assert json.load(f)['panels'][1]['targets'][0]['expr'] == 'job:http_requests_total:rate5m_896259'
@@ -0,0 +1,99 @@
+"""Tests for build time schema upgrades."""
+
+import pytest
+
+import grafanalib.core as G
+from grafanalib import schema
+
+
+def test_default_schema_version_is_unchanged():
+    data = G.Dashboard(title='legacy', sharedCrosshair=True).to_json_data()
+    assert data['schemaVersion'] == G.SCHEMA_VERSION
+    assert data['sharedCrosshair'] is True
+    assert 'rows' in data
+
+
+def test_upgrade_to_latest_schema():
+    dashboard = G.Dashboard(
+        title='upgraded',
+        schemaVersion=G.LATEST_SCHEMA_VERSION,
+        sharedCrosshair=True,
+        templating=G.Templating([
+            G.Template(name='job', query='label_values(job)', dataSource='prom', multi=True, default='api'),
+        ]),
+        rows=[G.Row(title='Overview', panels=[
+            G.SingleStat(title='up', dataSource='prom', span=6, targets=[G.Target(expr='up')]),
+            G.BarGauge(title='gauge', dataSource='-- Mixed --', span=6),
+        ])],
+    )
+    data = schema.to_plain_json(dashboard.to_json_data())
+
+    assert data['schemaVersion'] == G.LATEST_SCHEMA_VERSION
+    assert data['graphTooltip'] == 1
+    assert 'rows' not in data and 'sharedCrosshair' not in data
+
+    row, stat, bar_gauge = data['panels']
+    assert row['type'] == 'row' and 'fieldConfig' not in row
+    assert stat['type'] == 'stat' and stat['autoMigrateFrom'] == 'singlestat'
+    assert stat['gridPos'] == {'h': 7, 'w': 12, 'x': 0, 'y': 1}
+    assert 'span' not in stat
+    assert stat['datasource'] == {'uid': 'prom'}
+    assert stat['targets'][0]['datasource'] == {'uid': 'prom'}
+    assert bar_gauge['datasource'] == {'type': 'datasource', 'uid': '-- Mixed --'}
+    assert 'fieldOptions' not in bar_gauge['options']
+    assert bar_gauge['options']['reduceOptions']['calcs'] == ['mean']
+    assert bar_gauge['fieldConfig']['defaults']['thresholds']['steps'][0] == {'color': 'green', 'value': None}
+
+    text = schema.upgrade_dashboard_json({
+        'schemaVersion': G.SCHEMA_VERSION, 'templating': {'list': []}, 'annotations': {'list': []},
+        'panels': [{'type': 'text', 'options': {'content': 'x'}}],
+    })['panels'][0]
+    assert 'fieldConfig' not in text
+
+    variable = data['templating']['list'][0]
+    assert variable['datasource'] == {'uid': 'prom'}
+    assert variable['current']['value'] == ['api']
+    assert variable['refresh'] == 1
+
+
+def test_upgrade_stops_at_requested_version():
+    data = schema.to_plain_json(G.Dashboard(
+        title='partial',
+        schemaVersion=27,
+        panels=[G.TimeSeries(dataSource='prom', gridPos=G.GridPos(h=8, w=12, x=0, y=0))],
+    ).to_json_data())
+    assert data['schemaVersion'] == 27
+    # Datasource references only arrive with schema version 33.
+    assert data['panels'][0]['datasource'] == 'prom'
+
+
+def test_known_datasources_and_table_cell_options():
+    data = schema.to_plain_json(G.Table(
+        title='table', dataSource='prom', displayMode='lcd-gauge',
+        gridPos=G.GridPos(h=8, w=12, x=0, y=0),
+    ).to_json_data())
+    dashboard = {'schemaVersion': G.SCHEMA_VERSION, 'panels': [data],
+                 'templating': {'list': []}, 'annotations': {'list': []}}
+    schema.upgrade_dashboard_json(dashboard, datasources={'prom': {'type': 'prometheus', 'uid': 'P1'}})
+    table = dashboard['panels'][0]
+    assert table['datasource'] == {'type': 'prometheus', 'uid': 'P1'}
+    custom = table['fieldConfig']['defaults']['custom']
+    assert 'displayMode' not in custom
+    assert custom['cellOptions'] == {'type': 'gauge', 'mode': 'lcd'}
+
+
+def test_cloudwatch_statistics_split():
+    dashboard = {'schemaVersion': 33, 'templating': {'list': []}, 'annotations': {'list': []}, 'panels': [
+        {'type': 'timeseries', 'targets': [
+            {'refId': 'A', 'namespace': 'AWS/EC2', 'statistics': ['Average', 'Maximum'], 'statistic': 'Average'},
+        ]},
+    ]}
+    schema.upgrade_dashboard_json(dashboard, 34)
+    targets = dashboard['panels'][0]['targets']
+    assert [(t['refId'], t['statistic']) for t in targets] == [('A', 'Average'), ('B', 'Maximum')]
+    assert not any('statistics' in t for t in targets)
+
+
+def test_upgrade_beyond_latest_fails():
+    with pytest.raises(ValueError):
+        schema.upgrade_dashboard_json({'schemaVersion': 12}, G.LATEST_SCHEMA_VERSION + 1)
@@ -0,0 +1,55 @@
+"""Tests for dashboard sharding."""
+
+import json
+import os
+
+import grafanalib.core as G
+from grafanalib import _gen, shard
+
+
+def big_dashboard():
+    panels = []
+    for row in range(4):
+        panels.append(G.RowPanel(title='row {}'.format(row), gridPos=G.GridPos(h=1, w=24, x=0, y=row * 9)))
+        for i in range(3):
+            panels.append(G.Stat(
+                title='stat {}/{}'.format(row, i), targets=[G.Target(expr='up')],
+                gridPos=G.GridPos(h=8, w=8, x=i * 8, y=row * 9 + 1)))
+    return G.Dashboard(
+        title='Big', uid='big', panels=panels,
+        templating=G.Templating([G.Template(name='job', query='label_values(job)')]),
+    )
+
+
+def test_shard_by_panel_count():
+    shards = shard.shard_dashboard(big_dashboard(), max_panels=9)
+    assert [s.uid for s in shards] == ['big', 'big-2']
+    assert [s.title for s in shards] == ['Big (1/2)', 'Big (2/2)']
+    # Rows stay together.
+    assert [len(s.panels) for s in shards] == [8, 8]
+    assert shards[1].panels[0].title == 'row 2'
+    assert shards[1].panels[0].gridPos.y == 0 and shards[1].panels[1].gridPos.y == 1
+    for s in shards:
+        assert s.templating == shards[0].templating
+        assert 'shard:big' in s.tags
+        assert s.links[-1].tags == ['shard:big'] and s.links[-1].includeVars
+
+    dashboard = big_dashboard()
+    assert shard.shard_dashboard(dashboard, max_panels=100) == [dashboard]
+
+
+def test_shard_by_size(tmpdir):
+    dashboard = big_dashboard()
+    size = len(json.dumps(dashboard.to_json_data(), cls=_gen.DashboardEncoder, sort_keys=True, indent=2))
+    shards = shard.shard_dashboard(dashboard, max_bytes=size // 2)
+    assert len(shards) >= 2
+    for s in shards:
+        written = json.dumps(s.to_json_data(), cls=_gen.DashboardEncoder, sort_keys=True, indent=2)
+        assert len(written) <= size // 2
+
+    definition = os.path.join(str(tmpdir), 'big.dashboard.py')
+    with open(definition, 'w') as f:
+        f.write('from grafanalib.tests.test_shard import big_dashboard\ndashboard = big_dashboard()\n')
+    assert _gen.generate_dashboards(['--max-panels', '5', definition]) == 0
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'big-2.json', 'big-3.json', 'big-4.json', 'big.dashboard.py', 'big.json']
@@ -73,3 +73,40 @@ def test_list_of_raises():
     with pytest.raises(ValueError):
         val = validators.is_list_of(etype)
         val(None, create_attribute(), check)
+
+
+def test_deferred_validation_collects_all_errors():
+    import grafanalib.core as G
+
+    with validators.deferred_validation():
+        dashboard = G.Dashboard(
+            title='deferred',
+            editable='yes',
+            panels=[
+                G.TimeSeries(title='a', targets=[G.Target(instant='no')]),
+                G.Stat(title='b', transparent=1),
+            ],
+        ).auto_panel_ids()
+
+    with pytest.raises(validators.ValidationError) as e:
+        validators.validate_all(dashboard)
+    paths = [path for path, _ in e.value.errors]
+    assert paths == [
+        'Dashboard.editable',
+        'Dashboard.panels[0].targets[0].instant',
+        'Dashboard.panels[1].transparent',
+    ]
+
+    # Eager validation is restored when the block exits.
+    with pytest.raises(TypeError):
+        G.Dashboard(title='eager', editable='yes')
+
+
+def test_validate_all_returns_valid_tree():
+    import grafanalib.core as G
+
+    with validators.deferred_validation():
+        group = G.AlertGroup(name='group', rules=[
+            G.AlertRulev9(title='rule', triggers=[G.Target(refId='A')]),
+        ])
+    assert validators.validate_all(group) is group
@@ -0,0 +1,131 @@
+"""Tests for template variable dependencies and snapshots."""
+
+import json
+import os
+
+import attr
+import pytest
+
+import grafanalib.core as G
+from grafanalib import _gen, variables
+
+
+def chained_dashboard():
+    return G.Dashboard(title='k8s', templating=G.Templating([
+        G.Template(name='pod', query='label_values(kube_pod_info{namespace="${namespace}"}, pod)',
+                   refresh=G.REFRESH_ON_TIME_RANGE_CHANGE),
+        G.Template(name='namespace', query='label_values(kube_pod_info{cluster=~"[[cluster]]"}, namespace)',
+                   dataSource='$ds'),
+        G.Template(name='ds', type='datasource', query='prometheus'),
+        G.Template(name='cluster', query='label_values(up, cluster)', refresh=G.REFRESH_ON_TIME_RANGE_CHANGE),
+        G.Template(name='top', query='query_result(topk(5, sum by (job) (increase(x[$__range]))))'),
+        G.Template(name='env', query='label_values(env)', options=[{'text': 'prod', 'value': 'prod'}]),
+    ]))
+
+
+def test_dependency_graph():
+    assert variables.references('${a:csv} [[b]] $c_d $__range') == {'a', 'b', 'c_d', '__range'}
+    templates = chained_dashboard().templating.list
+    assert variables.dependency_graph(templates) == {
+        'pod': ['namespace'], 'namespace': ['cluster', 'ds'], 'ds': [], 'cluster': [], 'top': [], 'env': [],
+    }
+    ordered = [t.name for t in variables.order_templates(templates)]
+    assert ordered == ['ds', 'cluster', 'namespace', 'pod', 'top', 'env']
+
+    loop = [G.Template(name='a', query='$c'), G.Template(name='b', query='$a'), G.Template(name='c', query='$b')]
+    assert variables.find_cycle(variables.dependency_graph(loop)) == ['a', 'c', 'b', 'a']
+    with pytest.raises(ValueError):
+        variables.order_templates(loop)
+
+
+def test_optimize_variables():
+    # Grafana resets query variables of dashboards with the default schema
+    # version to refresh on load, so none is recommended not to refresh.
+    assert variables.recommend_refresh(chained_dashboard()) == {
+        'pod': (G.REFRESH_ON_TIME_RANGE_CHANGE, G.REFRESH_ON_DASHBOARD_LOAD),
+        'cluster': (G.REFRESH_ON_TIME_RANGE_CHANGE, G.REFRESH_ON_DASHBOARD_LOAD),
+        'top': (G.REFRESH_ON_DASHBOARD_LOAD, G.REFRESH_ON_TIME_RANGE_CHANGE),
+    }
+
+    dashboard = attr.evolve(chained_dashboard(), schemaVersion=variables.NEVER_REFRESH_SCHEMA_VERSION)
+    assert variables.recommend_refresh(dashboard)['env'] == (G.REFRESH_ON_DASHBOARD_LOAD, G.REFRESH_NEVER)
+    optimized = variables.optimize_variables(dashboard)
+    assert [(t.name, t.refresh) for t in optimized.templating.list] == [
+        ('ds', G.REFRESH_ON_DASHBOARD_LOAD),
+        ('cluster', G.REFRESH_ON_DASHBOARD_LOAD),
+        ('namespace', G.REFRESH_ON_DASHBOARD_LOAD),
+        ('pod', G.REFRESH_ON_DASHBOARD_LOAD),
+        ('top', G.REFRESH_ON_TIME_RANGE_CHANGE),
+        ('env', G.REFRESH_NEVER),
+    ]
+
+
+def test_snapshot_variables(tmpdir):
+    fixture = os.path.join(str(tmpdir), 'variables.json')
+    with open(fixture, 'w') as f:
+        json.dump({
+            'label_values(up, cluster)': {'values': ['us-1', 'eu-1', 'eu-1', 'a,b'], 'timestamp': 9000},
+            'label_values(up, instance)': {'values': ['web-1:9100', 'db-1:9100', 'web-2:9100']},
+            'label_values(up, job)': {'values': ['old'], 'timestamp': 0},
+        }, f)
+    dashboard = G.Dashboard(title='snap', templating=G.Templating([
+        G.Template(name='cluster', query='label_values(up, cluster)', default='eu-1', includeAll=True),
+        G.Template(name='host', query='label_values(up, instance)', regex='/(web-\\d+):.*/',
+                   sort=G.SORT_ALPHA_DESC),
+        G.Template(name='job', query='label_values(up, job)'),
+        G.Template(name='pod', query='label_values(up{cluster="$cluster"}, pod)'),
+        G.Template(name='unknown', query='label_values(up, unknown)'),
+    ]))
+    snapshot = variables.snapshot_variables(dashboard, variables.FixtureResolver(fixture), max_age=3600, now=10000)
+    cluster, host, job, pod, unknown = snapshot.templating.list
+    assert (cluster.type, cluster.query, cluster.includeAll) == ('custom', 'a\\,b,eu-1,us-1', True)
+    assert cluster.to_json_data()['current'] == {'selected': True, 'text': 'eu-1', 'value': 'eu-1'}
+    assert [o['value'] for o in cluster.options] == ['a,b', 'eu-1', 'us-1']
+    assert [o['value'] for o in host.options] == ['web-2', 'web-1']
+    assert host.options[0]['selected']
+    assert [t.type for t in (job, pod, unknown)] == ['query', 'query', 'query']
+
+    with pytest.raises(ValueError):
+        variables.snapshot_variables(dashboard, variables.FixtureResolver(fixture), max_age=3600, strict=True)
+
+    definition = os.path.join(str(tmpdir), 'snap.dashboard.py')
+    with open(definition, 'w') as f:
+        f.write('from grafanalib.tests.test_variables import chained_dashboard\ndashboard = chained_dashboard()\n')
+    assert _gen.generate_dashboards([definition, '--variable-fixture', fixture]) == 0
+    with open(os.path.join(str(tmpdir), 'snap.json')) as f:
+        written = {t['name']: t for t in json.load(f)['templating']['list']}
+    assert written['cluster']['type'] == 'custom'
+    assert _gen.generate_dashboards([definition, '--variable-fixture', fixture, '--max-variable-age', '1h']) == 1
+
+
+def test_set_all_values():
+    from grafanalib.elasticsearch import ElasticsearchTarget
+
+    dashboard = G.Dashboard(
+        title='all',
+        templating=G.Templating([
+            G.Template(name='job', query='label_values(job)', includeAll=True),
+            G.Template(name='svc', query='label_values(up, service)', includeAll=True),
+            G.Template(name='host', query='{"find": "terms", "field": "host"}', includeAll=True),
+            G.Template(name='pod', query='label_values(up, pod)', includeAll=True),
+            G.Template(name='env', query='label_values(up{team="a"}, env)', includeAll=True),
+            G.Template(name='dc', type='custom', query=','.join('dc-{}'.format(i) for i in range(100)),
+                       includeAll=True),
+        ]),
+        panels=[
+            G.TimeSeries(targets=[
+                G.Target(expr='sum(rate(x{job=~"$job", service=~"$svc", env=~"${env}", dc=~"$dc"}[5m]))'),
+                G.Target(expr='up{pod="$pod"}'),
+            ]),
+            G.Logs(targets=[ElasticsearchTarget(query='host:$host AND level:error')]),
+        ],
+    )
+    with pytest.warns(UserWarning, match="'dc'"):
+        result = variables.set_all_values(dashboard, max_size=100)
+    # label_values(up, service) only selects the services of up, a wildcard
+    # would select those of every metric.
+    assert [t.allValue for t in result.templating.list] == ['.+', None, '*', None, None, None]
+    assert variables.all_value_wildcard(dashboard, 'env') == '.+'
+    # Grafana does not escape "-".
+    assert variables.all_value_size(result.templating.list[-1]) == 2 + 10 * 4 + 90 * 5 + 99
+    assert variables.grafana_regex_escape('a.b-c') == 'a\\\\.b-c'
@@ -0,0 +1,24 @@
+"""Tests for Weave-specific helpers."""
+
+import pytest
+
+from grafanalib import weave
+
+
+def test_qps_graph():
+    graph = weave.QPSGraph('prom', 'QPS', ['a', 'b', 'c', 'd', 'e'])
+    assert [(t.refId, t.legendFormat, t.expr) for t in graph.targets] == [
+        ('A', '1xx', 'a'), ('B', '2xx', 'b'), ('C', '3xx', 'c'), ('D', '4xx', 'd'), ('E', '5xx', 'e')]
+    with pytest.raises(ValueError):
+        weave.QPSGraph('prom', 'QPS', ['a', 'b'])
+
+
+def test_qps_graph_single_query():
+    graph = weave.QPSGraph('prom', 'QPS', 'rate(request_duration_seconds_count{job="api"}[1m])', code_label='code')
+    assert len(graph.targets) == 1
+    target = graph.targets[0]
+    assert (target.refId, target.legendFormat) == ('A', '{{code_class}}')
+    assert str(target.expr) == (
+        'sum by (code_class) (label_replace(rate(request_duration_seconds_count{job="api"}[1m]), '
+        '"code_class", "${1}xx", "code", "([1-5]).*"))')
+    assert graph.stack and set(graph.aliasColors) >= {'1xx', '2xx', '3xx', '4xx', '5xx'}
@@ -1,4 +1,6 @@
+import contextlib
 import re
+
 import attr
 
 
@@ -82,3 +84,103 @@ def is_list_of(etype):
     :param choices: List of valid choices
     """
     return _ListOfValidator(etype)
+
+
+class ValidationError(ValueError):
+    """Raised by :func:`validate_all` with every validation error found.
+
+    :param errors: list of ``(path, exception)`` tuples, where ``path``
+        describes where in the object tree the invalid value lives, e.g.
+        ``Dashboard.panels[2].targets[0].instant``.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(ValidationError, self).__init__('\n'.join(
+            '{}: {}'.format(path, error) for path, error in errors))
+
+
+@contextlib.contextmanager
+def deferred_validation():
+    """
+    A context manager that skips per-field validators while objects are built.
+
+    Everything constructed inside the block (including the copies made by
+    ``attr.evolve`` in helpers such as ``Dashboard.auto_panel_ids``) is left
+    unvalidated. Pass the finished object to :func:`validate_all` to check
+    it in a single pass. Using the block without calling
+    :func:`validate_all` afterwards is the trusted fast path: it is only
+    safe for definitions that have already been validated elsewhere, e.g.
+    in CI.
+
+    The switch is process wide, so it should not be used while other
+    threads are building objects that expect eager validation.
+    """
+    previous = attr.validators.get_disabled()
+    attr.validators.set_disabled(True)
+    try:
+        yield
+    finally:
+        attr.validators.set_disabled(previous)
+
+
+_fields_cache = {}
+
+
+def _validated_fields(cls):
+    """Return ``(attribute, validator)`` pairs for the fields of ``cls``."""
+    try:
+        return _fields_cache[cls]
+    except KeyError:
+        fields = [(a, a.validator) for a in attr.fields(cls)]
+        _fields_cache[cls] = fields
+        return fields
+
+
+def validate_all(obj):
+    """
+    Run every attrs validator in an object tree and collect all failures.
+
+    The tree is walked once; objects shared between several parents (for
+    instance a ``Target`` reused by two panels, or module level defaults
+    such as ``DEFAULT_TIME``) are only checked the first time they are
+    reached.
+
+    :param obj: the root of the tree, usually a ``Dashboard`` or an
+        ``AlertGroup``
+    :returns: ``obj``, so the call can be chained
+    :raises ValidationError: if any validator failed
+    """
+    errors = []
+    seen = set()
+    stack = [(type(obj).__name__, obj)]
+    while stack:
+        path, value = stack.pop()
+        cls = type(value)
+        if isinstance(value, (str, bytes, int, float, type(None))):
+            continue
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        if attr.has(cls):
+            children = []
+            for attribute, validator in _validated_fields(cls):
+                field = getattr(value, attribute.name)
+                if validator is not None:
+                    try:
+                        validator(value, attribute, field)
+                    except (TypeError, ValueError) as e:
+                        errors.append(('{}.{}'.format(path, attribute.name), e))
+                children.append(('{}.{}'.format(path, attribute.name), field))
+            stack.extend(reversed(children))
+        elif isinstance(value, (list, tuple)):
+            stack.extend(reversed([
+                ('{}[{}]'.format(path, i), item) for i, item in enumerate(value)
+            ]))
+        elif isinstance(value, dict):
+            stack.extend(reversed([
+                ('{}[{!r}]'.format(path, key), item) for key, item in value.items()
+            ]))
+    if errors:
+        raise ValidationError(errors)
+    return obj
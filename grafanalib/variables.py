@@ -0,0 +1,516 @@
+"""Dependencies between the template variables of a dashboard.
+
+Variables refer to other variables in their query, regex or datasource
+(``$cluster`` -> ``$namespace`` -> ``$pod``). Grafana queries a variable
+again whenever one it depends on changes, and needs them listed after the
+variables they depend on. The helpers here find the references, order
+``Templating.list`` accordingly, and pick the cheapest refresh mode of each
+query variable that still keeps its values right:
+
+* ``REFRESH_ON_TIME_RANGE_CHANGE`` only for variables whose own query uses
+  the time range, such as ``$__range``. Variables depending on them are
+  queried again anyway when their values change;
+* ``REFRESH_NEVER`` for variables whose options are given in the definition
+  and that do not depend on other variables, on dashboards with a
+  ``schemaVersion`` of at least 29. Grafana migrates older dashboards by
+  clearing the options of query variables and querying them on load, so
+  variables of dashboards with the default ``schemaVersion`` should rather
+  be snapshot into custom variables;
+* ``REFRESH_ON_DASHBOARD_LOAD`` for the others.
+
+Query variables whose values rarely change can also be resolved at build
+time with ``snapshot_variables``, which turns them into custom variables so
+that opening the dashboard does not query them at all. Values come from a
+resolver: any callable taking a ``Template`` and returning a ``Resolution``,
+such as ``FixtureResolver`` reading them from a file.
+
+``set_all_values`` gives query variables with an All option a wildcard
+``allValue`` where every query uses them as a whole regex or Lucene term,
+so that selecting All does not inline every value into the queries.
+"""
+
+import json
+import re
+import time
+import warnings
+
+import attr
+from attr.validators import instance_of, optional
+
+from grafanalib.core import (
+    REFRESH_NEVER, REFRESH_ON_DASHBOARD_LOAD, REFRESH_ON_TIME_RANGE_CHANGE,
+    SCHEMA_VERSION, SORT_ALPHA_ASC, SORT_ALPHA_DESC, SORT_ALPHA_IGNORE_CASE_ASC,
+    SORT_ALPHA_IGNORE_CASE_DESC, SORT_NUMERIC_ASC, SORT_NUMERIC_DESC, Template,
+)
+
+# $name, ${name}, ${name:format} and [[name]].
+VARIABLE_REFERENCE = re.compile(r'\$\{(\w+)(?::[^}]*)?\}|\[\[(\w+)(?::\w+)?\]\]|\$(\w+)')
+
+# Global variables whose value depends on the time range.
+TIME_RANGE_VARIABLES = frozenset([
+    '__from', '__to', '__range', '__range_s', '__range_ms',
+    '__interval', '__interval_ms', '__rate_interval', '__timeFilter', 'timeFilter',
+])
+
+# Fields of a template that may refer to other variables.
+REFERENCING_FIELDS = ('query', 'regex', 'dataSource', 'datasource')
+
+# First schema version whose query variables Grafana does not reset to
+# refresh on load, dropping their options.
+NEVER_REFRESH_SCHEMA_VERSION = 29
+
+
+def _get(obj, name, default=None):
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+
+def references(obj):
+    """Return the names of the variables referred to in a string, or in
+    the strings of a dict or list."""
+    if isinstance(obj, str):
+        return set(a or b or c for a, b, c in VARIABLE_REFERENCE.findall(obj))
+    if isinstance(obj, dict):
+        values = obj.values()
+    elif isinstance(obj, (list, tuple)):
+        values = obj
+    else:
+        return set()
+    names = set()
+    for value in values:
+        names.update(references(value))
+    return names
+
+
+def template_references(template):
+    """Return the names of the variables a template refers to."""
+    names = set()
+    for field in REFERENCING_FIELDS:
+        names.update(references(_get(template, field)))
+    names.discard(_get(template, 'name'))
+    return names
+
+
+def dependency_graph(templates):
+    """Return the variables each of a list of templates depends on.
+
+    :returns: dict of the sorted names of the templates each one refers to,
+        by template name, in the order of ``templates``
+    """
+    names = set(_get(t, 'name') for t in templates)
+    return {
+        _get(t, 'name'): sorted(template_references(t) & names)
+        for t in templates
+    }
+
+
+def find_cycle(graph):
+    """Return a list of variables that depend on each other in a loop, the
+    first one repeated at the end, or ``None`` if there is no loop."""
+    visiting, done = [], set()
+
+    def visit(name):
+        if name in done:
+            return None
+        if name in visiting:
+            return visiting[visiting.index(name):] + [name]
+        visiting.append(name)
+        for dependency in graph.get(name, []):
+            cycle = visit(dependency)
+            if cycle:
+                return cycle
+        visiting.pop()
+        done.add(name)
+        return None
+
+    for name in graph:
+        cycle = visit(name)
+        if cycle:
+            return cycle
+    return None
+
+
+def order_templates(templates):
+    """Order templates after the variables they depend on.
+
+    Templates keep their order where dependencies allow.
+
+    :raises ValueError: if variables depend on each other in a loop
+    """
+    graph = dependency_graph(templates)
+    cycle = find_cycle(graph)
+    if cycle:
+        raise ValueError('Variables depend on each other: {}'.format(' -> '.join(cycle)))
+    ordered, placed = [], set()
+    remaining = list(templates)
+    while remaining:
+        for index, template in enumerate(remaining):
+            if all(dependency in placed for dependency in graph[_get(template, 'name')]):
+                break
+        template = remaining.pop(index)
+        ordered.append(template)
+        placed.add(_get(template, 'name'))
+    return ordered
+
+
+def cheapest_refresh(template, schemaVersion=SCHEMA_VERSION):
+    """Return the cheapest refresh mode that keeps a template's values right,
+    ``None`` for templates that are not queried.
+
+    :param schemaVersion: schema version of the dashboard of the template;
+        ``REFRESH_NEVER`` is only returned from ``NEVER_REFRESH_SCHEMA_VERSION``
+        on, as Grafana resets the refresh mode of older dashboards
+    """
+    if _get(template, 'type', 'query') != 'query':
+        return None
+    own = set()
+    for field in REFERENCING_FIELDS:
+        own.update(references(_get(template, field)))
+    if own & TIME_RANGE_VARIABLES:
+        return REFRESH_ON_TIME_RANGE_CHANGE
+    never = schemaVersion >= NEVER_REFRESH_SCHEMA_VERSION
+    if never and _get(template, 'options') and not template_references(template):
+        return REFRESH_NEVER
+    return REFRESH_ON_DASHBOARD_LOAD
+
+
+def recommend_refresh(dashboard):
+    """Return the query variables of a dashboard whose refresh mode could
+    be cheaper, or must change to keep their values right.
+
+    :returns: dict of ``(current, recommended)`` refresh modes by name
+    """
+    changes = {}
+    for template in dashboard.templating.list:
+        refresh = cheapest_refresh(template, dashboard.schemaVersion)
+        if refresh is not None and refresh != _get(template, 'refresh'):
+            changes[_get(template, 'name')] = (_get(template, 'refresh'), refresh)
+    return changes
+
+
+def optimize_variables(dashboard):
+    """Order the variables of a dashboard and set their refresh modes.
+
+    Returns a new ``Dashboard`` whose ``Templating.list`` is ordered with
+    ``order_templates`` and whose query variables get the refresh mode of
+    ``cheapest_refresh``. Variables given as dicts are ordered but left
+    as they are.
+
+    :raises ValueError: if variables depend on each other in a loop
+    """
+    recommended = recommend_refresh(dashboard)
+    templates = []
+    for template in order_templates(dashboard.templating.list):
+        name = _get(template, 'name')
+        if name in recommended and not isinstance(template, dict):
+            template = attr.evolve(template, refresh=recommended[name][1])
+        templates.append(template)
+    return attr.evolve(dashboard, templating=attr.evolve(dashboard.templating, list=templates))
+
+
+@attr.s
+class Resolution(object):
+    """Values of a query variable, as returned by a resolver.
+
+    :param values: list of the values of the variable
+    :param timestamp: when the values were resolved, in seconds since the
+        epoch, ``None`` if just now
+    """
+
+    values = attr.ib(validator=instance_of(list))
+    timestamp = attr.ib(default=None, validator=optional(instance_of((int, float))))
+
+
+@attr.s
+class FixtureResolver(object):
+    """Resolve query variables from a JSON file, for offline builds.
+
+    The file maps variable queries to their values and when they were
+    resolved::
+
+        {"label_values(up, cluster)": {"values": ["eu-1", "us-1"], "timestamp": 1760000000}}
+
+    Queries that are not in the file are not resolved.
+
+    :param path: path to the JSON file
+    """
+
+    path = attr.ib(validator=instance_of(str))
+    _fixture = attr.ib(init=False, default=None)
+
+    def __call__(self, template):
+        if self._fixture is None:
+            with open(self.path) as fixture_file:
+                self._fixture = json.load(fixture_file)
+        entry = self._fixture.get(_get(template, 'query'))
+        if entry is None:
+            return None
+        return Resolution(values=list(entry['values']), timestamp=entry.get('timestamp'))
+
+
+def _regex(text):
+    """Compile a ``/pattern/flags`` regex as written in Grafana."""
+    match = re.match(r'^/(.*)/([gimsuy]*)$', text, re.S)
+    if not match:
+        return re.compile(text)
+    return re.compile(match.group(1), re.I if 'i' in match.group(2) else 0)
+
+
+def _numeric(value):
+    match = re.search(r'-?\d+(?:\.\d+)?', value)
+    return float(match.group()) if match else float('-inf')
+
+
+SORT_KEYS = {
+    SORT_ALPHA_ASC: (str, False),
+    SORT_ALPHA_DESC: (str, True),
+    SORT_NUMERIC_ASC: (_numeric, False),
+    SORT_NUMERIC_DESC: (_numeric, True),
+    SORT_ALPHA_IGNORE_CASE_ASC: (str.lower, False),
+    SORT_ALPHA_IGNORE_CASE_DESC: (str.lower, True),
+}
+
+
+def template_options(template, values):
+    """Return the values of a query variable as Grafana shows them: filtered
+    with its regex, first group only when it has one, without duplicates and
+    sorted its way."""
+    values = [str(v) for v in values]
+    regex = _get(template, 'regex')
+    if regex:
+        pattern = _regex(regex)
+        matched = []
+        for value in values:
+            match = pattern.search(value)
+            if match:
+                matched.append(match.group(1) if pattern.groups else value)
+        values = matched
+    values = list(dict.fromkeys(values))
+    key = SORT_KEYS.get(_get(template, 'sort'))
+    if key:
+        values.sort(key=key[0], reverse=key[1])
+    return values
+
+
+def escape_custom_value(value):
+    """Escape a value for the comma separated query of a custom variable."""
+    return value.replace(',', '\\,')
+
+
+def snapshot_template(template, values):
+    """Return a custom variable with the given values in place of a query
+    variable, keeping its name, label, selection and display settings."""
+    values = template_options(template, values)
+    default = template.default
+    if default not in values and not (template.includeAll and default in ('$__all', 'All')):
+        default = values[0] if values else None
+    return Template(
+        name=template.name,
+        type='custom',
+        query=','.join(escape_custom_value(v) for v in values),
+        default=default,
+        label=template.label,
+        hide=template.hide,
+        includeAll=template.includeAll,
+        allValue=template.allValue,
+        multi=template.multi,
+        minimalOptions=template.minimalOptions,
+    )
+
+
+def _can_snapshot(template, names):
+    if not isinstance(template, Template) or template.type != 'query':
+        return False
+    if names is not None and template.name not in names:
+        return False
+    return not template_references(template) and not references(template.query) & TIME_RANGE_VARIABLES
+
+
+def snapshot_variables(dashboard, resolver, max_age=None, names=None, now=None, strict=False):
+    """Resolve query variables at build time into custom variables.
+
+    Only query variables that do not refer to other variables or to the
+    time range can be resolved, as the values of the others depend on what
+    is selected when the dashboard is viewed. Variables the resolver does not
+    know, or whose values are older than ``max_age``, stay query variables.
+
+    :param dashboard: a ``Dashboard``
+    :param resolver: callable returning the ``Resolution`` of a ``Template``,
+        or ``None`` if it cannot resolve it
+    :param max_age: oldest values to use, in seconds, ``None`` for any
+    :param names: names of the variables to resolve, ``None`` for all
+    :param now: the current time in seconds since the epoch, for tests
+    :param strict: raise ``ValueError`` instead of keeping variables whose
+        values are too old
+    :returns: a new ``Dashboard``
+    """
+    now = time.time() if now is None else now
+    templates = []
+    for template in dashboard.templating.list:
+        if _can_snapshot(template, names):
+            resolution = resolver(template)
+            stale = False
+            if resolution is not None and max_age is not None and resolution.timestamp is not None:
+                stale = now - resolution.timestamp > max_age
+            if stale and strict:
+                raise ValueError('Values of variable {!r} are {:.0f}s old, more than {}s'.format(
+                    template.name, now - resolution.timestamp, max_age))
+            if resolution is not None and not stale:
+                template = snapshot_template(template, resolution.values)
+        templates.append(template)
+    return attr.evolve(dashboard, templating=attr.evolve(dashboard.templating, list=templates))
+
+
+# allValue matching every value in PromQL and LogQL regex matchers, and in
+# Lucene queries. Like the values of the label, they only match series and
+# documents that have it.
+ALL_VALUE_REGEX = '.+'
+ALL_VALUE_LUCENE = '*'
+
+# Characters Grafana's Prometheus datasource escapes in the values of
+# variables it puts in a regex.
+GRAFANA_REGEX_SPECIAL = re.compile(r"[$^*{}\[\]'+?.()|]")
+
+# Queries of all the values of a label: label_values(label) for Prometheus,
+# and checked in _can_use_wildcard for Elasticsearch terms.
+_ALL_LABEL_VALUES = re.compile(r'^\s*label_values\(\s*[\w.]+\s*\)\s*$')
+
+# Longest All expansion, in characters, set_all_values lets through quietly.
+DEFAULT_MAX_ALL_SIZE = 4096
+
+
+def _strings(obj):
+    """Yield the strings of a target, dict or list."""
+    if isinstance(obj, str):
+        yield obj
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            for text in _strings(value):
+                yield text
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            for text in _strings(value):
+                yield text
+    elif attr.has(type(obj)):
+        for field in attr.fields(type(obj)):
+            for text in _strings(getattr(obj, field.name)):
+                yield text
+
+
+def _query_strings(dashboard, name):
+    """Yield the strings of the targets and other variables of a dashboard."""
+    for panel in dashboard._iter_panels():
+        for target in getattr(panel, 'targets', None) or []:
+            for text in _strings(target):
+                yield text
+    for template in dashboard.templating.list:
+        if _get(template, 'name') != name:
+            for field in ('query', 'regex'):
+                for text in _strings(_get(template, field)):
+                    yield text
+
+
+def all_value_wildcard(dashboard, name):
+    """Return the wildcard ``allValue`` that can stand for every value of
+    variable ``name`` in the queries of a dashboard.
+
+    That is ``ALL_VALUE_REGEX`` if every reference to the variable is the
+    whole value of a regex label matcher (``label=~"$name"``),
+    ``ALL_VALUE_LUCENE`` if every reference is the whole term of a Lucene
+    field (``field:$name``), and ``None`` otherwise, or if it is not used.
+    """
+    ref = r'(?:\$%(name)s\b|\$\{%(name)s(?::\w+)?\}|\[\[%(name)s(?::\w+)?\]\])' % {'name': re.escape(name)}
+    plain = r'(?:\$%(name)s\b|\$\{%(name)s\}|\[\[%(name)s\]\])' % {'name': re.escape(name)}
+    contexts = (
+        (ALL_VALUE_REGEX, re.compile(r'\w+\s*=~\s*"%s"' % plain)),
+        (ALL_VALUE_LUCENE, re.compile(r'[\w.@-]+:\(?%s\)?(?![\w*?])' % plain)),
+    )
+    counts = dict.fromkeys([wildcard for wildcard, _ in contexts], 0)
+    total = 0
+    for text in _query_strings(dashboard, name):
+        total += len(re.findall(ref, text))
+        for wildcard, pattern in contexts:
+            counts[wildcard] += len(pattern.findall(text))
+    for wildcard, count in counts.items():
+        if total and count == total:
+            return wildcard
+    return None
+
+
+def all_value_size(template, resolver=None):
+    """Return the length of the regex Grafana puts in queries for the All
+    option of a template, ``None`` if its values are not known.
+
+    :param resolver: resolver of the values of query variables, see
+        ``snapshot_variables``
+    """
+    if template.type == 'custom':
+        values = [option['value'] for option in template.options]
+    else:
+        resolution = resolver(template) if resolver is not None else None
+        if resolution is None:
+            return None
+        values = template_options(template, resolution.values)
+    return len('({})'.format('|'.join(grafana_regex_escape(v) for v in values)))
+
+
+def grafana_regex_escape(value):
+    """Escape a value the way Grafana's Prometheus datasource does when it
+    puts the values of a variable in a regex matcher."""
+    value = value.replace('\\', '\\\\\\\\')
+    return GRAFANA_REGEX_SPECIAL.sub(lambda match: '\\\\' + match.group(0), value)
+
+
+def _selects_all_values(query):
+    if not isinstance(query, str):
+        return False
+    if _ALL_LABEL_VALUES.match(query):
+        return True
+    try:
+        data = json.loads(query)
+    except ValueError:
+        return False
+    return isinstance(data, dict) and data.get('find') == 'terms' and not data.get('query')
+
+
+def _can_use_wildcard(template):
+    # Custom values, regex filters and queries of the values of a label for
+    # some metric or documents only select some of the values of the label,
+    # which a wildcard would not.
+    if template.type != 'query' or not template.includeAll or template.allValue is not None:
+        return False
+    return not template.regex and _selects_all_values(template.query)
+
+
+def set_all_values(dashboard, max_size=DEFAULT_MAX_ALL_SIZE, resolver=None):
+    """Give query variables with an All option a wildcard ``allValue``.
+
+    Variables get the wildcard of ``all_value_wildcard`` when they have no
+    ``allValue`` yet, and select every value of a label: their query is
+    ``label_values(label)``, without a metric, or an Elasticsearch terms
+    query without a filter, and they have no ``regex``. A warning is issued for each
+    variable with an All option still expanding into a regex longer than
+    ``max_size``.
+
+    :param dashboard: a ``Dashboard``
+    :param max_size: longest All expansion to let through without a warning
+    :param resolver: resolver of the values of query variables, to size
+        their All expansion, see ``snapshot_variables``
+    :returns: a new ``Dashboard``
+    """
+    templates = []
+    for template in dashboard.templating.list:
+        if isinstance(template, Template) and _can_use_wildcard(template):
+            wildcard = all_value_wildcard(dashboard, template.name)
+            if wildcard is not None:
+                template = attr.evolve(template, allValue=wildcard)
+        if isinstance(template, Template) and template.includeAll and template.allValue is None:
+            size = all_value_size(template, resolver)
+            if size is not None and size > max_size:
+                warnings.warn(
+                    'All option of variable {!r} expands into a {} character regex, '
+                    'more than {}'.format(template.name, size, max_size),
+                    stacklevel=2)
+        templates.append(template)
+    return attr.evolve(dashboard, templating=attr.evolve(dashboard.templating, list=templates))
@@ -27,20 +27,51 @@ ALIAS_COLORS = {
 }
 
 
-def QPSGraph(data_source, title, expressions, **kwargs):
+# Label the single query of ``QPSGraph`` groups series by.
+CODE_CLASS_LABEL = 'code_class'
+
+
+def code_class_rate(expr, code_label='status_code'):
+    """Sum a rate of requests by class of response code.
+
+    ``rate(...)`` becomes ``sum by (code_class) (label_replace(rate(...),
+    "code_class", "${1}xx", "status_code", "([1-5]).*"))``, one series per
+    class named like the keys of ``ALIAS_COLORS``.
+
+    :param expr: rate of requests, as text or a ``prometheus.Expr``, with a
+        label holding the response code
+    :param code_label: name of that label
+    """
+    args = [CODE_CLASS_LABEL, '${1}xx', code_label, '([1-5]).*']
+    classified = prometheus.call(
+        'label_replace', expr, *[prometheus.intern(prometheus.String(a)) for a in args])
+    return prometheus.aggregate('sum', classified, by=[CODE_CLASS_LABEL])
+
+
+def QPSGraph(data_source, title, expressions, code_label='status_code', **kwargs):
     """Create a graph of QPS, broken up by response code.
 
     Data is drawn from Prometheus.
 
     :param title: Title of the graph.
-    :param expressions: List of Prometheus expressions. Must be 5.
+    :param expressions: List of Prometheus expressions, one per key of
+        ``ALIAS_COLORS``. Must be 5 or 7. Or a single rate expression, text
+        or ``prometheus.Expr``, which is broken up by response code in one
+        query, see ``code_class_rate``.
+    :param code_label: Label of the response code, for a single expression.
     :param kwargs: Passed on to Graph.
     """
-    if len(expressions) != 5 and len(expressions) != 7:
+    if isinstance(expressions, (str, prometheus.Expr)):
+        exprs = [{
+            'expr': code_class_rate(expressions, code_label),
+            'legendFormat': '{{%s}}' % CODE_CLASS_LABEL,
+        }]
+    elif len(expressions) != 5 and len(expressions) != 7:
         raise ValueError('Expected 5 or 7 expressions, got {}: {}'.format(
             len(expressions), expressions))
-    legends = sorted(ALIAS_COLORS.keys())
-    exprs = zip(legends, expressions)
+    else:
+        legends = sorted(ALIAS_COLORS.keys())
+        exprs = zip(legends, expressions)
     return stacked(prometheus.PromGraph(
         data_source=data_source,
         title=title,
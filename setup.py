@@ -40,7 +40,7 @@ setup(
         'Topic :: System :: Monitoring',
     ],
     install_requires=[
-        'attrs>=15.2.0',
+        'attrs>=21.3.0',
     ],
     extras_require={
         'dev': [
@@ -53,7 +53,11 @@ setup(
             'generate-dashboard=grafanalib._gen:generate_dashboard_script',
             'generate-dashboards=grafanalib._gen:generate_dashboards_script',
             'generate-alertgroup=grafanalib._gen:generate_alertgroup_script',
-            'generate-alertgroups=grafanalib._gen:generate_alertgroups_script'
+            'generate-alertgroups=grafanalib._gen:generate_alertgroups_script',
+            'dashboard-cost=grafanalib._gen:report_dashboard_cost_script',
+            'fleet-cost=grafanalib._gen:forecast_fleet_load_script',
+            'extract-recording-rules=grafanalib._gen:extract_recording_rules_script',
+            'export-used-metrics=grafanalib._gen:export_used_metrics_script'
         ],
     },
 )